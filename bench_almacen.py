@@ -0,0 +1,133 @@
+"""Varios workers compartiendo cachés y sesiones a través del almacén.
+
+Lanza, uno detrás de otro, varios procesos worker con el mismo
+``ALMACEN_PATH``, cada uno con su propio backend de Sheets en memoria:
+
+1. Caché: cada worker pide LISTAS y las casas de trabajo. Con ``memoria``
+   cada uno las lee de Sheets; con ``sqlite`` solo el primero.
+2. Sesión: un usuario empieza a meter un gasto en un worker y lo termina en
+   otro (como cuando el balanceador reparte los updates del webhook). Con
+   ``sqlite`` el segundo worker continúa la sesión y guarda el gasto.
+
+Uso:
+    python bench_almacen.py [--workers 3] [--backend memoria,sqlite]
+                            [--latencia-sheets-ms 80]
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+import benchmark
+import fake_telegram
+import stress_estado
+
+USER_ID = 4000
+
+
+async def _worker(indice, pasos, latencia_sheets_ms):
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+
+    entorno = await benchmark.preparar_bot(latencia_sheets_ms=latencia_sheets_ms)
+    main = entorno["main"]
+    sesion = entorno["sesion"]
+    app = entorno["app"]
+    main.ensure_google_sheets_ready()
+
+    antes = sesion.total_llamadas
+    t0 = time.perf_counter()
+    main.get_listas_data()
+    for persona in main.TRABAJO_SPREADSHEETS:
+        main.obtener_casas_trabajo(persona)
+    cache_ms = (time.perf_counter() - t0) * 1000
+    llamadas_cache = sesion.total_llamadas - antes
+
+    # Los update_id de Telegram son únicos entre workers: si se repitieran, el
+    # almacén compartido los descartaría como reentregas.
+    generador = fake_telegram.GeneradorUpdates(app.bot, entorno["telegram"], primer_update_id=1 + indice * 10000)
+    await app.start()
+    for paso in pasos:
+        await app.update_queue.put(generador.paso(USER_ID, paso))
+    await app.update_queue.join()
+    await app.stop()
+
+    guardados = main.consultar_registro(
+        "SELECT persona, pagador, observacion, importe FROM registro WHERE observacion LIKE 'stress %'"
+    )
+    await app.shutdown()
+    return {
+        "worker": indice,
+        "llamadas_cache": llamadas_cache,
+        "cache_ms": cache_ms,
+        "guardados": guardados,
+        "errores": len(entorno["errores"]),
+    }
+
+
+def _proceso_worker(indice, pasos, latencia_sheets_ms, entorno_vars, resultados):
+    os.environ.update(entorno_vars)
+    resultados.put(asyncio.run(_worker(indice, pasos, latencia_sheets_ms)))
+
+
+def ejecutar_backend(backend, workers, latencia_sheets_ms):
+    contexto = multiprocessing.get_context("spawn")
+    ruta = os.path.join(tempfile.mkdtemp(prefix="bench-almacen-"), "almacen.db")
+    pasos, esperado = stress_estado.pasos_gasto(USER_ID, 0, 1)
+    # El gasto se reparte entre el primer y el último worker; el resto solo lee cachés.
+    corte = len(pasos) // 2
+    tramos = [pasos[:corte]] + [[] for _ in range(workers - 2)] + [pasos[corte:]]
+
+    resultados = contexto.Queue()
+    filas = []
+    for indice in range(workers):
+        entorno_vars = {
+            "AUTHORIZED_USERS": str(USER_ID),
+            "ADMIN_ID": str(USER_ID),
+            "ALMACEN_BACKEND": backend,
+            "ALMACEN_PATH": ruta,
+            # El espejo de REGISTRO y demás ficheros locales, uno por worker.
+            "LOCAL_CACHE_DIR": tempfile.mkdtemp(prefix=f"bench-worker{indice}-"),
+        }
+        proceso = contexto.Process(
+            target=_proceso_worker,
+            args=(indice, tramos[indice], latencia_sheets_ms, entorno_vars, resultados),
+        )
+        proceso.start()
+        filas.append(resultados.get())
+        proceso.join()
+
+    print(f"\n=== Backend {backend} | {workers} workers ===")
+    print(f"{'Worker':6} | {'Sheets (cachés)':15} | {'ms cachés':9} | {'Pasos':5} | {'Errores':7}")
+    for fila, tramo in zip(filas, tramos):
+        print(
+            f"{fila['worker']:6} | {fila['llamadas_cache']:15} | {fila['cache_ms']:9.1f} | "
+            f"{len(tramo):5} | {fila['errores']:7}"
+        )
+    total = sum(f["llamadas_cache"] for f in filas)
+    guardados = filas[-1]["guardados"]
+    continua = len(guardados) == 1 and tuple(guardados[0]) == esperado
+    print(f"Llamadas a Sheets para cachés: {total}")
+    print(
+        "Sesión continuada en otro worker: "
+        + ("✅ gasto guardado con los datos del primer worker" if continua else f"❌ guardado: {guardados}")
+    )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--backend", default="memoria,sqlite", help="backends separados por coma")
+    parser.add_argument("--latencia-sheets-ms", type=float, default=80)
+    args = parser.parse_args()
+
+    for backend in args.backend.split(","):
+        ejecutar_backend(backend.strip(), max(args.workers, 2), args.latencia_sheets_ms)
+
+
+if __name__ == "__main__":
+    main_cli()
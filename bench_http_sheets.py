@@ -0,0 +1,178 @@
+"""Benchmark del transporte HTTP del cliente de Sheets.
+
+Levanta un servidor HTTP local que hace de Sheets (``values.get`` con un
+payload JSON de tamaño configurable, keep-alive y gzip) y simula el coste de
+abrir cada conexión (el handshake TCP+TLS contra Google). En cada ronda,
+tantos hilos como el pool de Sheets lanzan una petición a la vez (como varios
+usuarios pidiendo resúmenes) a través del ``HTTPClient`` de gspread, con
+distintas sesiones:
+
+- ``por defecto``: ``requests.Session`` tal cual (pool de 10 conexiones);
+- ``sin keep-alive``: una conexión nueva por llamada;
+- ``sin gzip``: la sesión ajustada, pero pidiendo la respuesta sin comprimir;
+- ``ajustada``: ``configurar_sesion_http`` (pool del tamaño del de hilos,
+  keep-alive y gzip).
+
+Informa del tiempo total, la latencia p50/p95 por llamada, las conexiones
+abiertas y los bytes recibidos.
+
+Uso:
+    python bench_http_sheets.py [--hilos 12] [--rondas 25] [--filas 500]
+                                [--handshake-ms 80] [--latencia-ms 20]
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import benchmark
+
+
+class ServidorSheets(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handshake_ms, latencia_ms, filas):
+        super().__init__(("127.0.0.1", 0), ManejadorSheets)
+        self.handshake_ms = handshake_ms
+        self.latencia_ms = latencia_ms
+        valores = [
+            ["2026-03-01", "Común", "Ramon", "Gasto", "Comida", "Supermercado", "Mercadona", "—", "compra", 23.4 + i]
+            for i in range(filas)
+        ]
+        self.cuerpo = json.dumps({"range": "REGISTRO!A1:J", "values": valores}).encode("utf-8")
+        self.cuerpo_gzip = gzip.compress(self.cuerpo)
+        self.lock = threading.Lock()
+        self.conexiones = 0
+        self.bytes_enviados = 0
+
+
+class ManejadorSheets(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.conexiones += 1
+        # Coste de abrir la conexión: handshake TCP + TLS con Google.
+        time.sleep(self.server.handshake_ms / 1000)
+
+    def do_GET(self):
+        time.sleep(self.server.latencia_ms / 1000)
+        comprimir = "gzip" in self.headers.get("Accept-Encoding", "")
+        cuerpo = self.server.cuerpo_gzip if comprimir else self.server.cuerpo
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        if comprimir:
+            self.send_header("Content-Encoding", "gzip")
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(cuerpo)
+        with self.server.lock:
+            self.server.bytes_enviados += len(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def sesiones(main, hilos):
+    import requests
+
+    por_defecto = requests.Session()
+
+    sin_keep_alive = requests.Session()
+    sin_keep_alive.headers["Connection"] = "close"
+
+    sin_gzip = main.configurar_sesion_http(requests.Session(), hilos)
+    sin_gzip.headers["Accept-Encoding"] = "identity"
+
+    ajustada = main.configurar_sesion_http(requests.Session(), hilos)
+
+    return [
+        ("por defecto", por_defecto),
+        ("sin keep-alive", sin_keep_alive),
+        ("sin gzip", sin_gzip),
+        ("ajustada", ajustada),
+    ]
+
+
+def medir_sesion(main, servidor, session, hilos, rondas):
+    from gspread.http_client import HTTPClient
+
+    http_client = HTTPClient(None, session=session)
+    http_client.timeout = (main.SHEETS_TIMEOUT_CONEXION, main.SHEETS_TIMEOUT_LECTURA)
+    main.instrumentar_http_client(http_client)
+    url = f"http://127.0.0.1:{servidor.server_port}/v4/spreadsheets/bench/values/REGISTRO!A1:J"
+
+    def llamada(_):
+        t0 = time.perf_counter()
+        respuesta = http_client.request("get", url)
+        assert len(respuesta.json()["values"]) > 0
+        return (time.perf_counter() - t0) * 1000
+
+    conexiones_antes = servidor.conexiones
+    bytes_antes = servidor.bytes_enviados
+    inicio = time.perf_counter()
+    tiempos = []
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        for _ in range(rondas):
+            tiempos += pool.map(llamada, range(hilos))
+    total_ms = (time.perf_counter() - inicio) * 1000
+    session.close()
+
+    return {
+        "total_ms": total_ms,
+        "p50": benchmark.percentil(tiempos, 50),
+        "p95": benchmark.percentil(tiempos, 95),
+        "conexiones": servidor.conexiones - conexiones_antes,
+        "kb": (servidor.bytes_enviados - bytes_antes) / 1024,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hilos", type=int, default=12)
+    parser.add_argument("--rondas", type=int, default=25, help="ráfagas de --hilos llamadas simultáneas")
+    parser.add_argument("--filas", type=int, default=500, help="filas del payload de values.get")
+    parser.add_argument("--handshake-ms", type=float, default=80, help="coste de abrir cada conexión")
+    parser.add_argument("--latencia-ms", type=float, default=20, help="latencia del servidor por petición")
+    args = parser.parse_args()
+
+    # urllib3 avisa de cada conexión descartada por pool lleno: aquí se cuentan.
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+
+    benchmark._configurar_entorno()
+    import main
+
+    servidor = ServidorSheets(args.handshake_ms, args.latencia_ms, args.filas)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    print(
+        f"{args.rondas} rondas x {args.hilos} hilos | payload {len(servidor.cuerpo) / 1024:.0f} KB "
+        f"({len(servidor.cuerpo_gzip) / 1024:.0f} KB gzip) | handshake {args.handshake_ms:.0f} ms | "
+        f"servidor {args.latencia_ms:.0f} ms\n"
+    )
+    cabecera = f"{'Sesión':15} | {'total ms':9} | {'p50 ms':7} | {'p95 ms':7} | {'conexiones':10} | {'KB recibidos':12}"
+    print(cabecera)
+    print("-" * len(cabecera))
+    for nombre, session in sesiones(main, args.hilos):
+        r = medir_sesion(main, servidor, session, args.hilos, args.rondas)
+        print(
+            f"{nombre:15} | {r['total_ms']:9.0f} | {r['p50']:7.1f} | {r['p95']:7.1f} | "
+            f"{r['conexiones']:10} | {r['kb']:12.0f}"
+        )
+
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,153 @@
+"""Benchmark de la importación y la exportación de CSV de REGISTRO.
+
+Genera CSV sintéticos de varios tamaños (con un porcentaje de filas
+erróneas), los sube como documento a la Application real, confirma la
+importación y después lo exporta todo con /export. Para cada tamaño
+informa de:
+
+- llamadas a Sheets y a Telegram de toda la importación;
+- tiempo del análisis (descarga + validación), de la escritura y de /export;
+- memoria de trabajo (pico de ``tracemalloc`` por encima de lo que queda
+  retenido al terminar; el backend falso de Sheets guarda las filas en
+  memoria y eso no cuenta como coste de la importación). La de la
+  exportación es la de generar el CSV: al enviarlo, python-telegram-bot
+  carga el fichero terminado para subirlo.
+
+Uso:
+    python bench_importar_csv.py [--filas 2000,20000,100000] [--errores 0.02]
+                                 [--latencia-sheets-ms 0]
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import logging
+import os
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import benchmark
+import fake_sheets
+import fake_telegram
+
+USER_ID = 5000
+
+
+def csv_sintetico(filas, errores, semilla=11):
+    rnd = random.Random(semilla)
+    salida = io.StringIO()
+    escritor = csv.writer(salida, delimiter=";")
+    escritor.writerow(["Fecha", "Persona", "Pagador", "Tipo", "Categoría", "Sub1", "Sub2", "Sub3", "Observación", "Importe"])
+    inicio = date.today() - timedelta(days=365)
+    for i in range(filas):
+        tipo, categoria, sub1, sub2, sub3 = rnd.choice(fake_sheets.TAXONOMIA)
+        fecha = (inicio + timedelta(days=rnd.randint(0, 364))).strftime("%d/%m/%Y")
+        importe = f"{rnd.uniform(1, 300):.2f}".replace(".", ",")
+        if rnd.random() < errores:
+            categoria = "Inventada"
+        escritor.writerow([
+            fecha,
+            rnd.choice(fake_sheets.PERSONAS),
+            rnd.choice(fake_sheets.PERSONAS),
+            tipo, categoria, sub1, sub2, sub3,
+            f"movimiento {i}",
+            importe,
+        ])
+    return salida.getvalue().encode("utf-8")
+
+
+async def medir(ronda, filas, errores, latencia_sheets_ms):
+    entorno = await benchmark.preparar_bot(latencia_sheets_ms=latencia_sheets_ms)
+    main = entorno["main"]
+    app = entorno["app"]
+    # El almacén recuerda los update_id de rondas anteriores: cada ronda usa los suyos.
+    generador = fake_telegram.GeneradorUpdates(app.bot, entorno["telegram"], primer_update_id=1 + ronda * 10000)
+    sesion = entorno["sesion"]
+    telegram = entorno["telegram"]
+    main.ensure_google_sheets_ready()
+    # Cada ronda tiene un libro falso nuevo con los mismos ids: el espejo de la
+    # ronda anterior se descarta para que no pase por actual.
+    with main._registro_lock:
+        main.get_registro_db().execute("DELETE FROM sync WHERE clave = 'origen'")
+    main.sincronizar_registro(forzar=True)
+    main.get_indice_taxonomia()
+
+    contenido = csv_sintetico(filas, errores)
+    await app.start()
+
+    async def atender(update):
+        antes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        await app.update_queue.put(update)
+        await app.update_queue.join()
+        ms = (time.perf_counter() - t0) * 1000
+        actual, pico = tracemalloc.get_traced_memory()
+        return ms, pico - max(antes, actual)
+
+    sheets_antes = sesion.total_llamadas
+    telegram.reiniciar_contadores()
+    ms_analisis, mem_analisis = await atender(generador.documento(USER_ID, "movimientos.csv", contenido))
+    ms_escritura, mem_escritura = await atender(generador.callback(USER_ID, "importar_csv|si"))
+    llamadas_sheets = sesion.total_llamadas - sheets_antes
+    ms_export, _ = await atender(generador.texto(USER_ID, "/export"))
+
+    tracemalloc.reset_peak()
+    antes = tracemalloc.get_traced_memory()[0]
+    exportadas, _ = main.exportar_registro({}, os.path.join(main.EXPORTAR_DIR, "bench.csv"))
+    mem_export = tracemalloc.get_traced_memory()[1] - antes
+
+    importadas = sum(1 for v in main.sheet.col_values(9) if v.startswith("movimiento "))
+    await app.stop()
+    await app.shutdown()
+    return {
+        "mb": len(contenido) / 1024 / 1024,
+        "importadas": importadas,
+        "sheets": llamadas_sheets,
+        "telegram": telegram.total_llamadas,
+        "ms_analisis": ms_analisis,
+        "ms_escritura": ms_escritura,
+        "mem_analisis": mem_analisis / 1024,
+        "mem_escritura": mem_escritura / 1024,
+        "ms_export": ms_export,
+        "mem_export": mem_export / 1024,
+        "exportadas": exportadas,
+        "errores": len(entorno["errores"]),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", default="2000,20000,100000", help="tamaños separados por coma")
+    parser.add_argument("--errores", type=float, default=0.02, help="fracción de filas con categoría inexistente")
+    parser.add_argument("--latencia-sheets-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    logging.getLogger().setLevel(logging.CRITICAL)
+    os.environ["AUTHORIZED_USERS"] = str(USER_ID)
+    os.environ["ADMIN_ID"] = str(USER_ID)
+    benchmark._configurar_entorno()
+    tracemalloc.start()
+
+    cabecera = (
+        f"{'Filas':>7} | {'MB':>5} | {'importadas':>10} | {'exportadas':>10} | {'Sheets':>6} | {'Telegram':>8} | "
+        f"{'análisis ms':>11} | {'escritura ms':>12} | {'export ms':>9} | {'mem análisis KB':>15} | "
+        f"{'mem escritura KB':>16} | {'mem export KB':>13}"
+    )
+    print(cabecera)
+    print("-" * len(cabecera))
+    for ronda, filas in enumerate(int(f) for f in args.filas.split(",")):
+        r = asyncio.run(medir(ronda, filas, args.errores, args.latencia_sheets_ms))
+        print(
+            f"{filas:7} | {r['mb']:5.1f} | {r['importadas']:10} | {r['exportadas']:10} | {r['sheets']:6} | {r['telegram']:8} | "
+            f"{r['ms_analisis']:11.0f} | {r['ms_escritura']:12.0f} | {r['ms_export']:9.0f} | "
+            f"{r['mem_analisis']:15.0f} | {r['mem_escritura']:16.0f} | {r['mem_export']:13.0f}" + (f" | ❌ {r['errores']} errores" if r["errores"] else "")
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,93 @@
+"""Benchmark del parseo de importes sobre hojas anuales grandes.
+
+Genera una hoja "Cuenta …: gráficos y datos {año}" sintética (categorías x
+13 columnas) y mide, para todas las columnas de mes más el total:
+
+- parseo celda a celda de textos con formato (lo que hacía el resumen);
+- ``parse_columna_importes`` sobre textos, sin y con NumPy;
+- ``parse_columna_importes`` sobre valores UNFORMATTED_VALUE (números).
+
+Uso:
+    python bench_importes.py [--filas 20000] [--repeticiones 5]
+"""
+
+import argparse
+import random
+import time
+
+import benchmark
+import fake_sheets
+
+
+def hoja_sintetica(filas, semilla=7):
+    rnd = random.Random(semilla)
+    numeros = []
+    for i in range(filas):
+        meses = [round(rnd.uniform(-50, 5000), 2) if rnd.random() < 0.85 else "" for _ in range(12)]
+        numeros.append([f"Categoría {i}"] + meses + [round(sum(m for m in meses if m != ""), 2)])
+    textos = [
+        [fila[0]] + [fake_sheets.formatear_moneda(v) if v != "" else "" for v in fila[1:]]
+        for fila in numeros
+    ]
+    return numeros, textos
+
+
+def medir(funcion, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    return min(tiempos)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, default=20000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    benchmark._configurar_entorno()
+    import main
+
+    numeros, textos = hoja_sintetica(args.filas)
+    columnas = range(1, 14)
+    np_original = main.np
+
+    def por_celda():
+        return [[main.parse_importe(fila[c]) for fila in textos] for c in columnas]
+
+    def columna_textos():
+        return [main.parse_columna_importes([fila[c] for fila in textos]) for c in columnas]
+
+    def columna_numeros():
+        return [main.parse_columna_importes([fila[c] for fila in numeros]) for c in columnas]
+
+    esperado = por_celda()
+    casos = [("celda a celda (texto)", por_celda, None)]
+
+    main.np = None
+    casos.append(("columna, sin NumPy (texto)", columna_textos, None))
+    assert columna_textos() == esperado
+    if np_original is not None:
+        main.np = np_original
+        assert columna_textos() == esperado
+        casos.append(("columna, NumPy (texto)", columna_textos, np_original))
+    casos.append(("columna (UNFORMATTED_VALUE)", columna_numeros, np_original))
+
+    celdas = args.filas * len(columnas)
+    print(f"{args.filas} filas x {len(columnas)} columnas = {celdas} celdas | mejor de {args.repeticiones}\n")
+    print(f"{'Caso':30} | {'ms':9} | {'celdas/ms':9}")
+    print("-" * 54)
+    for nombre, funcion, modulo_np in casos:
+        main.np = modulo_np
+        ms = medir(funcion, args.repeticiones)
+        print(f"{nombre:30} | {ms:9.1f} | {celdas / ms:9.0f}")
+    main.np = np_original
+
+    if np_original is None:
+        print("\nNumPy no está instalado: se omite la variante vectorizada.")
+
+
+if __name__ == "__main__":
+    main_cli()
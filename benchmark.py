@@ -0,0 +1,287 @@
+"""Benchmark de extremo a extremo de los flujos del bot.
+
+Recorre los flujos completos (añadir gasto, resumen, lista de la compra y
+trabajo) con ``application.process_update`` contra el backend de Sheets en
+memoria (``fake_sheets``) y un transporte falso de Telegram
+(``fake_telegram``). Informa del tiempo de pared y del número de llamadas a
+Sheets y a Telegram por flujo.
+
+Uso:
+    python benchmark.py [--repeticiones 5] [--latencia-sheets-ms 0]
+                        [--latencia-telegram-ms 0] [--tasa-error-cuota 0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from datetime import date
+
+
+def _configurar_entorno():
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN")
+    os.environ.setdefault("SPREADSHEET_NAME", "Gestión dinero (bench)")
+    os.environ.setdefault("SPREADSHEET_NAME_LISTA_COMPRA", "Lista compra (bench)")
+    os.environ.setdefault("AUTHORIZED_USERS", "1001,1002")
+    os.environ.setdefault("ADMIN_ID", "1001")
+    # Las credenciales solo se construyen al abrir el cliente real, que aquí no se usa.
+    os.environ.setdefault("GOOGLE_CREDENTIALS", "{}")
+    # Las cachés en disco del bot van a un directorio desechable.
+    os.environ.setdefault("LOCAL_CACHE_DIR", tempfile.mkdtemp(prefix="bench-cache-"))
+    # Los usuarios sintéticos tocan mucho más rápido que una persona: sin
+    # subir los límites de salida se mediría la cola y no el bot.
+    os.environ.setdefault("TELEGRAM_GLOBAL_POR_SEGUNDO", "100000")
+    os.environ.setdefault("TELEGRAM_CHAT_POR_SEGUNDO", "100000")
+
+
+async def preparar_bot(latencia_sheets_ms=0, tasa_error_cuota=0.0,
+                       latencia_telegram_ms=0, filas_registro=500, procesador=None,
+                       variacion_telegram_ms=0):
+    """Importa ``main`` apuntando a los backends falsos y devuelve el entorno listo."""
+    _configurar_entorno()
+
+    import main
+    import fake_sheets
+    import fake_telegram
+
+    sesion = fake_sheets.FakeSheetsSession(
+        latencia_ms=latencia_sheets_ms,
+        tasa_error_cuota=tasa_error_cuota,
+        semilla=42,
+    )
+    fake_sheets.crear_libros_bot(
+        sesion,
+        main.SHEET_NAME,
+        main.SHEET_NAME_LISTA_COMPRA,
+        main.TRABAJO_SPREADSHEETS,
+        filas_registro=filas_registro,
+    )
+    main.configurar_cliente_sheets(fake_sheets.cliente_gspread(sesion))
+
+    telegram_fake = fake_telegram.FakeTelegramRequest(
+        latencia_ms=latencia_telegram_ms,
+        variacion_ms=variacion_telegram_ms,
+        semilla=42,
+    )
+    app = main.construir_application(request=telegram_fake, procesador=procesador)
+
+    errores = []
+
+    async def contar_error(update, context):
+        errores.append(context.error)
+
+    app.add_error_handler(contar_error)
+    await app.initialize()
+
+    return {
+        "main": main,
+        "sesion": sesion,
+        "telegram": telegram_fake,
+        "app": app,
+        "generador": fake_telegram.GeneradorUpdates(app.bot, telegram_fake),
+        "errores": errores,
+    }
+
+
+def flujos_bot(año=None, mes=None):
+    """Guiones de pasos ``("cb", data)`` / ``("txt", texto)`` de cada flujo."""
+    hoy = date.today()
+    año = año or hoy.year
+    mes = mes or hoy.month
+
+    return {
+        "añadir gasto": [
+            ("txt", "/start"),
+            ("cb", "menu|gestion"),
+            ("cb", "menu|add"),
+            ("cb", "fecha|hoy"),
+            ("cb", "persona|Común"),
+            ("cb", "pagador|Ramon"),
+            ("cb", "tipo|Gasto"),
+            ("cb", "categoria|Comida"),
+            ("cb", "sub1|Supermercado"),
+            ("cb", "sub2|Mercadona"),
+            ("cb", "obs|si"),
+            ("txt", "compra semanal"),
+            ("txt", "23,40"),
+        ],
+        "gasto rápido": [
+            ("txt", "/g Común Ramon Mercadona 23,40 compra semanal"),
+            ("cb", "rapido|0"),
+        ],
+        "resumen": [
+            ("txt", "/start"),
+            ("cb", "menu|gestion"),
+            ("cb", "menu|resumen"),
+            ("cb", f"resumen_mes|{año}|{mes}"),
+            ("cb", f"resumen_final|{año}|{mes}|Común"),
+            ("cb", "menu|resumen"),
+            ("cb", f"resumen_año|{año}"),
+            ("cb", f"resumen_final|{año}|0|Ramon"),
+            ("cb", "menu|resumen"),
+            ("cb", f"resumen_mes|{año}|{mes}"),
+            ("cb", f"resumen_final|{año}|{mes}|Todos"),
+        ],
+        "comparativa": [
+            ("txt", "/start"),
+            ("cb", "menu|gestion"),
+            ("cb", "menu|resumen"),
+            ("cb", f"comparar|{año}"),
+            ("cb", f"comparar_persona|{año}|Común"),
+            ("cb", f"comparar_cat|{año}|Común|0"),
+            ("cb", f"comparar_persona|{año}|Común"),
+            ("cb", f"comparar_cat|{año}|Común|1"),
+        ],
+        "lista compra": [
+            ("txt", "/start"),
+            ("cb", "menu|lista"),
+            ("cb", "lista|add"),
+            ("cb", "lista_add|Mercadona"),
+            ("txt", "Leche, Pan, Huevos"),
+            ("cb", "lista|ver"),
+            ("cb", "lista|borrar"),
+            ("cb", "lista_borrar|Mercadona"),
+            ("cb", "lista_toggle|2"),
+            ("cb", "lista_toggle|3"),
+            ("cb", "lista_confirm_delete"),
+        ],
+        "trabajo": [
+            ("txt", "/start"),
+            ("cb", "menu|trabajo"),
+            ("cb", "trabajo|Ramon"),
+            ("cb", "trabajo_promotor_toggle|RCM"),
+            ("cb", "trabajo_promotor_toggle|DMC"),
+            ("cb", "trabajo_promotor_confirmar"),
+            ("cb", "trabajo_fecha|hoy"),
+            ("txt", "reta"),
+            ("cb", "trabajo_casa_idx|0"),
+            ("cb", "trabajo_tipo_bono|Recurrente"),
+            ("cb", "trabajo_tipo_promo|Freebet"),
+            ("txt", "Freebet 10€ cuota mínima 1.5"),
+            ("txt", "Betis - Sevilla"),
+            ("txt", "-9,50"),
+            ("txt", "21.3"),
+            ("txt", "Todo correcto"),
+        ],
+        "buscar": [
+            ("txt", "/buscar mercadona"),
+            ("cb", "buscar_pag|1"),
+            ("txt", f"/buscar tipo:Gasto mes:{mes}/{año} persona:Común"),
+            ("txt", "/buscar cat:Comida sub:Supermercado desde:01/01/{0} hasta:30/06/{0}".format(año)),
+        ],
+        "stats": [
+            ("txt", "/stats"),
+        ],
+    }
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[k]
+
+
+async def ejecutar_flujo(entorno, user_id, pasos):
+    app = entorno["app"]
+    generador = entorno["generador"]
+    for paso in pasos:
+        await app.process_update(generador.paso(user_id, paso))
+
+
+async def benchmark(repeticiones, **opciones):
+    entorno = await preparar_bot(**opciones)
+    main = entorno["main"]
+    sesion = entorno["sesion"]
+    telegram_fake = entorno["telegram"]
+    user_id = next(iter(sorted(main.AUTHORIZED_USERS)))
+
+    # Los errores de cuota se inyectan solo en los flujos, no en la apertura de libros.
+    tasa_error_cuota, sesion.tasa_error_cuota = sesion.tasa_error_cuota, 0.0
+    inicio = time.perf_counter()
+    main.ensure_google_sheets_ready()
+    arranque_ms = (time.perf_counter() - inicio) * 1000
+    llamadas_arranque = sesion.total_llamadas
+    sesion.tasa_error_cuota = tasa_error_cuota
+
+    resultados = []
+    for nombre, pasos in flujos_bot().items():
+        tiempos = []
+        sheets = []
+        telegram = []
+        errores_antes = len(entorno["errores"])
+        ediciones_antes = main._metricas_ui["ediciones"]
+
+        for _ in range(repeticiones):
+            sesion.reiniciar_contadores()
+            telegram_fake.reiniciar_contadores()
+            t0 = time.perf_counter()
+            await ejecutar_flujo(entorno, user_id, pasos)
+            tiempos.append((time.perf_counter() - t0) * 1000)
+            sheets.append(sesion.total_llamadas)
+            telegram.append(telegram_fake.total_llamadas)
+
+        resultados.append({
+            "flujo": nombre,
+            "pasos": len(pasos),
+            "ms_medio": sum(tiempos) / len(tiempos),
+            "ms_p95": percentil(tiempos, 95),
+            "sheets": sum(sheets) / len(sheets),
+            "telegram": sum(telegram) / len(telegram),
+            "errores": len(entorno["errores"]) - errores_antes,
+            "ediciones": (main._metricas_ui["ediciones"] - ediciones_antes) / repeticiones,
+            # Respuestas escritas (no comandos): el bot las borra y edita su mensaje.
+            "pasos_escritos": sum(1 for tipo, valor in pasos if tipo == "txt" and not valor.startswith("/")),
+        })
+
+    await entorno["app"].shutdown()
+    return arranque_ms, llamadas_arranque, resultados
+
+
+def imprimir_resultados(arranque_ms, llamadas_arranque, resultados, repeticiones):
+    print(f"Arranque Sheets: {arranque_ms:.1f} ms | {llamadas_arranque} llamadas")
+    print(f"Repeticiones por flujo: {repeticiones}\n")
+    cabecera = (
+        f"{'Flujo':16} | {'Pasos':5} | {'ms medio':9} | {'ms p95':9} | {'Sheets':7} | {'Telegram':8} | "
+        f"{'Ediciones':9} | {'Errores':7}"
+    )
+    print(cabecera)
+    print("-" * len(cabecera))
+    for r in resultados:
+        print(
+            f"{r['flujo']:16} | {r['pasos']:5} | {r['ms_medio']:9.1f} | {r['ms_p95']:9.1f} | "
+            f"{r['sheets']:7.1f} | {r['telegram']:8.1f} | {r['ediciones']:9.1f} | {r['errores']:7}"
+        )
+    sin_editar = [r["flujo"] for r in resultados if r["pasos_escritos"] and not r["ediciones"]]
+    if sin_editar:
+        print("\n❌ Pasos escritos que reenvían el mensaje de interfaz en vez de editarlo: " + ", ".join(sin_editar))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--latencia-sheets-ms", type=float, default=0)
+    parser.add_argument("--latencia-telegram-ms", type=float, default=0)
+    parser.add_argument("--tasa-error-cuota", type=float, default=0.0)
+    parser.add_argument("--filas-registro", type=int, default=500)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    arranque_ms, llamadas_arranque, resultados = asyncio.run(benchmark(
+        args.repeticiones,
+        latencia_sheets_ms=args.latencia_sheets_ms,
+        latencia_telegram_ms=args.latencia_telegram_ms,
+        tasa_error_cuota=args.tasa_error_cuota,
+        filas_registro=args.filas_registro,
+    ))
+    imprimir_resultados(arranque_ms, llamadas_arranque, resultados, args.repeticiones)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,597 @@
+"""Backend de Google Sheets en memoria para benchmarks y pruebas de carga.
+
+Imita la API REST de Sheets v4 y el listado de Drive que usa gspread, de modo
+que el bot funciona contra él con un ``gspread.Client`` normal (incluido el
+cliente trazado de ``main``). Permite configurar latencia por llamada y
+errores de cuota (HTTP 429).
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime
+from urllib.parse import unquote, urlsplit
+
+import gspread
+import requests
+from gspread.http_client import HTTPClient
+
+MESES = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre",
+]
+
+CUENTAS = {
+    "Común": "Cuenta común",
+    "Claudia": "Cuenta Claudia",
+    "Ramon": "Cuenta Ramon",
+}
+
+PERSONAS = ["Ramon", "Claudia", "Común"]
+
+# tipo, categoría, sub1, sub2, sub3
+TAXONOMIA = [
+    ("Gasto", "Comida", "Supermercado", "Mercadona", "—"),
+    ("Gasto", "Comida", "Supermercado", "Carrefour", "—"),
+    ("Gasto", "Comida", "Supermercado", "Sirena", "—"),
+    ("Gasto", "Comida", "Restaurante", "—", "—"),
+    ("Gasto", "Comida", "Delivery", "—", "—"),
+    ("Gasto", "Hogar", "Alquiler", "—", "—"),
+    ("Gasto", "Hogar", "Suministros", "Luz", "—"),
+    ("Gasto", "Hogar", "Suministros", "Agua", "—"),
+    ("Gasto", "Hogar", "Suministros", "Internet", "Fibra"),
+    ("Gasto", "Hogar", "Suministros", "Internet", "Móvil"),
+    ("Gasto", "Hogar", "Limpieza", "—", "—"),
+    ("Gasto", "Transporte", "Gasolina", "—", "—"),
+    ("Gasto", "Transporte", "Transporte público", "Metro", "—"),
+    ("Gasto", "Transporte", "Transporte público", "Tren", "—"),
+    ("Gasto", "Transporte", "Parking", "—", "—"),
+    ("Gasto", "Salud", "Farmacia", "—", "—"),
+    ("Gasto", "Salud", "Dentista", "—", "—"),
+    ("Gasto", "Ocio", "Cine", "—", "—"),
+    ("Gasto", "Ocio", "Viajes", "Vuelos", "—"),
+    ("Gasto", "Ocio", "Viajes", "Hotel", "—"),
+    ("Gasto", "Ocio", "Suscripciones", "Streaming", "—"),
+    ("Gasto", "Ropa", "Ropa", "—", "—"),
+    ("Gasto", "Mascotas", "Comida", "—", "—"),
+    ("Gasto", "Mascotas", "Veterinario", "—", "—"),
+    ("Ingreso", "Nómina", "Nómina", "—", "—"),
+    ("Ingreso", "Trabajo", "Promos", "—", "—"),
+    ("Ingreso", "Otros", "Devoluciones", "—", "—"),
+    ("Ahorro", "Inversión", "Fondos", "—", "—"),
+    ("Ahorro", "Inversión", "Colchón", "—", "—"),
+]
+
+CASAS = [
+    "Bet365", "William Hill", "Codere", "Retabet", "Bwin", "Sportium",
+    "Luckia", "Marca Apuestas", "888sport", "Betfair", "Casino Gran Madrid",
+    "Betway", "Kirolbet", "Paf", "PokerStars", "Versus", "Jokerbet",
+    "Yaass Casino", "Enracha", "Goldenpark", "Casumo", "LeoVegas",
+    "Interwetten", "Betsson", "Unibet", "Tonybet", "Olybet", "Efbet",
+    "Admiral", "Botemanía", "Casino Barcelona", "Juegging", "Bet777",
+    "Winamax", "Aupabet", "Daznbet",
+]
+
+PRODUCTOS = [
+    "Leche", "Pan", "Huevos", "Tomates", "Aceite", "Arroz", "Pasta",
+    "Yogures", "Café", "Plátanos", "Pollo", "Queso", "Agua", "Detergente",
+]
+
+_RE_A1 = re.compile(r"^([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+_RE_NUMERO = re.compile(r"^-?\d+(?:[.,]\d+)?$")
+
+
+def _cargar_cuerpo(data):
+    if not data:
+        return {}
+    return json.loads(data)
+
+
+def columna_a_indice(letras):
+    indice = 0
+    for letra in letras:
+        indice = indice * 26 + (ord(letra) - 64)
+    return indice
+
+
+def formatear_moneda(valor):
+    texto = f"{abs(valor):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"{'-' if valor < 0 else ''}{texto} €"
+
+
+def formatear_numero(valor):
+    if isinstance(valor, float) and not valor.is_integer():
+        return repr(valor).replace(".", ",")
+    return str(int(valor))
+
+
+class HojaFake:
+    def __init__(self, titulo, sheet_id, index, filas=None, moneda=False):
+        self.titulo = titulo
+        self.sheet_id = sheet_id
+        self.index = index
+        self.filas = [list(f) for f in (filas or [])]
+        self.moneda = moneda
+
+    @property
+    def num_filas(self):
+        return max(1000, len(self.filas))
+
+    @property
+    def num_columnas(self):
+        return max([26] + [len(f) for f in self.filas])
+
+    def propiedades(self):
+        return {
+            "sheetId": self.sheet_id,
+            "title": self.titulo,
+            "index": self.index,
+            "sheetType": "GRID",
+            "gridProperties": {
+                "rowCount": self.num_filas,
+                "columnCount": self.num_columnas,
+            },
+        }
+
+    def _celda(self, fila, col):
+        if fila < len(self.filas) and col < len(self.filas[fila]):
+            return self.filas[fila][col]
+        return ""
+
+    def _renderizar(self, valor, render):
+        if valor == "" or valor is None:
+            return ""
+        if render == "UNFORMATTED_VALUE" or not isinstance(valor, (int, float)):
+            return valor
+        if self.moneda:
+            return formatear_moneda(valor)
+        return formatear_numero(valor)
+
+    def leer(self, f0, c0, f1, c1, render="FORMATTED_VALUE", columnas=False):
+        f1 = len(self.filas) if f1 is None else min(f1, len(self.filas))
+        c1 = self.num_columnas if c1 is None else c1
+
+        filas = []
+        for f in range(f0, f1):
+            filas.append([self._renderizar(self._celda(f, c), render) for c in range(c0, c1)])
+
+        if columnas:
+            ancho = max([len(f) for f in filas] + [0])
+            filas = [[fila[c] for fila in filas] for c in range(ancho)]
+
+        # La API real recorta celdas y filas vacías al final.
+        resultado = []
+        for fila in filas:
+            while fila and fila[-1] == "":
+                fila.pop()
+            resultado.append(fila)
+        while resultado and not resultado[-1]:
+            resultado.pop()
+        return resultado
+
+    def escribir(self, f0, c0, valores, user_entered=True):
+        for df, fila_valores in enumerate(valores):
+            f = f0 + df
+            while len(self.filas) <= f:
+                self.filas.append([])
+            fila = self.filas[f]
+            for dc, valor in enumerate(fila_valores):
+                c = c0 + dc
+                while len(fila) <= c:
+                    fila.append("")
+                fila[c] = self._interpretar(valor) if user_entered else valor
+
+    @staticmethod
+    def _interpretar(valor):
+        if isinstance(valor, str) and _RE_NUMERO.match(valor.strip()):
+            numero = float(valor.strip().replace(",", "."))
+            return int(numero) if numero.is_integer() else numero
+        return valor
+
+    def limpiar(self, f0, c0, f1, c1):
+        f1 = len(self.filas) if f1 is None else min(f1, len(self.filas))
+        for f in range(f0, f1):
+            fila = self.filas[f]
+            fin = len(fila) if c1 is None else min(c1, len(fila))
+            for c in range(c0, fin):
+                fila[c] = ""
+
+    def ultima_fila_con_datos(self):
+        for f in range(len(self.filas) - 1, -1, -1):
+            if any(v != "" for v in self.filas[f]):
+                return f + 1
+        return 0
+
+
+class LibroFake:
+    def __init__(self, spreadsheet_id, titulo):
+        self.id = spreadsheet_id
+        self.titulo = titulo
+        self.hojas = []
+
+    def añadir_hoja(self, titulo, filas=None, moneda=False):
+        hoja = HojaFake(titulo, len(self.hojas) * 1000 + 7, len(self.hojas), filas, moneda)
+        self.hojas.append(hoja)
+        return hoja
+
+    def hoja(self, titulo):
+        for hoja in self.hojas:
+            if hoja.titulo == titulo:
+                return hoja
+        raise KeyError(titulo)
+
+    def hoja_por_id(self, sheet_id):
+        for hoja in self.hojas:
+            if hoja.sheet_id == sheet_id:
+                return hoja
+        raise KeyError(sheet_id)
+
+    def metadatos(self):
+        return {
+            "spreadsheetId": self.id,
+            "properties": {"title": self.titulo, "locale": "es_ES", "timeZone": "Europe/Madrid"},
+            "sheets": [{"properties": h.propiedades()} for h in self.hojas],
+        }
+
+
+class FakeSheetsSession:
+    """Sustituto de ``requests.Session`` que atiende la API de Sheets en memoria.
+
+    ``latencia_ms`` puede ser un número o una tupla ``(min, max)``; la espera
+    se hace fuera del lock para que las llamadas concurrentes se solapen como
+    en la API real. ``tasa_error_cuota`` es la probabilidad de responder 429.
+    """
+
+    def __init__(self, latencia_ms=0, tasa_error_cuota=0.0, semilla=None):
+        self.latencia_ms = latencia_ms
+        self.tasa_error_cuota = tasa_error_cuota
+        self.headers = {}
+        self.libros = {}
+        self.llamadas = Counter()
+        self.errores_cuota = 0
+        self.bytes_respuesta = 0
+        self._errores_forzados = 0
+        self._random = random.Random(semilla)
+        self._lock = threading.Lock()
+
+    # ---------- configuración ----------
+
+    def crear_libro(self, titulo):
+        libro = LibroFake(f"fake-{len(self.libros) + 1:04d}", titulo)
+        self.libros[libro.id] = libro
+        return libro
+
+    def libro(self, titulo):
+        for libro in self.libros.values():
+            if libro.titulo == titulo:
+                return libro
+        raise KeyError(titulo)
+
+    def forzar_errores_cuota(self, n):
+        self._errores_forzados += n
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.llamadas.clear()
+            self.errores_cuota = 0
+            self.bytes_respuesta = 0
+
+    @property
+    def total_llamadas(self):
+        return sum(self.llamadas.values())
+
+    # ---------- interfaz requests.Session ----------
+
+    def close(self):
+        pass
+
+    def request(self, method, url, params=None, data=None, json=None,
+                files=None, headers=None, timeout=None, **kwargs):
+        self._esperar_latencia()
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        cuerpo = json if json is not None else _cargar_cuerpo(data)
+
+        with self._lock:
+            if self._debe_fallar_por_cuota():
+                self.errores_cuota += 1
+                return self._respuesta(url, 429, {
+                    "error": {
+                        "code": 429,
+                        "message": "Quota exceeded for quota metric 'Read requests'",
+                        "status": "RESOURCE_EXHAUSTED",
+                    }
+                })
+
+            try:
+                operacion, resultado = self._despachar(method.upper(), url, params, cuerpo)
+            except KeyError as e:
+                return self._respuesta(url, 404, {
+                    "error": {"code": 404, "message": f"Not found: {e}", "status": "NOT_FOUND"}
+                })
+            except ValueError as e:
+                return self._respuesta(url, 400, {
+                    "error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}
+                })
+
+            self.llamadas[operacion] += 1
+            return self._respuesta(url, 200, resultado)
+
+    def _esperar_latencia(self):
+        latencia = self.latencia_ms
+        if isinstance(latencia, (tuple, list)):
+            latencia = self._random.uniform(*latencia)
+        if latencia:
+            time.sleep(latencia / 1000)
+
+    def _debe_fallar_por_cuota(self):
+        if self._errores_forzados > 0:
+            self._errores_forzados -= 1
+            return True
+        return self.tasa_error_cuota > 0 and self._random.random() < self.tasa_error_cuota
+
+    def _respuesta(self, url, status, cuerpo):
+        response = requests.models.Response()
+        response.status_code = status
+        response.url = url
+        response.encoding = "utf-8"
+        response.headers["Content-Type"] = "application/json; charset=UTF-8"
+        response._content = json.dumps(cuerpo).encode("utf-8")
+        if status == 200:
+            self.bytes_respuesta += len(response._content)
+        return response
+
+    # ---------- API ----------
+
+    def _despachar(self, method, url, params, cuerpo):
+        path = urlsplit(url).path
+
+        if "/drive/" in path:
+            return "drive.files", self._listar_ficheros(params)
+
+        resto = path.split("/spreadsheets/", 1)[1]
+
+        if "/values/" in resto:
+            spreadsheet_id, rango_raw = resto.split("/values/", 1)
+            libro = self.libros[spreadsheet_id]
+            if rango_raw.endswith(":append"):
+                return "values.append", self._append(libro, unquote(rango_raw[:-7]), params, cuerpo)
+            if rango_raw.endswith(":clear"):
+                self._limpiar(libro, unquote(rango_raw[:-6]))
+                return "values.clear", {"spreadsheetId": libro.id}
+            if method == "GET":
+                return "values.get", self._leer(libro, unquote(rango_raw), params)
+            return "values.update", self._actualizar(libro, unquote(rango_raw), params, cuerpo)
+
+        if "/values:" in resto:
+            spreadsheet_id, accion = resto.split("/values:", 1)
+            libro = self.libros[spreadsheet_id]
+            if accion == "batchGet":
+                rangos = params.get("ranges", [])
+                if isinstance(rangos, str):
+                    rangos = [rangos]
+                return "values.batchGet", {
+                    "spreadsheetId": libro.id,
+                    "valueRanges": [self._leer(libro, r, params) for r in rangos],
+                }
+            if accion == "batchClear":
+                for rango in cuerpo.get("ranges", []):
+                    self._limpiar(libro, rango)
+                return "values.batchClear", {"spreadsheetId": libro.id, "clearedRanges": cuerpo.get("ranges", [])}
+            if accion == "batchUpdate":
+                parametros = {"valueInputOption": cuerpo.get("valueInputOption", "RAW")}
+                respuestas = [
+                    self._actualizar(libro, d["range"], parametros, d)
+                    for d in cuerpo.get("data", [])
+                ]
+                return "values.batchUpdate", {"spreadsheetId": libro.id, "responses": respuestas}
+            raise ValueError(f"Acción no soportada: {accion}")
+
+        if resto.endswith(":batchUpdate"):
+            libro = self.libros[resto[:-len(":batchUpdate")]]
+            replies = [self._peticion_estructura(libro, r) for r in cuerpo.get("requests", [])]
+            return "batchUpdate", {"spreadsheetId": libro.id, "replies": replies}
+
+        return "metadata", self.libros[resto].metadatos()
+
+    def _listar_ficheros(self, params):
+        consulta = params.get("q", "")
+        nombre = re.search(r'name = "(.*?)"', consulta)
+        ahora = datetime.now().isoformat() + "Z"
+        return {
+            "kind": "drive#fileList",
+            "files": [
+                {"id": libro.id, "name": libro.titulo, "createdTime": ahora, "modifiedTime": ahora}
+                for libro in self.libros.values()
+                if nombre is None or libro.titulo == nombre.group(1)
+            ],
+        }
+
+    def _resolver_rango(self, libro, rango):
+        if "!" in rango:
+            titulo, a1 = rango.rsplit("!", 1)
+        else:
+            titulo, a1 = rango, ""
+        titulo = titulo.strip()
+        if titulo.startswith("'") and titulo.endswith("'"):
+            titulo = titulo[1:-1].replace("''", "'")
+        hoja = libro.hoja(titulo)
+
+        if not a1:
+            return hoja, 0, 0, None, None
+
+        match = _RE_A1.match(a1.upper())
+        if not match:
+            raise ValueError(f"Rango no soportado: {rango}")
+        col0, fila0, col1, fila1 = match.groups()
+        es_rango = ":" in a1
+
+        c0 = columna_a_indice(col0) - 1 if col0 else 0
+        f0 = int(fila0) - 1 if fila0 else 0
+        if es_rango:
+            c1 = columna_a_indice(col1) if col1 else None
+            f1 = int(fila1) if fila1 else None
+        else:
+            c1 = c0 + 1
+            f1 = f0 + 1
+        return hoja, f0, c0, f1, c1
+
+    def _leer(self, libro, rango, params):
+        hoja, f0, c0, f1, c1 = self._resolver_rango(libro, rango)
+        valores = hoja.leer(
+            f0, c0, f1, c1,
+            render=params.get("valueRenderOption", "FORMATTED_VALUE"),
+            columnas=params.get("majorDimension") == "COLUMNS",
+        )
+        respuesta = {
+            "range": rango,
+            "majorDimension": params.get("majorDimension", "ROWS"),
+        }
+        if valores:
+            respuesta["values"] = valores
+        return respuesta
+
+    def _actualizar(self, libro, rango, params, cuerpo):
+        hoja, f0, c0, _, _ = self._resolver_rango(libro, rango)
+        valores = cuerpo.get("values", [])
+        hoja.escribir(f0, c0, valores, params.get("valueInputOption") == "USER_ENTERED")
+        return {
+            "spreadsheetId": libro.id,
+            "updatedRange": rango,
+            "updatedRows": len(valores),
+            "updatedCells": sum(len(f) for f in valores),
+        }
+
+    def _append(self, libro, rango, params, cuerpo):
+        hoja, _, c0, _, _ = self._resolver_rango(libro, rango)
+        f0 = hoja.ultima_fila_con_datos()
+        valores = cuerpo.get("values", [])
+        hoja.escribir(f0, c0, valores, params.get("valueInputOption") == "USER_ENTERED")
+        return {
+            "spreadsheetId": libro.id,
+            "tableRange": rango,
+            "updates": {
+                "spreadsheetId": libro.id,
+                "updatedRange": f"'{hoja.titulo}'!A{f0 + 1}",
+                "updatedRows": len(valores),
+                "updatedCells": sum(len(f) for f in valores),
+            },
+        }
+
+    def _limpiar(self, libro, rango):
+        hoja, f0, c0, f1, c1 = self._resolver_rango(libro, rango)
+        hoja.limpiar(f0, c0, f1, c1)
+
+    def _peticion_estructura(self, libro, peticion):
+        if "deleteDimension" in peticion:
+            rango = peticion["deleteDimension"]["range"]
+            hoja = libro.hoja_por_id(rango["sheetId"])
+            inicio, fin = rango["startIndex"], rango["endIndex"]
+            if rango["dimension"] == "ROWS":
+                del hoja.filas[inicio:fin]
+            else:
+                for fila in hoja.filas:
+                    del fila[inicio:fin]
+        return {}
+
+
+def cliente_gspread(sesion, http_client=HTTPClient):
+    """Devuelve un ``gspread.Client`` que habla con ``sesion`` en lugar de Google."""
+    return gspread.Client(None, session=sesion, http_client=http_client)
+
+
+def crear_libros_bot(
+    sesion,
+    nombre_gestion,
+    nombre_lista_compra,
+    trabajo_spreadsheets,
+    año=None,
+    filas_registro=500,
+    semilla=1234,
+):
+    """Puebla ``sesion`` con la estructura de libros que espera el bot."""
+    rnd = random.Random(semilla)
+    año = año or date.today().year
+
+    # ---------- Gestión de dinero ----------
+    gestion = sesion.crear_libro(nombre_gestion)
+
+    registro = [[
+        "Fecha", "Persona", "Pagador", "Tipo", "Categoría",
+        "Sub1", "Sub2", "Sub3", "Observación", "Importe",
+    ]]
+    for _ in range(filas_registro):
+        tipo, categoria, sub1, sub2, sub3 = rnd.choice(TAXONOMIA)
+        fecha = date(año, rnd.randint(1, 12), rnd.randint(1, 28))
+        registro.append([
+            fecha.isoformat(),
+            rnd.choice(PERSONAS),
+            rnd.choice(PERSONAS),
+            tipo, categoria, sub1, sub2, sub3,
+            rnd.choice(["", "", "", "compra semanal", "cena", "regalo"]),
+            round(rnd.uniform(2, 180), 2),
+        ])
+    gestion.añadir_hoja("REGISTRO", registro, moneda=True)
+
+    listas = [["Tipo", "Categoría", "Sub1", "Sub2", "Sub3"] + [""] * 13 + ["Persona", "Pagador"]]
+    for i, fila in enumerate(TAXONOMIA):
+        extra = [""] * 13 + ([PERSONAS[i], PERSONAS[i]] if i < len(PERSONAS) else [])
+        listas.append(list(fila) + extra)
+    gestion.añadir_hoja("LISTAS", listas)
+
+    categorias = sorted({fila[1] for fila in TAXONOMIA})
+    for persona, prefijo in CUENTAS.items():
+        for año_hoja in (año - 1, año):
+            datos = [["Categoría"] + MESES + ["Total"]]
+            for categoria in categorias:
+                meses = [round(rnd.uniform(0, 600), 2) if rnd.random() < 0.8 else "" for _ in MESES]
+                total = round(sum(m for m in meses if m != ""), 2)
+                datos.append([categoria] + meses + [total])
+            gestion.añadir_hoja(f"{prefijo}: gráficos y datos {año_hoja}", datos, moneda=True)
+
+        objetivos = [["Categoría", "Mes", "Objetivo", "Real"]]
+        for categoria in categorias:
+            objetivos.append([
+                categoria,
+                MESES[date.today().month - 1],
+                round(rnd.uniform(50, 500), 0),
+                round(rnd.uniform(0, 550), 2),
+            ])
+        gestion.añadir_hoja(f"{prefijo}: gráficos y datos del mes actual", objetivos, moneda=True)
+
+    # ---------- Lista de la compra ----------
+    compra = sesion.crear_libro(nombre_lista_compra)
+    for supermercado in ("Carrefour", "Mercadona", "Sirena", "Otros"):
+        productos = rnd.sample(PRODUCTOS, rnd.randint(0, 5))
+        compra.añadir_hoja(supermercado, [["Producto"]] + [[p] for p in productos])
+
+    # ---------- Trabajo ----------
+    for nombre in trabajo_spreadsheets.values():
+        libro = sesion.crear_libro(nombre)
+
+        promos = [[
+            "Promotor", "Fecha", "Casa", "Tipo bono", "Tipo promo", "Condiciones",
+            "Partido", "", "", "", "", "", "", "", "", "Pérdida", "Beneficio",
+            "Neto", "Observaciones",
+        ]]
+        for n in range(2, 2 + rnd.randint(20, 60)):
+            fila = [""] * 19
+            fila[0] = "RCM"
+            fila[1] = date(año, rnd.randint(1, 12), rnd.randint(1, 28)).isoformat()
+            fila[2] = rnd.choice(CASAS)
+            fila[15] = round(rnd.uniform(-20, 0), 2)
+            fila[16] = round(rnd.uniform(0, 40), 2)
+            promos.append(fila)
+        # La columna R lleva fórmulas precargadas que el bot no debe pisar.
+        for n in range(2, 400):
+            while len(promos) < n:
+                promos.append([""] * 19)
+            promos[n - 1][17] = f"=Q{n}+P{n}"
+        libro.añadir_hoja("PromosDone", promos)
+
+        control = [["Control de casas"], [], [], ["Casa"]] + [[c] for c in CASAS]
+        libro.añadir_hoja("ControlDeCases", control)
+
+    return sesion
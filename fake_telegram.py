@@ -0,0 +1,201 @@
+"""Transporte falso de la Bot API y generador de updates sintéticos.
+
+``FakeTelegramRequest`` sustituye a ``HTTPXRequest`` en el ``Bot``: responde a
+cada método de la API con un JSON plausible sin salir a la red, de modo que
+``application.process_update`` recorre los handlers reales de ``main``.
+"""
+
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+BOT_USER = {
+    "id": 999000999,
+    "is_bot": True,
+    "first_name": "Gestión Dinero (bench)",
+    "username": "gestion_dinero_bench_bot",
+}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Responde a la Bot API en memoria, con latencia opcional por llamada.
+
+    ``variacion_ms`` suma a cada llamada un extra aleatorio entre 0 y ese valor,
+    de modo que las respuestas pueden llegar en otro orden que las peticiones.
+    """
+
+    def __init__(self, latencia_ms=0, variacion_ms=0, semilla=None):
+        self.latencia_ms = latencia_ms
+        self.variacion_ms = variacion_ms
+        self._rnd = random.Random(semilla)
+        self.llamadas = Counter()
+        self.ultimo_mensaje = {}
+        # Documentos que los usuarios "han subido", por file_id.
+        self.ficheros = {}
+        # Como en un chat privado real, usuario y bot comparten la numeración.
+        self._message_ids = defaultdict(lambda: itertools.count(1))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def reiniciar_contadores(self):
+        self.llamadas.clear()
+
+    @property
+    def total_llamadas(self):
+        return sum(self.llamadas.values())
+
+    def siguiente_message_id(self, chat_id):
+        return next(self._message_ids[chat_id])
+
+    def _mensaje(self, chat_id, parametros, message_id=None):
+        if message_id is None:
+            message_id = self.siguiente_message_id(chat_id)
+            self.ultimo_mensaje[chat_id] = message_id
+        mensaje = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in parametros:
+            mensaje["text"] = parametros["text"]
+        if "reply_markup" in parametros:
+            mensaje["reply_markup"] = parametros["reply_markup"]
+        if "document" in parametros:
+            mensaje["document"] = {"file_id": "fake-file", "file_unique_id": "fake"}
+        return mensaje
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ):
+        latencia_ms = self.latencia_ms + (self._rnd.uniform(0, self.variacion_ms) if self.variacion_ms else 0)
+        if latencia_ms:
+            await asyncio.sleep(latencia_ms / 1000)
+
+        metodo = url.rsplit("/", 1)[-1]
+        if "/file/bot" in url:
+            # Descarga de un fichero: la URL acaba en el file_path de getFile.
+            self.llamadas["descarga"] += 1
+            return 200, self.ficheros[metodo]
+        self.llamadas[metodo] += 1
+        parametros = request_data.parameters if request_data is not None else {}
+        chat_id = parametros.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+
+        if metodo == "getMe":
+            resultado = BOT_USER
+        elif metodo in ("sendMessage", "sendDocument"):
+            resultado = self._mensaje(chat_id, parametros)
+        elif metodo == "editMessageText":
+            resultado = self._mensaje(chat_id, parametros, parametros.get("message_id"))
+        elif metodo == "getUpdates":
+            resultado = []
+        elif metodo == "getFile":
+            file_id = parametros["file_id"]
+            resultado = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.ficheros[file_id]),
+                "file_path": file_id,
+            }
+        else:
+            resultado = True
+
+        return 200, json.dumps({"ok": True, "result": resultado}).encode("utf-8")
+
+
+class GeneradorUpdates:
+    """Construye objetos ``Update`` reales a partir de pasos de un guion."""
+
+    def __init__(self, bot, telegram_fake, primer_update_id=1):
+        self.bot = bot
+        self.telegram_fake = telegram_fake
+        self._update_ids = itertools.count(primer_update_id)
+        self._ids_callback = itertools.count(1)
+
+    @staticmethod
+    def _usuario(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Usuario{user_id}"}
+
+    @staticmethod
+    def _chat(user_id):
+        return {"id": user_id, "type": "private"}
+
+    def texto(self, user_id, texto):
+        mensaje = {
+            "message_id": self.telegram_fake.siguiente_message_id(user_id),
+            "date": int(time.time()),
+            "chat": self._chat(user_id),
+            "from": self._usuario(user_id),
+            "text": texto,
+        }
+        if texto.startswith("/"):
+            comando = texto.split()[0]
+            mensaje["entities"] = [{"type": "bot_command", "offset": 0, "length": len(comando)}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": mensaje}, self.bot)
+
+    def documento(self, user_id, nombre, contenido, mime_type="text/csv"):
+        """Mensaje con un documento; ``contenido`` (bytes) se sirve en la descarga."""
+        file_id = f"doc{len(self.telegram_fake.ficheros) + 1}"
+        self.telegram_fake.ficheros[file_id] = contenido
+        mensaje = {
+            "message_id": self.telegram_fake.siguiente_message_id(user_id),
+            "date": int(time.time()),
+            "chat": self._chat(user_id),
+            "from": self._usuario(user_id),
+            "document": {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_name": nombre,
+                "mime_type": mime_type,
+                "file_size": len(contenido),
+            },
+        }
+        return Update.de_json({"update_id": next(self._update_ids), "message": mensaje}, self.bot)
+
+    def callback(self, user_id, data):
+        message_id = self.telegram_fake.ultimo_mensaje.get(user_id, 1)
+        return Update.de_json(
+            {
+                "update_id": next(self._update_ids),
+                "callback_query": {
+                    "id": str(next(self._ids_callback)),
+                    "from": self._usuario(user_id),
+                    "chat_instance": str(user_id),
+                    "data": data,
+                    "message": {
+                        "message_id": message_id,
+                        "date": int(time.time()),
+                        "chat": self._chat(user_id),
+                        "from": BOT_USER,
+                        "text": "📲 Menú principal",
+                    },
+                },
+            },
+            self.bot,
+        )
+
+    def paso(self, user_id, paso):
+        """``paso`` es ``("cb", data)`` o ``("txt", texto)``."""
+        tipo, valor = paso
+        if tipo == "cb":
+            return self.callback(user_id, valor)
+        return self.texto(user_id, valor)
@@ -0,0 +1,144 @@
+"""Prueba de carga sintética del bot.
+
+Simula varios usuarios concurrentes que recorren los guiones de
+``benchmark.flujos_bot`` llamando a ``application.process_update`` con
+updates reales, contra el Bot falso y el backend de Sheets en memoria.
+Para cada nivel de concurrencia informa del throughput y de la latencia
+p50/p95/p99 por ruta.
+
+Uso:
+    python loadtest.py [--usuarios 1,2,4,8] [--duracion 10]
+                       [--latencia-sheets-ms 80] [--latencia-telegram-ms 40]
+                       [--pausa-ms 0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+
+import benchmark
+
+# Peso relativo de cada flujo en la mezcla de tráfico.
+MEZCLA_FLUJOS = {
+    "añadir gasto": 5,
+    "lista compra": 3,
+    "resumen": 2,
+    "trabajo": 2,
+}
+
+
+async def usuario_virtual(entorno, user_id, flujos, fin, pausa_s, latencias, rnd):
+    main = entorno["main"]
+    app = entorno["app"]
+    generador = entorno["generador"]
+    nombres = list(MEZCLA_FLUJOS)
+    pesos = [MEZCLA_FLUJOS[n] for n in nombres]
+
+    while time.perf_counter() < fin:
+        pasos = flujos[rnd.choices(nombres, pesos)[0]]
+        for paso in pasos:
+            update = generador.paso(user_id, paso)
+            ruta = main.ruta_update(update)
+            t0 = time.perf_counter()
+            await app.process_update(update)
+            latencias[ruta].append((time.perf_counter() - t0) * 1000)
+            if pausa_s:
+                await asyncio.sleep(pausa_s)
+            if time.perf_counter() >= fin:
+                return
+
+
+async def nivel_carga(entorno, usuarios, duracion_s, pausa_s):
+    main = entorno["main"]
+    flujos = benchmark.flujos_bot()
+    latencias = defaultdict(list)
+    user_ids = sorted(main.AUTHORIZED_USERS)[:usuarios]
+    errores_antes = len(entorno["errores"])
+    sheets_antes = entorno["sesion"].total_llamadas
+
+    inicio = time.perf_counter()
+    fin = inicio + duracion_s
+    await asyncio.gather(*(
+        usuario_virtual(entorno, uid, flujos, fin, pausa_s, latencias, random.Random(uid))
+        for uid in user_ids
+    ))
+    transcurrido = time.perf_counter() - inicio
+
+    return {
+        "usuarios": len(user_ids),
+        "segundos": transcurrido,
+        "latencias": latencias,
+        "updates": sum(len(v) for v in latencias.values()),
+        "errores": len(entorno["errores"]) - errores_antes,
+        "sheets": entorno["sesion"].total_llamadas - sheets_antes,
+    }
+
+
+def imprimir_nivel(resultado):
+    p = benchmark.percentil
+    todas = [x for v in resultado["latencias"].values() for x in v]
+    throughput = resultado["updates"] / resultado["segundos"]
+
+    print(
+        f"\n=== {resultado['usuarios']} usuarios | {resultado['updates']} updates en "
+        f"{resultado['segundos']:.1f}s | {throughput:.1f} updates/s | "
+        f"Sheets: {resultado['sheets']} llamadas | errores: {resultado['errores']} ==="
+    )
+    cabecera = f"{'Ruta':42} | {'n':5} | {'p50 ms':8} | {'p95 ms':8} | {'p99 ms':8} | {'max ms':8}"
+    print(cabecera)
+    print("-" * len(cabecera))
+    filas = sorted(resultado["latencias"].items(), key=lambda kv: -p(kv[1], 95))
+    for ruta, valores in filas + [("TOTAL", todas)]:
+        print(
+            f"{ruta[:42]:42} | {len(valores):5} | {p(valores, 50):8.1f} | "
+            f"{p(valores, 95):8.1f} | {p(valores, 99):8.1f} | {max(valores, default=0):8.1f}"
+        )
+
+
+async def prueba_carga(niveles, duracion_s, pausa_s, **opciones):
+    # Un usuario autorizado por cada usuario virtual del nivel más alto.
+    os.environ["AUTHORIZED_USERS"] = ",".join(str(2000 + i) for i in range(max(niveles)))
+    os.environ.setdefault("ADMIN_ID", "2000")
+
+    entorno = await benchmark.preparar_bot(**opciones)
+    entorno["main"].ensure_google_sheets_ready()
+
+    for usuarios in niveles:
+        imprimir_nivel(await nivel_carga(entorno, usuarios, duracion_s, pausa_s))
+
+    await entorno["app"].shutdown()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", default="1,2,4,8",
+                        help="niveles de concurrencia separados por coma")
+    parser.add_argument("--duracion", type=float, default=10, help="segundos por nivel")
+    parser.add_argument("--pausa-ms", type=float, default=0, help="pausa entre toques de un usuario")
+    parser.add_argument("--latencia-sheets-ms", type=float, default=80)
+    parser.add_argument("--latencia-telegram-ms", type=float, default=40)
+    parser.add_argument("--tasa-error-cuota", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    nivel_log = logging.INFO if args.verbose else logging.ERROR
+    logging.basicConfig(level=nivel_log)
+    logging.getLogger().setLevel(nivel_log)
+
+    niveles = [int(n) for n in args.usuarios.split(",") if n.strip()]
+    asyncio.run(prueba_carga(
+        niveles,
+        args.duracion,
+        args.pausa_ms / 1000,
+        latencia_sheets_ms=args.latencia_sheets_ms,
+        latencia_telegram_ms=args.latencia_telegram_ms,
+        tasa_error_cuota=args.tasa_error_cuota,
+    ))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,29 +1,88 @@
 import os
+import pickle
+import time
+
+# Referencia para STARTUP_PROFILE, tomada antes de importar las librerías pesadas.
+_ARRANQUE_T0 = time.perf_counter()
+
 import json
 import logging
-import time
 import re
+import shlex
+import sqlite3
+import threading
 import unicodedata
+import uuid
 import asyncio
+import bisect
+import contextlib
+import codecs
+import contextvars
+import csv
+import functools
+import hashlib
+import io
+import itertools
+from collections import Counter, defaultdict, deque
 from difflib import SequenceMatcher
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
 )
-from datetime import datetime, timedelta
-from google.oauth2.service_account import Credentials
-import gspread
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, unquote
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: solo acelera el parseo de columnas grandes.
+    np = None
+
+_IMPORTS_LISTOS = time.perf_counter()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 PROCESS_STARTED_AT = time.time()
 
+
+def env_bool(nombre):
+    """True si la variable de entorno ``nombre`` vale 1, true o yes."""
+    return os.environ.get(nombre, "").strip().lower() in {"1", "true", "yes"}
+
+# =========================
+# PERFIL DE ARRANQUE
+# =========================
+
+STARTUP_PROFILE = env_bool("STARTUP_PROFILE")
+_fases_arranque = [("imports", _IMPORTS_LISTOS)]
+
+
+def marcar_fase_arranque(nombre):
+    if STARTUP_PROFILE:
+        _fases_arranque.append((nombre, time.perf_counter()))
+
+
+def informe_arranque(titulo):
+    if not STARTUP_PROFILE:
+        return
+
+    lineas = []
+    anterior = _ARRANQUE_T0
+    for nombre, instante in _fases_arranque:
+        lineas.append(
+            f"  {nombre:28} +{(instante - anterior) * 1000:8.1f} ms | "
+            f"acumulado {(instante - _ARRANQUE_T0) * 1000:8.1f} ms"
+        )
+        anterior = instante
+    logger.info("Perfil de arranque (%s):\n%s", titulo, "\n".join(lineas))
+
 TRABAJO_SPREADSHEETS = {
     "Claudia": "RegistreApostes2026_SeñoraLapa",
     "Ramon": "RegistreApostes2026_SeñorLapa",
@@ -95,6 +154,11 @@ WEBHOOK_BASE_URL = os.environ.get(
     "WEBHOOK_BASE_URL",
     "https://gestion-dinero-bot.onrender.com"
 ).rstrip("/")
+# Directorio de las copias locales (caché anual, espejo de REGISTRO).
+LOCAL_CACHE_DIR = os.environ.get(
+    "LOCAL_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
 
 # =========================
 # USUARIOS AUTORIZADOS
@@ -105,6 +169,244 @@ AUTHORIZED_USERS = parse_authorized_users(get_required_env("AUTHORIZED_USERS"))
 
 ADMIN_ID = int(get_required_env("ADMIN_ID"))
 
+# =========================
+# TRAZADO SHEETS
+# =========================
+
+# Llamadas a Sheets permitidas por update antes de avisar con la traza completa.
+SHEETS_CALL_BUDGET = int(os.environ.get("SHEETS_CALL_BUDGET", 8))
+
+_traza_update = contextvars.ContextVar("traza_update", default=None)
+
+# Contadores en proceso para /stats: no cuestan llamadas a la API.
+_metricas_sheets = {
+    "llamadas": 0,
+    "errores": 0,
+    "recientes": deque(maxlen=5000),
+}
+_latencias_ruta = defaultdict(lambda: deque(maxlen=500))
+_metricas_cache = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+
+def _describir_llamada_sheets(method, endpoint, params, json_body):
+    path = urlsplit(endpoint).path
+    params = params or {}
+    json_body = json_body or {}
+
+    if "/drive/" in path:
+        return "drive.files", params.get("q", "")
+
+    if "/values/" in path:
+        rango_raw = path.split("/values/", 1)[1]
+        for accion in (":append", ":clear"):
+            if rango_raw.endswith(accion):
+                return f"values.{accion[1:]}", unquote(rango_raw[:-len(accion)])
+        operacion = "values.get" if method.lower() == "get" else "values.update"
+        return operacion, unquote(rango_raw)
+
+    if "/values:" in path:
+        accion = path.rsplit("/values:", 1)[1]
+        rangos = params.get("ranges") or json_body.get("ranges")
+        if rangos is None:
+            rangos = [d.get("range", "") for d in json_body.get("data", [])]
+        if isinstance(rangos, str):
+            rangos = [rangos]
+        return f"values.{accion}", ",".join(rangos)
+
+    if path.endswith(":batchUpdate"):
+        tipos = [next(iter(r), "") for r in json_body.get("requests", [])]
+        return "batchUpdate", ",".join(tipos)
+
+    return "metadata", ""
+
+
+def registrar_llamada_sheets(operacion, rango, bytes_enviados, bytes_recibidos, duracion_ms, error=None):
+    traza = _traza_update.get()
+    llamada = {
+        "operacion": operacion,
+        "rango": rango,
+        "bytes_enviados": bytes_enviados,
+        "bytes_recibidos": bytes_recibidos,
+        "ms": duracion_ms,
+        "error": error,
+    }
+
+    if traza is not None:
+        traza["llamadas"].append(llamada)
+
+    _metricas_sheets["llamadas"] += 1
+    if error:
+        _metricas_sheets["errores"] += 1
+    _metricas_sheets["recientes"].append((time.monotonic(), bool(error)))
+
+    logger.debug(
+        "Sheets %s | update_id=%s | ruta=%s | rango=%s | out=%dB | in=%dB | ms=%.1f | error=%s",
+        operacion,
+        traza["update_id"] if traza else None,
+        traza["ruta"] if traza else None,
+        rango,
+        bytes_enviados,
+        bytes_recibidos,
+        duracion_ms,
+        error,
+    )
+
+
+def _bytes_peticion(data, json_body):
+    if data is not None:
+        return len(data)
+    if json_body is not None:
+        return len(json.dumps(json_body))
+    return 0
+
+
+def instrumentar_http_client(http_client):
+    """Envuelve el HTTPClient de gspread para anotar cada petición en la traza del update en curso."""
+    request_original = http_client.request
+
+    @functools.wraps(request_original)
+    def request(method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        operacion, rango = _describir_llamada_sheets(method, endpoint, params, json)
+        bytes_enviados = _bytes_peticion(data, json)
+
+        inicio = time.perf_counter()
+        response = None
+        error = None
+        try:
+            response = request_original(
+                method,
+                endpoint,
+                params=params,
+                data=data,
+                json=json,
+                files=files,
+                headers=headers,
+            )
+            return response
+        except Exception as e:
+            # gspread.exceptions.APIError lleva la respuesta HTTP y el código.
+            response = getattr(e, "response", None)
+            codigo = getattr(e, "code", None)
+            error = f"HTTP {codigo}" if codigo else type(e).__name__
+            raise
+        finally:
+            registrar_llamada_sheets(
+                operacion,
+                rango,
+                bytes_enviados,
+                len(response.content) if response is not None else 0,
+                (time.perf_counter() - inicio) * 1000,
+                error,
+            )
+
+    http_client.request = request
+    return http_client
+
+def ruta_update(update):
+    if update.callback_query is not None:
+        return (update.callback_query.data or "").split("|", 1)[0] or "callback"
+
+    if update.message is not None and update.message.text:
+        texto = update.message.text
+        if texto.startswith("/"):
+            return texto.split()[0].split("@")[0]
+
+        estado = user_states.get(update.effective_user.id, {}) if update.effective_user else {}
+        for clave, valor in estado.items():
+            if "esperando_" in clave and valor is True:
+                return f"texto:{clave}"
+        return "texto"
+
+    return "otro"
+
+
+def cerrar_traza(traza):
+    llamadas = traza["llamadas"]
+    total_ms = (time.perf_counter() - traza["inicio"]) * 1000
+    _latencias_ruta[traza["ruta"]].append(total_ms)
+
+    if len(llamadas) > SHEETS_CALL_BUDGET:
+        detalle = "\n".join(
+            f"  {i}. {c['operacion']} {c['rango']} | out={c['bytes_enviados']}B "
+            f"in={c['bytes_recibidos']}B | {c['ms']:.1f}ms"
+            + (f" | {c['error']}" if c["error"] else "")
+            for i, c in enumerate(llamadas, start=1)
+        )
+        logger.warning(
+            "Presupuesto Sheets superado | update_id=%s | ruta=%s | llamadas=%d/%d | ms=%.1f\n%s",
+            traza["update_id"],
+            traza["ruta"],
+            len(llamadas),
+            SHEETS_CALL_BUDGET,
+            total_ms,
+            detalle,
+        )
+    elif llamadas:
+        logger.info(
+            "Update atendido | update_id=%s | ruta=%s | llamadas_sheets=%d | sheets_ms=%.1f | ms=%.1f",
+            traza["update_id"],
+            traza["ruta"],
+            len(llamadas),
+            sum(c["ms"] for c in llamadas),
+            total_ms,
+        )
+
+
+def trazar_update(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        traza = {
+            "update_id": update.update_id,
+            "ruta": ruta_update(update),
+            "llamadas": [],
+            "inicio": time.perf_counter(),
+        }
+        token = _traza_update.set(traza)
+        if update.effective_message is not None:
+            registrar_posicion_chat(update.effective_chat.id, update.effective_message.message_id)
+        try:
+            return await handler(update, context)
+        finally:
+            _traza_update.reset(token)
+            cerrar_traza(traza)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def medir_sheets():
+    """Aísla las llamadas a Sheets de un bloque para medir su payload y su latencia.
+
+    Las llamadas se siguen sumando a la traza del update en curso al salir.
+    """
+    exterior = _traza_update.get()
+    medicion = {
+        "update_id": exterior["update_id"] if exterior else None,
+        "ruta": exterior["ruta"] if exterior else None,
+        "llamadas": [],
+        "inicio": time.perf_counter(),
+    }
+    token = _traza_update.set(medicion)
+    try:
+        yield medicion
+    finally:
+        _traza_update.reset(token)
+        medicion["ms"] = (time.perf_counter() - medicion["inicio"]) * 1000
+        medicion["bytes_recibidos"] = sum(c["bytes_recibidos"] for c in medicion["llamadas"])
+        if exterior is not None:
+            exterior["llamadas"].extend(medicion["llamadas"])
+
+
+async def en_hilo(funcion, *args):
+    """Ejecuta ``funcion`` en el pool de hilos sin bloquear a los demás usuarios.
+
+    Copia el contexto para que sus llamadas a Sheets sigan en la traza del update.
+    """
+    contexto = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        get_executor_sheets(), contexto.run, funcion, *args
+    )
+
 # =========================
 # GOOGLE SHEETS
 # =========================
@@ -114,18 +416,202 @@ scope = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+# Solo se valida el JSON al arrancar; las credenciales y el cliente (y las
+# librerías de Google) se cargan en el primer uso para no retrasar el puerto.
 creds_json = get_required_env("GOOGLE_CREDENTIALS")
 try:
     creds_dict = json.loads(creds_json)
 except json.JSONDecodeError as e:
     raise RuntimeError("GOOGLE_CREDENTIALS is not valid JSON") from e
 
-credentials = Credentials.from_service_account_info(
-    creds_dict,
-    scopes=scope,
-)
+marcar_fase_arranque("configuración")
+
+# Transporte HTTP de Sheets: una sola sesión para todos los hilos, con tantas
+# conexiones keep-alive como hilos pueden llamar a la vez (las que sobran del
+# pool se cierran y la siguiente llamada paga otro handshake TLS), respuestas
+# comprimidas y timeouts por llamada (conexión, lectura).
+SHEETS_HILOS = int(os.environ.get("SHEETS_HILOS", min(32, (os.cpu_count() or 1) + 4)))
+SHEETS_POOL_CONEXIONES = int(os.environ.get("SHEETS_POOL_CONEXIONES", SHEETS_HILOS))
+SHEETS_TIMEOUT_CONEXION = float(os.environ.get("SHEETS_TIMEOUT_CONEXION", 5))
+SHEETS_TIMEOUT_LECTURA = float(os.environ.get("SHEETS_TIMEOUT_LECTURA", 30))
+# Las APIs de Google solo comprimen si el User-Agent incluye "gzip".
+SHEETS_USER_AGENT = "gestion-dinero-bot (gzip)"
+
+# El token OAuth de la cuenta de servicio dura una hora. Se refresca en
+# segundo plano TOKEN_MARGEN_SECONDS antes de caducar (google-auth lo da por
+# caducado 3m45s antes), así ningún handler paga la ida y vuelta a Google.
+TOKEN_MARGEN_SECONDS = int(os.environ.get("TOKEN_MARGEN_SECONDS", 600))
+TOKEN_REINTENTO_SECONDS = 30
+
+_credentials = None
+_client = None
+_executor_sheets = None
+_peticion_token = None
+_tarea_token = None
+
+# Los hilos del pool comparten credenciales: un solo refresco a la vez.
+_token_lock = threading.Lock()
+_origen_refresco = contextvars.ContextVar("origen_refresco", default="handler")
+_metricas_token = {
+    "refrescos": 0,
+    "en_handler": 0,
+    "errores": 0,
+    "ms": deque(maxlen=100),
+}
+
+
+def get_executor_sheets():
+    global _executor_sheets
+
+    if _executor_sheets is None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        _executor_sheets = ThreadPoolExecutor(max_workers=SHEETS_HILOS, thread_name_prefix="sheets")
+    return _executor_sheets
+
+
+def configurar_sesion_http(session, conexiones=None):
+    """Monta en ``session`` un pool del tamaño del pool de hilos, con gzip y keep-alive."""
+    from requests.adapters import HTTPAdapter
+
+    # pool_connections es el número de hosts con pool propio (Sheets, Drive, OAuth);
+    # pool_maxsize, las conexiones que se conservan abiertas por host.
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=conexiones or SHEETS_POOL_CONEXIONES)
+    session.mount("https://", adaptador)
+    session.mount("http://", adaptador)
+    session.headers.update({
+        "Accept-Encoding": "gzip",
+        "Connection": "keep-alive",
+        "User-Agent": SHEETS_USER_AGENT,
+    })
+    return session
+
+
+def get_credentials():
+    global _credentials
+
+    if _credentials is None:
+        from google.oauth2.service_account import Credentials
+
+        _credentials = instrumentar_credenciales(Credentials.from_service_account_info(
+            creds_dict,
+            scopes=scope,
+        ))
+        marcar_fase_arranque("credenciales")
+    return _credentials
+
+
+def get_peticion_token():
+    """Transporte (con su propio pool keep-alive) para pedir tokens a Google."""
+    global _peticion_token
+
+    if _peticion_token is None:
+        import requests
+        from google.auth.transport.requests import Request
+
+        _peticion_token = Request(configurar_sesion_http(requests.Session(), 2))
+    return _peticion_token
+
+
+def segundos_para_caducar(credenciales):
+    if credenciales.token is None or credenciales.expiry is None:
+        return 0.0
+    ahora = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (credenciales.expiry - ahora).total_seconds()
+
+
+def instrumentar_credenciales(credenciales):
+    """Serializa los refrescos del token entre hilos y anota su latencia y sus fallos."""
+    refresh_original = credenciales.refresh
+
+    @functools.wraps(refresh_original)
+    def refresh(request):
+        # Solo se salta si otro hilo (o el refresco en segundo plano) lo renovó
+        # mientras se esperaba: un token que parece válido pero Google ha
+        # rechazado (revocado, reloj desfasado) tiene que renovarse igualmente.
+        token_previo = credenciales.token
+        with _token_lock:
+            if credenciales.token != token_previo and credenciales.valid:
+                return
+
+            origen = _origen_refresco.get()
+            inicio = time.perf_counter()
+            try:
+                refresh_original(request)
+            except Exception:
+                _metricas_token["errores"] += 1
+                raise
+            finally:
+                duracion_ms = (time.perf_counter() - inicio) * 1000
+                _metricas_token["ms"].append(duracion_ms)
+
+            _metricas_token["refrescos"] += 1
+            if origen == "handler":
+                _metricas_token["en_handler"] += 1
+            logger.info(
+                "Token OAuth refrescado | %s | %.0f ms | caduca en %.0f s",
+                origen, duracion_ms, segundos_para_caducar(credenciales),
+            )
+
+    credenciales.refresh = refresh
+    return credenciales
+
+
+def refrescar_token():
+    """Renueva el token si le queda menos de TOKEN_MARGEN_SECONDS. Devuelve True si lo ha hecho."""
+    credenciales = get_credentials()
+    if segundos_para_caducar(credenciales) > TOKEN_MARGEN_SECONDS:
+        return False
+
+    token = _origen_refresco.set("segundo plano")
+    try:
+        credenciales.refresh(get_peticion_token())
+    finally:
+        _origen_refresco.reset(token)
+    return True
+
+
+async def mantener_token_fresco():
+    while True:
+        try:
+            await en_hilo(refrescar_token)
+            espera = max(
+                segundos_para_caducar(get_credentials()) - TOKEN_MARGEN_SECONDS,
+                TOKEN_REINTENTO_SECONDS,
+            )
+        except Exception as e:
+            logger.warning("No se pudo refrescar el token OAuth: %s", e)
+            espera = TOKEN_REINTENTO_SECONDS
+        await asyncio.sleep(espera)
+
+
+def get_client():
+    global _client
+
+    if _client is None:
+        import gspread
+        from google.auth.transport.requests import AuthorizedSession
+
+        session = configurar_sesion_http(
+            AuthorizedSession(get_credentials(), auth_request=get_peticion_token())
+        )
+        client = gspread.authorize(None, session=session)
+        client.http_client.timeout = (SHEETS_TIMEOUT_CONEXION, SHEETS_TIMEOUT_LECTURA)
+        instrumentar_http_client(client.http_client)
+        _client = client
+        marcar_fase_arranque("cliente gspread")
+    return _client
+
+
+def configurar_cliente_sheets(client):
+    """Sustituye el cliente gspread (p. ej. por el backend en memoria) y fuerza reabrir los libros."""
+    global _client, spreadsheet
+
+    instrumentar_http_client(client.http_client)
+    _client = client
+    spreadsheet = None
+
 
-client = gspread.authorize(credentials)
 spreadsheet = None
 sheet = None
 listas_sheet = None
@@ -158,6 +644,7 @@ def ensure_google_sheets_ready():
     if spreadsheet is not None:
         return
 
+    client = get_client()
     spreadsheet = client.open(SHEET_NAME)
     sheet = spreadsheet.worksheet("REGISTRO")
     listas_sheet = spreadsheet.worksheet("LISTAS")
@@ -180,27 +667,891 @@ def ensure_google_sheets_ready():
         persona: book.worksheet("ControlDeCases")
         for persona, book in trabajo_spreadsheets.items()
     }
-    
+    marcar_fase_arranque("apertura libros")
+
+# =========================
+# ALMACÉN COMPARTIDO
+# =========================
+
+# Dónde viven las cachés de Sheets y las sesiones de usuario:
+#   memoria  cada proceso las suyas (un solo worker);
+#   sqlite   un fichero compartido por todos los workers de la máquina, que
+#            comparten así la caché caliente y las sesiones.
+# Cada proceso guarda además una copia en memoria de cada caché. Con
+# ALMACEN_INVALIDACION=1 esa copia se descarta en cuanto otro worker recarga
+# la entrada compartida (cuesta una consulta por acceso); si no, vive su TTL.
+ALMACEN_BACKEND = os.environ.get("ALMACEN_BACKEND", "memoria").strip().lower()
+ALMACEN_PATH = os.environ.get("ALMACEN_PATH", os.path.join(LOCAL_CACHE_DIR, "almacen.db"))
+ALMACEN_INVALIDACION = env_bool("ALMACEN_INVALIDACION")
+# Un worker caído no bloquea la sesión de un usuario más de esto.
+SESION_CERROJO_SECONDS = 30
+# Cada cuántas escrituras se borran las entradas caducadas.
+ALMACEN_PURGA_CADA = 500
+
+_almacen = None
+_sesiones_guardadas = {}
+# Sesiones que no se pudieron guardar: su copia local es más nueva que la del almacén.
+_sesiones_sin_guardar = set()
+
+
+class AlmacenMemoria:
+    """Cachés y sesiones en el propio proceso."""
+
+    compartido = False
+
+    def __init__(self):
+        self._datos = {}
+        self._escrituras = 0
+
+    def leer(self, espacio, clave):
+        """Devuelve ``(valor, version, expira)`` o None si no está o ha caducado."""
+        entrada = self._datos.get((espacio, clave))
+        if entrada is None or (entrada[2] is not None and entrada[2] <= time.time()):
+            return None
+        return entrada
+
+    def version(self, espacio, clave):
+        entrada = self.leer(espacio, clave)
+        return entrada[1] if entrada else None
+
+    def escribir(self, espacio, clave, valor, segundos=None):
+        version = time.time_ns()
+        self._datos[(espacio, clave)] = (valor, version, time.time() + segundos if segundos else None)
+        self._escrituras += 1
+        if self._escrituras % ALMACEN_PURGA_CADA == 0:
+            ahora = time.time()
+            for k in [k for k, e in self._datos.items() if e[2] is not None and e[2] <= ahora]:
+                del self._datos[k]
+        return version
+
+    def reservar(self, espacio, clave, segundos):
+        """Crea la entrada solo si no existe. Devuelve False si ya estaba."""
+        if self.leer(espacio, clave) is not None:
+            return False
+        self.escribir(espacio, clave, True, segundos)
+        return True
+
+    def borrar(self, espacio, clave):
+        self._datos.pop((espacio, clave), None)
+
+    def adquirir(self, clave, dueño, segundos):
+        return True
+
+    def liberar(self, clave, dueño):
+        pass
+
+    def contar(self, espacio):
+        return sum(1 for e, _ in self._datos if e == espacio)
+
+
+class AlmacenSQLite:
+    """Cachés y sesiones en un fichero SQLite compartido entre procesos.
+
+    WAL para que las lecturas no esperen a las escrituras y ``busy_timeout``
+    para las escrituras simultáneas de varios workers; dentro del proceso, un
+    RLock serializa el uso de la conexión entre hilos. Los valores van en
+    pickle (el fichero es local y solo lo escribe el bot).
+    """
+
+    compartido = True
+
+    def __init__(self, ruta):
+        os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+        self.ruta = ruta
+        self._lock = threading.RLock()
+        self._escrituras = 0
+        self._conexion = sqlite3.connect(ruta, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.executescript("""
+            CREATE TABLE IF NOT EXISTS almacen (
+                espacio TEXT,
+                clave TEXT,
+                valor BLOB,
+                version INTEGER,
+                expira REAL,
+                PRIMARY KEY (espacio, clave)
+            );
+            CREATE TABLE IF NOT EXISTS cerrojos (
+                clave TEXT PRIMARY KEY,
+                dueño TEXT,
+                expira REAL
+            );
+        """)
+
+    def leer(self, espacio, clave):
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT valor, version, expira FROM almacen WHERE espacio = ? AND clave = ? "
+                "AND (expira IS NULL OR expira > ?)",
+                (espacio, str(clave), time.time()),
+            ).fetchone()
+        if fila is None:
+            return None
+        return pickle.loads(fila[0]), fila[1], fila[2]
+
+    def version(self, espacio, clave):
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT version FROM almacen WHERE espacio = ? AND clave = ? AND (expira IS NULL OR expira > ?)",
+                (espacio, str(clave), time.time()),
+            ).fetchone()
+        return fila[0] if fila else None
+
+    def escribir(self, espacio, clave, valor, segundos=None):
+        version = time.time_ns()
+        with self._lock:
+            self._conexion.execute(
+                "INSERT OR REPLACE INTO almacen VALUES (?, ?, ?, ?, ?)",
+                (
+                    espacio,
+                    str(clave),
+                    pickle.dumps(valor, protocol=pickle.HIGHEST_PROTOCOL),
+                    version,
+                    time.time() + segundos if segundos else None,
+                ),
+            )
+            self._contar_escritura()
+        return version
+
+    def reservar(self, espacio, clave, segundos):
+        """Crea la entrada solo si no existe (o ha caducado), de forma atómica entre procesos."""
+        ahora = time.time()
+        with self._lock:
+            cursor = self._conexion.execute(
+                "INSERT INTO almacen VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (espacio, clave) DO UPDATE SET valor = excluded.valor, "
+                "version = excluded.version, expira = excluded.expira "
+                "WHERE almacen.expira IS NOT NULL AND almacen.expira <= ?",
+                (espacio, str(clave), pickle.dumps(True), time.time_ns(), ahora + segundos, ahora),
+            )
+            self._contar_escritura()
+            return cursor.rowcount == 1
+
+    def _contar_escritura(self):
+        self._escrituras += 1
+        if self._escrituras % ALMACEN_PURGA_CADA == 0:
+            self._conexion.execute("DELETE FROM almacen WHERE expira IS NOT NULL AND expira <= ?", (time.time(),))
+
+    def borrar(self, espacio, clave):
+        with self._lock:
+            self._conexion.execute("DELETE FROM almacen WHERE espacio = ? AND clave = ?", (espacio, str(clave)))
+
+    def adquirir(self, clave, dueño, segundos):
+        """Toma el cerrojo ``clave`` si está libre, caducado o ya es de ``dueño``."""
+        ahora = time.time()
+        with self._lock:
+            cursor = self._conexion.execute(
+                "INSERT INTO cerrojos VALUES (?, ?, ?) "
+                "ON CONFLICT (clave) DO UPDATE SET dueño = excluded.dueño, expira = excluded.expira "
+                "WHERE cerrojos.expira <= ? OR cerrojos.dueño = excluded.dueño",
+                (str(clave), dueño, ahora + segundos, ahora),
+            )
+            return cursor.rowcount == 1
+
+    def liberar(self, clave, dueño):
+        with self._lock:
+            self._conexion.execute("DELETE FROM cerrojos WHERE clave = ? AND dueño = ?", (str(clave), dueño))
+
+    def contar(self, espacio):
+        with self._lock:
+            return self._conexion.execute(
+                "SELECT COUNT(*) FROM almacen WHERE espacio = ? AND (expira IS NULL OR expira > ?)",
+                (espacio, time.time()),
+            ).fetchone()[0]
+
+
+def get_almacen():
+    global _almacen
+
+    if _almacen is None:
+        if ALMACEN_BACKEND == "sqlite":
+            _almacen = AlmacenSQLite(ALMACEN_PATH)
+        elif ALMACEN_BACKEND == "memoria":
+            _almacen = AlmacenMemoria()
+        else:
+            raise RuntimeError(f"ALMACEN_BACKEND no válido: {ALMACEN_BACKEND!r} (memoria o sqlite)")
+        logger.info("Almacén de cachés y sesiones: %s", ALMACEN_BACKEND)
+    return _almacen
+
+
+async def en_almacen(funcion, *args):
+    """Llama a ``funcion`` del almacén; si es compartido, desde el pool de hilos.
+
+    Con SQLite una escritura puede esperar al bloqueo del fichero hasta su
+    ``timeout`` mientras escribe otro worker: no debe parar el bucle de eventos.
+    """
+    if get_almacen().compartido:
+        return await en_hilo(funcion, *args)
+    return funcion(*args)
+
+
+def leer_cache(nombre, cache, segundos, cargar):
+    """Caché de dos niveles: ``cache`` (dict del proceso) y el almacén compartido.
+
+    Solo si ningún worker la tiene vigente se llama a ``cargar`` (Sheets). Si
+    el almacén falla se sigue sin él: la copia del proceso o una carga nueva.
+    """
+    now = time.monotonic()
+    almacen = get_almacen()
+    if cache["data"] is not None and now < cache["expires_at"]:
+        if not ALMACEN_INVALIDACION:
+            _metricas_cache[nombre]["hits"] += 1
+            return cache["data"]
+        try:
+            vigente = almacen.version("cache", nombre) == cache.get("version")
+        except sqlite3.Error as e:
+            logger.warning("No se pudo comprobar la caché %s en el almacén; se usa la del proceso: %s", nombre, e)
+            vigente = True
+        if vigente:
+            _metricas_cache[nombre]["hits"] += 1
+            return cache["data"]
+
+    try:
+        compartida = almacen.leer("cache", nombre)
+    except sqlite3.Error as e:
+        logger.warning("No se pudo leer la caché %s del almacén: %s", nombre, e)
+        compartida = None
+    if compartida is not None:
+        _metricas_cache[nombre]["hits"] += 1
+        data, version, expira = compartida
+        restante = expira - time.time()
+    else:
+        _metricas_cache[nombre]["misses"] += 1
+        data = cargar()
+        try:
+            version = almacen.escribir("cache", nombre, data, segundos)
+        except sqlite3.Error as e:
+            logger.warning("No se pudo guardar la caché %s en el almacén: %s", nombre, e)
+            version = None
+        restante = segundos
+
+    cache.update({
+        "data": data,
+        "expires_at": now + restante,
+        "loaded_at": now,
+        "version": version,
+    })
+    return data
+
+
+async def desde_cache(cache, funcion, *args):
+    """Llama desde el bucle de eventos a ``funcion``, que lee ``cache`` con leer_cache.
+
+    Si vale la copia del proceso se atiende en el propio bucle; si hay que
+    consultar el almacén (que puede esperar a otro worker) o Sheets, en el
+    pool de hilos.
+    """
+    if (
+        cache is not None
+        and cache["data"] is not None
+        and time.monotonic() < cache["expires_at"]
+        and not (ALMACEN_INVALIDACION and get_almacen().compartido)
+    ):
+        return funcion(*args)
+    return await en_hilo(funcion, *args)
+
+
 # =========================
 # USER STATE
 # =========================
 
+# Copia de trabajo de las sesiones. Con un almacén compartido, la sesión de un
+# usuario se carga antes de atender cada update suyo y se guarda al terminar.
 user_states = {}
 
+
+def _dueño_sesiones():
+    return f"{os.getpid()}@{os.uname().nodename}"
+
+
+@contextlib.asynccontextmanager
+async def sesion_usuario(user_id):
+    """Bloquea la sesión de ``user_id`` entre workers y la sincroniza con el almacén."""
+    almacen = get_almacen()
+    if not almacen.compartido:
+        yield
+        return
+
+    # Si el almacén falla, el update se atiende con la copia local de la sesión.
+    dueño = _dueño_sesiones()
+    fin = time.monotonic() + SESION_CERROJO_SECONDS
+    while True:
+        try:
+            if await en_almacen(almacen.adquirir, user_id, dueño, SESION_CERROJO_SECONDS):
+                break
+        except sqlite3.Error as e:
+            logger.warning("No se pudo tomar la sesión de %s: %s", user_id, e)
+            break
+        if time.monotonic() >= fin:
+            logger.warning("Sesión de %s bloqueada más de %ss: se atiende igualmente", user_id, SESION_CERROJO_SECONDS)
+            break
+        await asyncio.sleep(0.02)
+
+    try:
+        if user_id not in _sesiones_sin_guardar:
+            try:
+                guardada = await en_almacen(almacen.leer, "sesion", user_id)
+            except sqlite3.Error as e:
+                logger.warning("No se pudo leer la sesión de %s; se usa la copia local: %s", user_id, e)
+            else:
+                if guardada is None:
+                    user_states.pop(user_id, None)
+                    _sesiones_guardadas.pop(user_id, None)
+                else:
+                    user_states[user_id] = guardada[0]
+                    _sesiones_guardadas[user_id] = pickle.dumps(guardada[0], protocol=pickle.HIGHEST_PROTOCOL)
+
+        yield
+    finally:
+        try:
+            estado = user_states.get(user_id)
+            if estado is None:
+                if user_id in _sesiones_guardadas:
+                    await en_almacen(almacen.borrar, "sesion", user_id)
+                    del _sesiones_guardadas[user_id]
+            else:
+                serializado = pickle.dumps(estado, protocol=pickle.HIGHEST_PROTOCOL)
+                # Solo se escribe si el update ha cambiado algo.
+                if serializado != _sesiones_guardadas.get(user_id):
+                    await en_almacen(almacen.escribir, "sesion", user_id, estado)
+                    _sesiones_guardadas[user_id] = serializado
+            _sesiones_sin_guardar.discard(user_id)
+        except sqlite3.Error as e:
+            _sesiones_sin_guardar.add(user_id)
+            logger.warning("No se pudo guardar la sesión de %s; se reintenta en su próximo update: %s", user_id, e)
+        finally:
+            try:
+                await en_almacen(almacen.liberar, user_id, dueño)
+            except sqlite3.Error as e:
+                logger.warning("No se pudo liberar la sesión de %s (caduca en %ss): %s", user_id, SESION_CERROJO_SECONDS, e)
+
+
+# =========================
+# IDEMPOTENCIA
+# =========================
+
+# Telegram reintenta la entrega de un update si el webhook tarda en responder,
+# y el usuario puede reenviar el mismo mensaje. Dos defensas:
+#   - cada update_id se atiende una sola vez dentro de la ventana;
+#   - cada flujo (un gasto, un registro de trabajo) escribe una sola vez en
+#     su hoja, con una clave de idempotencia sacada de su sesión.
+# Las dos viven en el almacén, así que valen también entre workers.
+UPDATE_DEDUPE_SECONDS = int(os.environ.get("UPDATE_DEDUPE_SECONDS", 86400))
+ESCRITURA_IDEMPOTENCIA_SECONDS = 7 * 86400
+
+_metricas_duplicados = {
+    "updates": 0,
+    "escrituras": 0,
+    "sin_comprobar": 0,
+}
+
+
+def nuevo_id_flujo():
+    return uuid.uuid4().hex
+
+
+async def update_repetido(update):
+    """Marca ``update`` como visto; True si ya se había atendido antes.
+
+    Si el almacén falla se atiende igualmente: mejor un posible duplicado (las
+    escrituras tienen su propia clave) que perder el update.
+    """
+    update_id = getattr(update, "update_id", None)
+    if update_id is None:
+        return False
+    try:
+        if await en_almacen(get_almacen().reservar, "update", update_id, UPDATE_DEDUPE_SECONDS):
+            return False
+    except sqlite3.Error as e:
+        logger.warning("No se pudo comprobar si el update %s es repetido: %s", update_id, e)
+        return False
+    _metricas_duplicados["updates"] += 1
+    logger.info("Update %s repetido: se descarta sin procesar", update_id)
+    return True
+
+
+def clave_escritura(user_id, destino):
+    estado = user_states.get(user_id, {})
+    flujo_id = estado.get("flujo_id")
+    if flujo_id is None:
+        # Sesión anterior a las claves: se deriva del propio contenido del flujo.
+        contenido = {k: v for k, v in estado.items() if k != "history" and not k.startswith("ui_")}
+        flujo_id = hashlib.sha1(repr(sorted(contenido.items(), key=str)).encode("utf-8")).hexdigest()
+    return f"{destino}:{user_id}:{flujo_id}"
+
+
+@contextlib.contextmanager
+def escritura_unica(user_id, destino):
+    """Cede True si el flujo de ``user_id`` aún no ha escrito en ``destino``.
+
+    Si la escritura falla se libera la clave para poder reintentarla. Si falla
+    el almacén se escribe sin comprobar: un posible duplicado es mejor que
+    perder lo que el usuario quería guardar. Con un almacén compartido puede
+    esperar al fichero: se llama desde el pool de hilos, nunca desde el bucle.
+    """
+    clave = clave_escritura(user_id, destino)
+    almacen = get_almacen()
+    try:
+        reservada = almacen.reservar("escritura", clave, ESCRITURA_IDEMPOTENCIA_SECONDS)
+    except sqlite3.Error as e:
+        _metricas_duplicados["sin_comprobar"] += 1
+        logger.warning("No se pudo reservar la escritura en %s; se escribe sin comprobar duplicados: %s", destino, e)
+        reservada = None
+    if reservada is None:
+        yield True
+        return
+
+    if not reservada:
+        _metricas_duplicados["escrituras"] += 1
+        logger.warning("Escritura duplicada en %s suprimida | clave=%s", destino, clave)
+        yield False
+        return
+
+    try:
+        yield True
+    except BaseException:
+        try:
+            almacen.borrar("escritura", clave)
+        except sqlite3.Error as e:
+            logger.warning("No se pudo liberar la clave de escritura %s (caduca sola): %s", clave, e)
+        raise
+
 LISTAS_CACHE_SECONDS = 60
 _listas_cache = {
     "data": None,
     "expires_at": 0.0,
+    "loaded_at": 0.0,
 }
 
 TRABAJO_CASAS_CACHE_SECONDS = 300
 _trabajo_casas_cache = {}
 
 
+# =========================
+# TELEGRAM SALIENTE
+# =========================
+
+# Último message_id visto en cada chat, entrante o enviado por el bot. En un
+# chat privado los ids son correlativos para los dos lados: un mensaje es el
+# último del chat si no se ha visto ninguno con un id mayor.
+_posiciones_chat = {}
+# Posición de cada chat antes del último mensaje registrado, para deshacerla
+# si ese mensaje era del usuario y el bot lo borra.
+_posiciones_previas = {}
+
+_metricas_telegram = {
+    "llamadas": 0,
+    "errores": 0,
+    "ms_total": 0.0,
+}
+
+
+def registrar_posicion_chat(chat_id, message_id):
+    if chat_id is None or message_id is None:
+        return
+    previa = _posiciones_chat.get(chat_id, 0)
+    if message_id > previa:
+        _posiciones_chat[chat_id] = message_id
+        _posiciones_previas[chat_id] = (message_id, previa)
+
+
+def retirar_posicion_chat(chat_id, message_id):
+    """Deshace la posición de un mensaje borrado si sigue siendo el último."""
+    ultimo, previa = _posiciones_previas.pop(chat_id, (None, 0))
+    if ultimo != message_id or _posiciones_chat.get(chat_id) != message_id:
+        return
+    if previa:
+        _posiciones_chat[chat_id] = previa
+    else:
+        del _posiciones_chat[chat_id]
+
+
+def es_ultimo_mensaje(chat_id, message_id):
+    return chat_id in _posiciones_chat and message_id >= _posiciones_chat[chat_id]
+
+
+# Cola de salida: las respuestas interactivas pasan antes que las difusiones
+# (p. ej. la lista compartida), con límite global y por chat. Los límites
+# siguen las recomendaciones de Telegram: ~30 mensajes/s en total y ~1/s
+# sostenido por chat (con ráfaga para que un usuario no note la espera).
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_DIFUSION = 1
+NOMBRES_PRIORIDAD = {PRIORIDAD_INTERACTIVA: "interactiva", PRIORIDAD_DIFUSION: "difusión"}
+
+TELEGRAM_GLOBAL_POR_SEGUNDO = float(os.environ.get("TELEGRAM_GLOBAL_POR_SEGUNDO", 30))
+TELEGRAM_CHAT_POR_SEGUNDO = float(os.environ.get("TELEGRAM_CHAT_POR_SEGUNDO", 1))
+TELEGRAM_CHAT_RAFAGA = 20
+# Parte del cupo global que las difusiones dejan libre para lo interactivo.
+TELEGRAM_RESERVA_INTERACTIVA = 5
+TELEGRAM_MAX_REINTENTOS = 3
+
+# Métodos que cuentan para el límite por chat (crean o cambian mensajes).
+_METODOS_LIMITE_CHAT = ("send", "edit", "copy", "forward")
+
+_metricas_cola_telegram = {
+    "espera_ms": defaultdict(lambda: deque(maxlen=500)),
+    "retry_after": 0,
+    "segundos_retry_after": 0.0,
+}
+
+
+class _Cubo:
+    """Token bucket: ``capacidad`` llamadas seguidas y ``ritmo`` por segundo después."""
+
+    def __init__(self, ritmo, capacidad):
+        self.ritmo = ritmo
+        self.capacidad = capacidad
+        self.tokens = float(capacidad)
+        self.actualizado = time.monotonic()
+
+    def _rellenar(self, ahora):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.ritmo)
+        self.actualizado = ahora
+
+    def espera(self, ahora, minimo=1.0):
+        """Segundos hasta tener ``minimo`` tokens (0 si ya los hay)."""
+        self._rellenar(ahora)
+        if self.tokens >= minimo:
+            return 0.0
+        return (minimo - self.tokens) / self.ritmo
+
+    def consumir(self):
+        self.tokens -= 1
+
+
+class LimitadorTelegram(BaseRateLimiter):
+    """Punto único por el que pasan todas las llamadas del bot a la Bot API.
+
+    Se engancha con ``ApplicationBuilder.rate_limiter``. Cada llamada entra en
+    una cola con prioridad (``rate_limit_args=PRIORIDAD_DIFUSION`` para las
+    difusiones) y un despachador la deja salir cuando hay cupo global y de su
+    chat. Un RetryAfter pausa toda la salida y la llamada se reintenta.
+    También mide cada llamada y apunta la posición de los mensajes enviados.
+    """
+
+    def __init__(self, global_por_segundo=None, chat_por_segundo=None):
+        self.global_por_segundo = global_por_segundo or TELEGRAM_GLOBAL_POR_SEGUNDO
+        self.chat_por_segundo = chat_por_segundo or TELEGRAM_CHAT_POR_SEGUNDO
+        self._global = _Cubo(self.global_por_segundo, self.global_por_segundo)
+        self._chats = {}
+        self._cola = []
+        self._turnos = itertools.count()
+        self._hay_cola = None
+        self._despachador = None
+        self._pausa_hasta = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._despachador is not None:
+            self._despachador.cancel()
+            self._despachador = None
+
+    @property
+    def en_cola(self):
+        return len(self._cola)
+
+    def _cubo_chat(self, chat_id):
+        cubo = self._chats.get(chat_id)
+        if cubo is None:
+            cubo = self._chats[chat_id] = _Cubo(self.chat_por_segundo, TELEGRAM_CHAT_RAFAGA)
+        return cubo
+
+    async def _despachar(self):
+        while True:
+            if not self._cola:
+                self._hay_cola.clear()
+                await self._hay_cola.wait()
+                continue
+
+            ahora = time.monotonic()
+            if ahora < self._pausa_hasta:
+                await asyncio.sleep(self._pausa_hasta - ahora)
+                continue
+
+            espera_minima = None
+            for entrada in self._cola:
+                prioridad, _, chat_id, futuro = entrada
+                if futuro.done():
+                    self._cola.remove(entrada)
+                    break
+
+                reserva = TELEGRAM_RESERVA_INTERACTIVA if prioridad > PRIORIDAD_INTERACTIVA else 0
+                espera = self._global.espera(ahora, 1 + min(reserva, self.global_por_segundo - 1))
+                if chat_id is not None:
+                    espera = max(espera, self._cubo_chat(chat_id).espera(ahora))
+
+                if espera <= 0:
+                    self._global.consumir()
+                    if chat_id is not None:
+                        self._cubo_chat(chat_id).consumir()
+                    self._cola.remove(entrada)
+                    futuro.set_result(None)
+                    break
+
+                if espera_minima is None or espera < espera_minima:
+                    espera_minima = espera
+            else:
+                # Nadie puede salir todavía: se duerme hasta el primer hueco o
+                # hasta que llegue algo nuevo a la cola.
+                self._hay_cola.clear()
+                try:
+                    await asyncio.wait_for(self._hay_cola.wait(), espera_minima)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _esperar_turno(self, prioridad, chat_id):
+        if self._despachador is None or self._despachador.done():
+            self._hay_cola = asyncio.Event()
+            self._despachador = asyncio.create_task(self._despachar())
+
+        futuro = asyncio.get_running_loop().create_future()
+        entrada = (prioridad, next(self._turnos), chat_id, futuro)
+        # La cola se mantiene ordenada por (prioridad, orden de llegada).
+        bisect.insort(self._cola, entrada, key=lambda e: e[:2])
+        self._hay_cola.set()
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            if entrada in self._cola:
+                self._cola.remove(entrada)
+            raise
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        prioridad = rate_limit_args if rate_limit_args in NOMBRES_PRIORIDAD else PRIORIDAD_INTERACTIVA
+        chat_id = data.get("chat_id") if endpoint.startswith(_METODOS_LIMITE_CHAT) else None
+
+        for intento in range(TELEGRAM_MAX_REINTENTOS + 1):
+            en_cola_desde = time.perf_counter()
+            await self._esperar_turno(prioridad, chat_id)
+            _metricas_cola_telegram["espera_ms"][prioridad].append((time.perf_counter() - en_cola_desde) * 1000)
+
+            inicio = time.perf_counter()
+            try:
+                resultado = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                segundos = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                _metricas_cola_telegram["retry_after"] += 1
+                _metricas_cola_telegram["segundos_retry_after"] += segundos
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+                logger.warning(
+                    "Telegram RetryAfter %.0fs en %s (intento %d, %s)",
+                    segundos, endpoint, intento + 1, NOMBRES_PRIORIDAD[prioridad],
+                )
+                if intento == TELEGRAM_MAX_REINTENTOS:
+                    _metricas_telegram["errores"] += 1
+                    raise
+                continue
+            except Exception:
+                _metricas_telegram["errores"] += 1
+                raise
+            finally:
+                _metricas_telegram["llamadas"] += 1
+                _metricas_telegram["ms_total"] += (time.perf_counter() - inicio) * 1000
+
+            if isinstance(resultado, dict) and "message_id" in resultado:
+                registrar_posicion_chat(resultado.get("chat", {}).get("id"), resultado["message_id"])
+            return resultado
+
+# =========================
+# CONCURRENCIA DE UPDATES
+# =========================
+
+# Updates de usuarios distintos se atienden a la vez; los de un mismo usuario,
+# de uno en uno y en orden de llegada, porque comparten su entrada de
+# ``user_states`` y el mensaje de la interfaz.
+UPDATES_CONCURRENTES = int(os.environ.get("UPDATES_CONCURRENTES", 8))
+# Updates sacados de la cola a la vez, incluidos los que esperan a su usuario.
+UPDATES_EN_VUELO = int(os.environ.get("UPDATES_EN_VUELO", 64))
+# Updates recibidos que esperan a que haya sitio en vuelo. Con la cola llena,
+# el webhook deja de responder hasta que se libera hueco y Telegram, que no
+# abre más de WEBHOOK_MAX_CONEXIONES a la vez, deja de mandar.
+COLA_UPDATES_MAX = int(os.environ.get("COLA_UPDATES_MAX", 200))
+WEBHOOK_MAX_CONEXIONES = int(os.environ.get("WEBHOOK_MAX_CONEXIONES", 40))
+
+_metricas_updates = {
+    "en_curso": 0,
+    "max_en_curso": 0,
+    "espera_usuario_ms": deque(maxlen=500),
+    "max_en_cola": 0,
+    "esperas_cola_llena": 0,
+    "espera_cola_ms": deque(maxlen=500),
+    "atendidos": 0,
+    "fallos": 0,
+}
+# Hueco en vuelo del update que se está procesando (ver ColaUpdates).
+_hueco_update = contextvars.ContextVar("hueco_update", default=None)
+
+
+class ColaUpdates(asyncio.Queue):
+    """``update_queue`` de la Application, acotada y con contrapresión.
+
+    El webhook de PTB responde a Telegram en cuanto el update entra aquí; el
+    trabajo lo hace después el pool de ProcesadorUpdates. PTB saca de la cola
+    y lanza una tarea por update sin esperar, así que ``get`` solo entrega
+    cuando hay menos de UPDATES_EN_VUELO en curso (``task_done`` libera el
+    hueco): lo que no cabe se queda en la cola, que tiene tope.
+    PTB solo llama a ``task_done`` si el procesador termina sin excepción;
+    ProcesadorUpdates nunca la deja salir.
+    Al parar, PTB deja de recibir y espera a que la cola se vacíe; los updates
+    que descarta sin sacarlos también pasan por ``task_done``. Para no liberar
+    con ellos el hueco de otro update, cada ``get`` deja su hueco en el
+    contexto, que hereda la tarea que PTB crea para procesarlo: ``task_done``
+    solo libera el hueco que encuentra en el suyo, y una sola vez.
+    """
+
+    def __init__(self, maxsize=None, en_vuelo=None):
+        super().__init__(maxsize or COLA_UPDATES_MAX)
+        self._en_vuelo = asyncio.Semaphore(en_vuelo or UPDATES_EN_VUELO)
+        self._huecos = set()
+
+    @property
+    def en_vuelo(self):
+        return len(self._huecos)
+
+    def _put(self, item):
+        self._queue.append((time.perf_counter(), item))
+        _metricas_updates["max_en_cola"] = max(_metricas_updates["max_en_cola"], len(self._queue))
+
+    def _get(self):
+        encolado, item = self._queue.popleft()
+        _metricas_updates["espera_cola_ms"].append((time.perf_counter() - encolado) * 1000)
+        return item
+
+    async def put(self, item):
+        if self.full():
+            _metricas_updates["esperas_cola_llena"] += 1
+            logger.warning("Cola de updates llena (%d): el webhook espera a que haya hueco", self.maxsize)
+        await super().put(item)
+
+    async def get(self):
+        await self._en_vuelo.acquire()
+        try:
+            item = await super().get()
+        except BaseException:
+            self._en_vuelo.release()
+            raise
+        hueco = object()
+        self._huecos.add(hueco)
+        _hueco_update.set(hueco)
+        return item
+
+    def task_done(self):
+        super().task_done()
+        hueco = _hueco_update.get()
+        if hueco in self._huecos:
+            self._huecos.remove(hueco)
+            self._en_vuelo.release()
+            _metricas_updates["atendidos"] += 1
+
+
+class ProcesadorUpdates(BaseUpdateProcessor):
+    """Procesa updates en paralelo manteniendo el orden de cada usuario.
+
+    Se engancha con ``ApplicationBuilder.concurrent_updates``. Cada update
+    espera primero al cerrojo de su usuario (``asyncio.Lock`` es FIFO) y luego
+    a un hueco entre los ``UPDATES_CONCURRENTES`` que se atienden a la vez;
+    así un usuario que encadena toques no ocupa los huecos de los demás.
+    """
+
+    def __init__(self, concurrentes=None):
+        super().__init__(UPDATES_EN_VUELO)
+        self.concurrentes = concurrentes or UPDATES_CONCURRENTES
+        self._huecos = asyncio.Semaphore(self.concurrentes)
+        self._cerrojos = {}
+        self._pendientes = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_update(self, update, coroutine):
+        # Una excepción aquí saltaría el ``task_done`` de PTB: el hueco en vuelo
+        # quedaría ocupado para siempre y ``Application.stop`` colgado en join().
+        try:
+            await super().process_update(update, coroutine)
+        except Exception:
+            _metricas_updates["fallos"] += 1
+            logger.exception("Error atendiendo el update %s fuera de los handlers", getattr(update, "update_id", None))
+        finally:
+            # Si no se llegó a esperar, se cierra para no dejarla pendiente.
+            coroutine.close()
+
+    @staticmethod
+    def _clave(update):
+        usuario = getattr(update, "effective_user", None)
+        if usuario is not None:
+            return usuario.id
+        chat = getattr(update, "effective_chat", None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        if await update_repetido(update):
+            coroutine.close()
+            return
+
+        clave = self._clave(update)
+        if clave is None:
+            async with self._huecos:
+                await coroutine
+            return
+
+        cerrojo = self._cerrojos.get(clave)
+        if cerrojo is None:
+            cerrojo = self._cerrojos[clave] = asyncio.Lock()
+        self._pendientes[clave] += 1
+
+        inicio = time.perf_counter()
+        try:
+            async with cerrojo, sesion_usuario(clave):
+                async with self._huecos:
+                    _metricas_updates["espera_usuario_ms"].append((time.perf_counter() - inicio) * 1000)
+                    _metricas_updates["en_curso"] += 1
+                    _metricas_updates["max_en_curso"] = max(
+                        _metricas_updates["max_en_curso"], _metricas_updates["en_curso"]
+                    )
+                    try:
+                        await coroutine
+                    finally:
+                        _metricas_updates["en_curso"] -= 1
+        finally:
+            self._pendientes[clave] -= 1
+            if not self._pendientes[clave]:
+                del self._pendientes[clave]
+                del self._cerrojos[clave]
+
 # =========================
 # FUNCIONES AUXILIARES
 # =========================
 
+def leer_json_local(ruta):
+    """Contenido de un JSON de LOCAL_CACHE_DIR, o None si no existe o está dañado."""
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Fichero local ilegible, se ignora (%s): %s", ruta, e)
+        return None
+
+
+def guardar_json_local(ruta, datos):
+    """Escritura atómica: nunca deja un JSON a medias si el proceso muere."""
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = ruta + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+        os.replace(temporal, ruta)
+    except OSError as e:
+        logger.warning("No se pudo guardar %s: %s", ruta, e)
+
+
 def usuario_autorizado(user_id):
     return user_id in AUTHORIZED_USERS
     
@@ -276,61 +1627,117 @@ def teclado_menu_trabajo():
     return [
         [InlineKeyboardButton("Claudia", callback_data="trabajo|Claudia")],
         [InlineKeyboardButton("Ramon", callback_data="trabajo|Ramon")],
+        [InlineKeyboardButton("📥 Importar Claudia", callback_data="trabajo_importar|Claudia"),
+         InlineKeyboardButton("📥 Importar Ramon", callback_data="trabajo_importar|Ramon")],
         [InlineKeyboardButton("⬅ Volver", callback_data="menu|volver")],
     ]
 
 
-async def desplazar_menu_al_final(context, user_id, texto_menu, keyboard):
-    estado = user_states.get(user_id, {})
-    chat_id = estado.get("ui_chat_id")
-    message_id = estado.get("ui_message_id")
+# Mensajes de interfaz: editar sale por una llamada; si el mensaje ya no es
+# el último del chat hay que reenviarlo, y el envío y el borrado van en paralelo.
+_metricas_ui = {
+    "ediciones": 0,
+    "reenvios": 0,
+    "llamadas_ahorradas": 0,
+    "esperas_ahorradas": 0,
+}
+
 
-    if chat_id and message_id:
+async def _borrar_mensaje(bot, chat_id, message_id, prioridad=PRIORIDAD_INTERACTIVA):
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id, rate_limit_args=prioridad)
+    except BadRequest:
+        pass
+
+
+async def mostrar_mensaje_ui(bot, user_id, chat_id, texto, reply_markup=None, prioridad=PRIORIDAD_INTERACTIVA):
+    """Deja ``texto`` como mensaje de interfaz del usuario, al final del chat.
+
+    Edita el mensaje anterior si sigue siendo el último; si no, envía uno
+    nuevo y borra el anterior.
+    """
+    estado = user_states.setdefault(user_id, {})
+    anterior_chat = estado.get("ui_chat_id")
+    anterior_id = estado.get("ui_message_id")
+
+    if anterior_chat == chat_id and anterior_id and es_ultimo_mensaje(chat_id, anterior_id):
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except BadRequest:
-            pass
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=anterior_id,
+                text=texto,
+                reply_markup=reply_markup,
+                rate_limit_args=prioridad,
+            )
+            _metricas_ui["ediciones"] += 1
+            _metricas_ui["llamadas_ahorradas"] += 1
+            _metricas_ui["esperas_ahorradas"] += 1
+            return
+        except BadRequest as e:
+            # Mismo texto y teclado: el mensaje ya está como debe.
+            if "not modified" in str(e).lower():
+                return
+            logger.info("No se pudo editar el mensaje de interfaz %s: %s", anterior_id, e)
+
+    envio = bot.send_message(chat_id=chat_id, text=texto, reply_markup=reply_markup, rate_limit_args=prioridad)
+    if anterior_chat and anterior_id:
+        sent_message, _ = await asyncio.gather(
+            envio,
+            _borrar_mensaje(bot, anterior_chat, anterior_id, prioridad),
+        )
+        _metricas_ui["esperas_ahorradas"] += 1
+    else:
+        sent_message = await envio
+    _metricas_ui["reenvios"] += 1
 
-    sent_message = await context.bot.send_message(
-        chat_id=user_id,
-        text=texto_menu,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-    )
     user_states.setdefault(user_id, {})["ui_chat_id"] = sent_message.chat_id
     user_states[user_id]["ui_message_id"] = sent_message.message_id
 
 
-async def desplazar_menu_principal_al_final(context, user_id):
+async def desplazar_menu_al_final(context, user_id, texto_menu, keyboard, prioridad=PRIORIDAD_INTERACTIVA):
+    await mostrar_mensaje_ui(
+        context.bot,
+        user_id,
+        user_id,
+        texto_menu,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        prioridad=prioridad,
+    )
+
+
+async def desplazar_menu_principal_al_final(context, user_id, prioridad=PRIORIDAD_INTERACTIVA):
     await desplazar_menu_al_final(
         context,
         user_id,
         "📲 Menú principal",
         teclado_menu_principal(),
+        prioridad,
     )
 
 
-def registrar_mensaje_interactivo(user_id, query):
-    user_states[user_id]["ui_chat_id"] = query.message.chat_id
-    user_states[user_id]["ui_message_id"] = query.message.message_id
+def reiniciar_estado(user_id):
+    """Vacía el estado del flujo conservando el mensaje de interfaz."""
+    estado = user_states.get(user_id, {})
+    user_states[user_id] = {
+        clave: estado[clave]
+        for clave in ("ui_chat_id", "ui_message_id")
+        if clave in estado
+    }
 
 
-async def actualizar_mensaje_flujo(update, context, user_id, texto, reply_markup=None):
-    estado = user_states.get(user_id, {})
-    chat_id = estado.get("ui_chat_id")
-    message_id = estado.get("ui_message_id")
+def registrar_mensaje_interactivo(user_id, query):
+    user_states[user_id]["ui_chat_id"] = query.message.chat_id
+    user_states[user_id]["ui_message_id"] = query.message.message_id
 
-    if chat_id and message_id:
-        try:
-            await context.bot.delete_message(
-                chat_id=chat_id,
-                message_id=message_id,
-            )
-        except BadRequest:
-            pass
 
-    sent_message = await update.message.reply_text(texto, reply_markup=reply_markup)
-    user_states.setdefault(user_id, {})["ui_chat_id"] = sent_message.chat_id
-    user_states[user_id]["ui_message_id"] = sent_message.message_id
+async def actualizar_mensaje_flujo(update, context, user_id, texto, reply_markup=None):
+    await mostrar_mensaje_ui(
+        context.bot,
+        user_id,
+        update.effective_chat.id,
+        texto,
+        reply_markup=reply_markup,
+    )
 
 
 async def verificar_autorizacion(update, context):
@@ -359,29 +1766,6 @@ async def verificar_autorizacion(update, context):
 
     return True
 
-def limpiar_importe(valor):
-    valor = str(valor).strip()
-    valor = valor.replace("€", "").replace(" ", "")
-
-    # Caso europeo típico: 1.550,00
-    if "," in valor and "." in valor:
-        valor = valor.replace(".", "")  # quitar separador miles
-        valor = valor.replace(",", ".") # decimal correcto
-
-    # Caso solo coma decimal: 150,50
-    elif "," in valor:
-        valor = valor.replace(",", ".")
-
-    # Quitar cualquier cosa rara
-    valor = "".join(c for c in valor if c.isdigit() or c == ".")
-
-    if valor == "":
-        return 0
-
-    return float(valor)
-
-
-
 def generar_barra(real, objetivo, largo=10):
 
     if objetivo <= 0:
@@ -414,72 +1798,533 @@ def _leer_productos_supermercado(hoja):
     return hoja.col_values(1)[1:]
 
 
-def obtener_lista_completa():
+def leer_lista_compra():
     ensure_google_sheets_ready()
 
-    mensaje = "🛒 LISTA ACTUAL COMPLETA\n\n"
+    return {
+        nombre: _leer_productos_supermercado(hoja)
+        for nombre, hoja in [
+            ("Carrefour", sheet_carrefour),
+            ("Mercadona", sheet_mercadona),
+            ("Sirena", sheet_sirena),
+            ("Otros", sheet_otros)
+        ]
+    }
+
 
-    for nombre, hoja in [
-        ("Carrefour", sheet_carrefour),
-        ("Mercadona", sheet_mercadona),
-        ("Sirena", sheet_sirena),
-        ("Otros", sheet_otros)
-    ]:
+def lineas_lista_compra(titulo, productos_por_super=None, cambios=""):
+    if productos_por_super is None:
+        productos_por_super = leer_lista_compra()
 
-        productos = _leer_productos_supermercado(hoja)
-        
-        mensaje += f"📍 {nombre}\n"
+    lineas = [titulo, ""]
+    if cambios:
+        lineas += [f"Último cambio: {cambios}", ""]
+
+    for nombre, productos in productos_por_super.items():
+
+        lineas.append(f"📍 {nombre}")
 
         if productos:
-            for p in productos:
-                mensaje += f"  • {p}\n"
+            lineas += [f"  • {p}" for p in productos]
         else:
-            mensaje += "  (Vacío)\n"
+            lineas.append("  (Vacío)")
 
-        mensaje += "\n"
+        lineas.append("")
+
+    return lineas
+
+
+# =========================
+# MENSAJES PAGINADOS
+# =========================
+
+TELEGRAM_MAX_CHARS = 4096
+# Margen para el pie "📄 Página i/n" y el cierre de un bloque ``` cortado.
+PAGINA_MAX_CHARS = TELEGRAM_MAX_CHARS - 64
+PAGINAS_MAX_SNAPSHOTS = 200
+
+_paginas_snapshots = {}
+_paginas_fijas = {}
+_paginas_ids = itertools.count(1)
+
+
+def paginar_lineas(lineas, limite=PAGINA_MAX_CHARS):
+    """Reparte líneas en páginas de como mucho ``limite`` caracteres sin cortar líneas.
+
+    Trabaja en tiempo lineal: cada página se une una sola vez al cerrarla. Si
+    un bloque ``` queda abierto al cortar, se cierra en esa página y se reabre
+    en la siguiente. Las líneas más largas que una página se trocean,
+    empezando por lo que quede libre de la página en curso.
+    """
+    paginas = []
+    actual = []
+    largo = 0
+    en_codigo = False
+    # Si la página tiene algo más que vallas ``` y líneas vacías.
+    contenido = False
+
+    def cerrar_pagina():
+        nonlocal actual, largo, contenido
+        if en_codigo:
+            actual.append("```")
+        paginas.append("\n".join(actual).strip("\n"))
+        actual = ["```"] if en_codigo else []
+        largo = 4 if en_codigo else 0
+        contenido = False
+
+    for linea in lineas:
+        resto = linea
+        valla = linea.strip() == "```"
+        while True:
+            # +1 por el salto de línea y +4 por si hay que cerrar un ``` abierto
+            # (o el que abre esta misma línea).
+            libre = limite - largo - 1 - (4 if en_codigo or valla else 0)
+            if len(resto) <= libre:
+                break
+            if contenido and len(resto) <= limite - 1 - (8 if en_codigo else 0):
+                # Cabe entera en una página nueva.
+                cerrar_pagina()
+                continue
+            # Más larga que una página (o la página solo tiene la valla
+            # reabierta): el primer trozo llena la página actual.
+            actual.append(resto[:libre])
+            resto = resto[libre:]
+            contenido = True
+            cerrar_pagina()
+        actual.append(resto)
+        largo += len(resto) + 1
+        if resto.strip() not in ("", "```"):
+            contenido = True
+        if valla:
+            en_codigo = not en_codigo
+
+    if contenido or not paginas:
+        if en_codigo:
+            actual.append("```")
+        paginas.append("\n".join(actual).strip("\n"))
+
+    return paginas
+
+
+def _teclado_pagina(snapshot_id, pagina, total, filas_extra):
+    keyboard = []
+    if total > 1:
+        navegacion = []
+        if pagina > 0:
+            navegacion.append(InlineKeyboardButton("⬅", callback_data=f"pag|{snapshot_id}|{pagina - 1}"))
+        navegacion.append(InlineKeyboardButton(f"{pagina + 1}/{total}", callback_data=f"pag|{snapshot_id}|{pagina}"))
+        if pagina + 1 < total:
+            navegacion.append(InlineKeyboardButton("➡", callback_data=f"pag|{snapshot_id}|{pagina + 1}"))
+        keyboard.append(navegacion)
+    keyboard += filas_extra or []
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+
+def _texto_pagina(paginas, pagina):
+    if len(paginas) == 1:
+        return paginas[0]
+    return f"{paginas[pagina]}\n\n📄 Página {pagina + 1}/{len(paginas)}"
+
+
+def crear_snapshot_paginas(lineas, filas_extra=None, parse_mode=None, fijar=None):
+    """Pagina ``lineas`` y guarda el resultado para servir las páginas sin releer Sheets.
+
+    Con ``fijar`` el snapshot no caduca hasta que se crea otro con la misma
+    clave (p. ej. el mensaje persistente de la lista).
+    """
+    paginas = paginar_lineas(lineas)
+    snapshot_id = next(_paginas_ids)
+    if len(paginas) > 1:
+        _paginas_snapshots[snapshot_id] = {
+            "paginas": paginas,
+            "filas_extra": filas_extra,
+            "parse_mode": parse_mode,
+        }
+        if fijar is not None:
+            _paginas_fijas[fijar] = snapshot_id
+        fijas = set(_paginas_fijas.values())
+        for antiguo in list(_paginas_snapshots):
+            if len(_paginas_snapshots) <= PAGINAS_MAX_SNAPSHOTS:
+                break
+            if antiguo not in fijas:
+                del _paginas_snapshots[antiguo]
+    elif fijar is not None:
+        _paginas_fijas.pop(fijar, None)
+    return {"id": snapshot_id, "paginas": paginas, "filas_extra": filas_extra, "parse_mode": parse_mode}
+
+
+async def enviar_paginado(enviar, lineas, filas_extra=None, parse_mode=None, snapshot=None):
+    """Envía la primera página con ``enviar`` (reply_text, edit_message_text, ...).
+
+    Se puede pasar un ``snapshot`` ya creado para mandar el mismo contenido a
+    varios chats sin repaginar.
+    """
+    snapshot = snapshot or crear_snapshot_paginas(lineas, filas_extra, parse_mode)
+    paginas = snapshot["paginas"]
+    return await enviar(
+        text=_texto_pagina(paginas, 0),
+        reply_markup=_teclado_pagina(snapshot["id"], 0, len(paginas), snapshot["filas_extra"]),
+        parse_mode=snapshot["parse_mode"],
+    )
+
+
+async def mostrar_pagina(query, snapshot_id, pagina):
+    snapshot = _paginas_snapshots.get(snapshot_id)
+    if snapshot is None:
+        await query.edit_message_text("⌛ Esta vista ha caducado. Vuelve a abrirla desde el menú.")
+        return
+
+    paginas = snapshot["paginas"]
+    pagina = max(0, min(pagina, len(paginas) - 1))
+    try:
+        await query.edit_message_text(
+            _texto_pagina(paginas, pagina),
+            reply_markup=_teclado_pagina(snapshot_id, pagina, len(paginas), snapshot["filas_extra"]),
+            parse_mode=snapshot["parse_mode"],
+        )
+    except BadRequest as e:
+        # Pulsar el indicador de la página actual no cambia nada.
+        if "not modified" not in str(e).lower():
+            raise
+
+
+# =========================
+# LISTA COMPARTIDA
+# =========================
+
+# Cada usuario tiene un único mensaje con la lista, que se edita en cada
+# cambio. Los message_id y el último estado notificado se guardan en disco
+# para seguir editando el mismo mensaje tras un reinicio; con un almacén
+# compartido se guardan en él, y un cerrojo del almacén deja difundir a un
+# solo worker a la vez, que relee lo que guardó el anterior.
+LISTA_MENSAJES_PATH = os.path.join(LOCAL_CACHE_DIR, "lista_mensajes.json")
+# Una difusión que se cuelgue no bloquea a los demás workers más de esto.
+LISTA_CERROJO_SECONDS = 120
+# Con LISTA_AVISO_CAMBIOS=1 se manda además una línea corta "+Leche −Pan":
+# las ediciones no generan notificación en el móvil.
+LISTA_AVISO_CAMBIOS = env_bool("LISTA_AVISO_CAMBIOS")
+LISTA_CAMBIOS_MAX = 10
+
+_lista_mensajes = None
+_lock_lista = asyncio.Lock()
+
+
+def get_lista_mensajes():
+    global _lista_mensajes
+
+    if _lista_mensajes is None:
+        guardado = leer_json_local(LISTA_MENSAJES_PATH) or {}
+        _lista_mensajes = {
+            "mensajes": guardado.get("mensajes", {}),
+            "estado": guardado.get("estado"),
+        }
+
+    return _lista_mensajes
+
+
+def cargar_lista_mensajes():
+    """Relee del almacén compartido lo que haya guardado otro worker."""
+    almacen = get_almacen()
+    estado = get_lista_mensajes()
+    if almacen.compartido:
+        try:
+            guardado = almacen.leer("lista", "mensajes")
+        except sqlite3.Error as e:
+            logger.warning("No se pudieron leer los mensajes de lista del almacén; se usa la copia local: %s", e)
+        else:
+            if guardado is not None:
+                estado.update(guardado[0])
+    return estado
+
+
+def guardar_lista_mensajes(estado):
+    almacen = get_almacen()
+    if almacen.compartido:
+        try:
+            almacen.escribir("lista", "mensajes", estado)
+            return
+        except sqlite3.Error as e:
+            logger.warning("No se pudieron guardar los mensajes de lista en el almacén: %s", e)
+    guardar_json_local(LISTA_MENSAJES_PATH, estado)
+
+
+@contextlib.asynccontextmanager
+async def cerrojo_lista():
+    """Una sola difusión de la lista a la vez entre todos los workers."""
+    almacen = get_almacen()
+    dueño = _dueño_sesiones()
+    fin = time.monotonic() + LISTA_CERROJO_SECONDS
+    while True:
+        try:
+            if await en_almacen(almacen.adquirir, "lista", dueño, LISTA_CERROJO_SECONDS):
+                break
+        except sqlite3.Error as e:
+            logger.warning("No se pudo tomar el cerrojo de la lista: %s", e)
+            break
+        if time.monotonic() >= fin:
+            logger.warning("Cerrojo de la lista ocupado más de %ss: se difunde igualmente", LISTA_CERROJO_SECONDS)
+            break
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            await en_almacen(almacen.liberar, "lista", dueño)
+        except sqlite3.Error as e:
+            logger.warning("No se pudo liberar el cerrojo de la lista (caduca en %ss): %s", LISTA_CERROJO_SECONDS, e)
+
+
+def texto_cambios_lista(anterior, actual):
+    """Diferencia entre dos estados de la lista: "+Leche +Huevos −Pan"."""
+    if anterior is None:
+        return ""
+
+    antes = Counter(p for productos in anterior.values() for p in productos)
+    ahora = Counter(p for productos in actual.values() for p in productos)
+    cambios = [f"+{p}" for p in (ahora - antes).elements()]
+    cambios += [f"−{p}" for p in (antes - ahora).elements()]
+
+    if len(cambios) > LISTA_CAMBIOS_MAX:
+        cambios = cambios[:LISTA_CAMBIOS_MAX] + [f"(+{len(cambios) - LISTA_CAMBIOS_MAX} más)"]
+    return " ".join(cambios)
+
+
+async def publicar_lista_usuario(bot, user_id, snapshot):
+    """Edita el mensaje de lista del usuario o, si ya no existe, manda uno nuevo.
+
+    Devuelve True si se ha enviado un mensaje nuevo.
+    """
+    mensajes = get_lista_mensajes()["mensajes"]
+    message_id = mensajes.get(str(user_id))
+
+    if message_id:
+        try:
+            await enviar_paginado(
+                functools.partial(
+                    bot.edit_message_text,
+                    chat_id=user_id,
+                    message_id=message_id,
+                    rate_limit_args=PRIORIDAD_DIFUSION,
+                ),
+                None,
+                snapshot=snapshot,
+            )
+            return False
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return False
+            # Borrado por el usuario o ya no editable: se sustituye por uno nuevo.
+            logger.info("Mensaje de lista %s de %s no editable (%s), se envía otro", message_id, user_id, e)
+
+    enviado = await enviar_paginado(
+        functools.partial(bot.send_message, chat_id=user_id, rate_limit_args=PRIORIDAD_DIFUSION),
+        None,
+        snapshot=snapshot,
+    )
+    mensajes[str(user_id)] = enviado.message_id
+    return True
 
-    return mensaje
 
 async def notificar_lista_actualizada(context, mover_menu=False):
-    
-    mensaje_lista = obtener_lista_completa()
+    # Dos usuarios pueden tocar la lista a la vez: las difusiones van de una
+    # en una para que el estado guardado y los mensajes no se pisen.
+    async with _lock_lista, cerrojo_lista():
+        await _difundir_lista(context, mover_menu)
+
+
+async def _difundir_lista(context, mover_menu):
+    estado = await en_almacen(cargar_lista_mensajes)
+    productos = leer_lista_compra()
+    cambios = texto_cambios_lista(estado["estado"], productos)
+
+    # Una sola lectura y una sola paginación para todos los usuarios.
+    snapshot = crear_snapshot_paginas(
+        lineas_lista_compra("🛒 LISTA ACTUAL COMPLETA", productos, cambios),
+        fijar="lista",
+    )
 
     for user_id_aut in AUTHORIZED_USERS:
         try:
-            await context.bot.send_message(
-                chat_id=user_id_aut,
-                text=mensaje_lista
-            )
-            if mover_menu:
-                await desplazar_menu_principal_al_final(context, user_id_aut)
+            nuevo = await publicar_lista_usuario(context.bot, user_id_aut, snapshot)
+            if LISTA_AVISO_CAMBIOS and cambios and not nuevo:
+                await context.bot.send_message(
+                    chat_id=user_id_aut,
+                    text=f"🛒 {cambios}",
+                    rate_limit_args=PRIORIDAD_DIFUSION,
+                )
+            # Solo un mensaje nuevo deja el menú por encima; una edición no lo mueve.
+            if mover_menu and nuevo:
+                await desplazar_menu_principal_al_final(context, user_id_aut, PRIORIDAD_DIFUSION)
         except Exception as e:
-            print("Error enviando lista a", user_id_aut, e)
+            logger.warning("No se pudo enviar la lista a %s: %s", user_id_aut, e)
+
+    estado["estado"] = productos
+    await en_almacen(guardar_lista_mensajes, estado)
+
+
+# =========================
+# IMPORTES
+# =========================
+
+# Los resúmenes piden UNFORMATTED_VALUE, así que los importes llegan como
+# números; el parseo de texto queda para celdas con formato y para lo que
+# escribe el usuario. Reglas comunes:
+#   - se ignoran "€" y espacios, y se respeta el signo inicial;
+#   - con "," y "." a la vez, el último que aparece es el decimal;
+#   - "." o "," repetidos, o un "." agrupando miles ("1.500"), son miles;
+#   - en cualquier otro caso "," y "." son el separador decimal.
+
+# Atajo para el formato que devuelve Sheets en es-ES: "-1.234,56 €".
+_RE_IMPORTE_ES = re.compile(r"^\s*([+-]?)(\d{1,3}(?:\.\d{3})+|\d+),(\d+)\s*€?\s*$")
+_RE_MILES_PUNTO = re.compile(r"^[1-9]\d{0,2}(\.\d{3})+$")
+_RE_MILES_COMA = re.compile(r"^[1-9]\d{0,2}(,\d{3}){2,}$")
+_RE_NUMERO_NORMALIZADO = re.compile(r"^[+-]?(\d+(\.\d*)?|\.\d+)$")
+_RE_ENTERO_MILES = {
+    ".": re.compile(r"^\d{1,3}(\.\d{3})*$"),
+    ",": re.compile(r"^\d{1,3}(,\d{3})*$"),
+}
+
+IMPORTES_NUMPY_MIN_CELDAS = 2000
+
+
+def _miles_validos(texto):
+    """False si ``texto`` agrupa mal los miles («1.2.3», «1.2,50»): cada grupo tras el primero, de 3 cifras."""
+    valor = texto.strip().replace("€", "").replace(" ", "").replace("\xa0", "").lstrip("+-")
+    if "," in valor and "." in valor:
+        decimal = "," if valor.rfind(",") > valor.rfind(".") else "."
+        miles = "." if decimal == "," else ","
+        entero = valor[:valor.rfind(decimal)]
+        return _RE_ENTERO_MILES[miles].match(entero) is not None
+    if valor.count(".") > 1:
+        return _RE_MILES_PUNTO.match(valor) is not None
+    return True
+
+
+def _normalizar_importe(texto):
+    valor = texto.strip().replace("€", "").replace(" ", "").replace("\xa0", "")
+
+    signo = ""
+    if valor and valor[0] in "+-":
+        signo, valor = valor[0], valor[1:]
+
+    if "," in valor and "." in valor:
+        if valor.rfind(",") > valor.rfind("."):
+            valor = valor.replace(".", "").replace(",", ".")
+        else:
+            valor = valor.replace(",", "")
+    elif "," in valor:
+        if _RE_MILES_COMA.match(valor):
+            valor = valor.replace(",", "")
+        else:
+            valor = valor.replace(",", ".")
+    elif "." in valor and (_RE_MILES_PUNTO.match(valor) or valor.count(".") > 1):
+        valor = valor.replace(".", "")
+
+    return signo + valor
+
+
+def parse_importe(valor, estricto=False):
+    """Convierte un importe de Sheets o del usuario a float.
+
+    Con ``estricto=True`` lanza ValueError si no hay un número válido (entrada
+    del usuario); si no, descarta caracteres extraños y devuelve 0 si no
+    queda nada (celdas de hojas).
+    """
+    if isinstance(valor, bool):
+        valor = str(valor)
+    if isinstance(valor, (int, float)):
+        return float(valor)
+
+    texto = str(valor)
+    match = _RE_IMPORTE_ES.match(texto)
+    if match:
+        signo, entero, decimales = match.groups()
+        return float(f"{signo}{entero.replace('.', '')}.{decimales}")
+
+    if estricto and not _miles_validos(texto):
+        raise ValueError(f"importe inválido: {valor!r}")
+
+    normalizado = _normalizar_importe(texto)
+    if _RE_NUMERO_NORMALIZADO.match(normalizado):
+        return float(normalizado)
+
+    if estricto:
+        raise ValueError(f"importe inválido: {valor!r}")
+
+    signo = "-" if normalizado.startswith("-") else ""
+    limpio = "".join(c for c in normalizado if c.isdigit() or c == ".")
+    if not _RE_NUMERO_NORMALIZADO.match(limpio):
+        return 0.0
+    return float(signo + limpio)
+
+
+def _parse_columna_numpy(textos):
+    arr = np.asarray(textos, dtype=str)
+    arr = np.where(arr == "", "0,0", arr)
+    coma = np.char.rfind(arr, ",")
+    # Solo se vectoriza el formato de Sheets en es-ES ("-1.234,56 €"): coma
+    # decimal y puntos de miles. Cualquier otra mezcla va por parse_importe.
+    if (coma < 0).any() or (np.char.rfind(arr, ".") > coma).any():
+        raise ValueError("columna con formatos mezclados")
+    for quitar in ("€", " ", "\xa0", "."):
+        arr = np.char.replace(arr, quitar, "")
+    return np.char.replace(arr, ",", ".").astype(float).tolist()
+
+
+def _importe_celda(valor):
+    if type(valor) is float or type(valor) is int:
+        return float(valor)
+    if valor in ("", None):
+        return 0.0
+    return parse_importe(valor)
+
+
+def parse_columna_importes(valores):
+    """Parsea una columna entera de importes de una vez.
+
+    Los números (UNFORMATTED_VALUE) pasan directamente. Una columna grande
+    de textos con el formato de Sheets se convierte con NumPy si está
+    instalado; cualquier otro caso va celda a celda con ``parse_importe``.
+    """
+    if (
+        np is not None
+        and len(valores) >= IMPORTES_NUMPY_MIN_CELDAS
+        and all(type(v) is str for v in valores)
+    ):
+        try:
+            return _parse_columna_numpy(valores)
+        except ValueError:
+            pass
+
+    return [_importe_celda(v) for v in valores]
+
+
+
+def formatear_importe(valor):
+    """Importe con el formato de Sheets en es-ES: 1234.5 → "1.234,50 €"."""
+    texto = f"{valor:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+    return f"{texto} €"
+
 # =========================
 # FUNCIONES DATOS
 # =========================
 
 def get_personas_gasto():
-    ensure_google_sheets_ready()
-    valores = listas_sheet.col_values(19)[1:4]
-    return [v for v in valores if v and v != "—"]
+    return get_indice_taxonomia()["personas"]
 
 def get_quien_paga():
-    ensure_google_sheets_ready()
-    valores = listas_sheet.col_values(20)[1:4]
-    return [v for v in valores if v and v != "—"]
+    return get_indice_taxonomia()["pagadores"]
 
 
 def get_listas_data():
     ensure_google_sheets_ready()
-    
-    now = time.monotonic()
-    if _listas_cache["data"] is not None and now < _listas_cache["expires_at"]:
-        return _listas_cache["data"]
 
-    data = listas_sheet.get_all_values()[1:]
-    _listas_cache["data"] = data
-    _listas_cache["expires_at"] = now + LISTAS_CACHE_SECONDS
-    return data
+    return leer_cache(
+        "LISTAS",
+        _listas_cache,
+        LISTAS_CACHE_SECONDS,
+        lambda: listas_sheet.get_all_values()[1:],
+    )
 
 def get_tipos():
     data = get_listas_data()
@@ -534,6 +2379,50 @@ def get_sub3(tipo, categoria, sub1, sub2):
 
     return sorted(sub3_set)
 
+
+# Índice en memoria de LISTAS para /g: rutas completas (tipo, categoría,
+# sub1-3), personas y pagadores, con los textos ya normalizados. Se rehace
+# solo cuando get_listas_data devuelve una lectura nueva.
+_indice_taxonomia = {"data": None, "indice": None}
+
+
+def _nombres_columna(data, columna):
+    # Columnas S (personas) y T (pagadores), filas 2-4 de LISTAS.
+    valores = [fila[columna].strip() for fila in data[:3] if len(fila) > columna]
+    return [v for v in valores if v and v != "—"]
+
+
+def get_indice_taxonomia():
+    data = get_listas_data()
+    if _indice_taxonomia["data"] is data:
+        return _indice_taxonomia["indice"]
+
+    rutas = sorted({
+        tuple((fila[i].strip() if i < len(fila) else "") or "—" for i in range(5))
+        for fila in data
+        if fila and fila[0].strip() and fila[0].strip() != "—"
+    })
+    claves = {}
+    for ruta in rutas:
+        for valor in ruta:
+            if valor != "—" and valor not in claves:
+                acronimo = "".join(palabra[0] for palabra in valor.split() if palabra)
+                claves[valor] = (normalizar_texto(valor), normalizar_texto(acronimo))
+
+    indice = {
+        "rutas": rutas,
+        "claves": claves,
+        # Ruta normalizada ("—" y vacío valen lo mismo) → ruta de LISTAS.
+        "por_ruta": {tuple(normalizar_texto(p) for p in ruta): ruta for ruta in rutas},
+        "personas": _nombres_columna(data, 18),
+        "pagadores": _nombres_columna(data, 19),
+    }
+    for campo in ("personas", "pagadores"):
+        indice[f"{campo}_por_clave"] = {normalizar_texto(n): n for n in indice[campo]}
+    _indice_taxonomia.update({"data": data, "indice": indice})
+    return indice
+
+
 def resumen_trabajo_parcial(data):
     campos = [
         ("trabajo_promotores", "Promotores"),
@@ -590,38 +2479,36 @@ def normalizar_texto(valor):
 
 def obtener_casas_trabajo(persona):
     ensure_google_sheets_ready()
-    
-    now = time.monotonic()
-    cache = _trabajo_casas_cache.get(persona)
-    if cache and now < cache["expires_at"]:
-        return cache["data"]
-
-    sheet_control = trabajo_control_sheets[persona]
-    valores = sheet_control.get("A5:A55")
-    casas = [row[0].strip() for row in valores if row and row[0].strip()]
-    _trabajo_casas_cache[persona] = {
-        "data": casas,
-        "expires_at": now + TRABAJO_CASAS_CACHE_SECONDS,
-    }
-    return casas
 
+    def cargar():
+        valores = trabajo_control_sheets[persona].get("A5:A55")
+        return [row[0].strip() for row in valores if row and row[0].strip()]
 
-def score_casa(entrada, casa):
-    en = normalizar_texto(entrada)
-    ca = normalizar_texto(casa)
+    cache = _trabajo_casas_cache.setdefault(
+        persona,
+        {"data": None, "expires_at": 0.0, "loaded_at": 0.0},
+    )
+    return leer_cache(f"Casas {persona}", cache, TRABAJO_CASAS_CACHE_SECONDS, cargar)
+
+
+def score_normalizado(en, ca, ac):
+    """Parecido entre textos ya normalizados: ``ac`` es el acrónimo de ``ca``."""
     if not en:
         return 0
     if en == ca:
         return 1.0
     if en in ca or ca in en:
         return 0.95
-    acronimo = "".join(word[0] for word in casa.split() if word)
-    ac = normalizar_texto(acronimo)
     if en == ac or en in ac:
         return 0.93
     return SequenceMatcher(None, en, ca).ratio()
 
 
+def score_casa(entrada, casa):
+    acronimo = "".join(word[0] for word in casa.split() if word)
+    return score_normalizado(normalizar_texto(entrada), normalizar_texto(casa), normalizar_texto(acronimo))
+
+
 def buscar_casas_parecidas(persona, entrada, limite=6):
     casas = obtener_casas_trabajo(persona)
     ranking = sorted(
@@ -636,23 +2523,6 @@ def buscar_casas_parecidas(persona, entrada, limite=6):
     return sugerencias
 
 
-def parse_numero_con_signo(texto):
-    valor = str(texto).strip().replace("€", "").replace(" ", "")
-    if not valor:
-        raise ValueError("vacío")
-
-    if "," in valor and "." in valor:
-        valor = valor.replace(".", "")
-        valor = valor.replace(",", ".")
-    elif "," in valor:
-        valor = valor.replace(",", ".")
-
-    if valor in {"+", "-", ".", "+.", "-."}:
-        raise ValueError("inválido")
-
-    return float(valor)
-
-
 def formatear_fecha_para_sheet(fecha_texto):
     valor = str(fecha_texto).strip()
     if not valor:
@@ -665,6 +2535,61 @@ def formatear_fecha_para_sheet(fecha_texto):
         return valor
 
 
+def fila_promos(data, promotor):
+    fila = [""] * 19
+    fila[0] = promotor
+    fila[1] = formatear_fecha_para_sheet(data.get("trabajo_fecha", ""))
+    fila[2] = data.get("trabajo_casa", "")
+    fila[3] = data.get("trabajo_tipo_bono", "")
+    fila[4] = data.get("trabajo_tipo_promo", "")
+    fila[5] = data.get("trabajo_observaciones", "")
+    fila[6] = data.get("trabajo_partido", "")
+    fila[15] = data.get("trabajo_perdida", 0)
+    fila[16] = data.get("trabajo_beneficio", 0)
+    fila[18] = data.get("trabajo_observaciones_finales", "")
+    return fila
+
+
+def bloques_contiguos(numeros):
+    """[3, 4, 5, 9, 10] → [(3, 5), (9, 10)]."""
+    bloques = []
+    for numero in numeros:
+        if bloques and numero == bloques[-1][1] + 1:
+            bloques[-1][1] = numero
+        else:
+            bloques.append([numero, numero])
+    return [tuple(b) for b in bloques]
+
+
+def escribir_filas_promos(hoja, filas):
+    """Escribe ``filas`` en los primeros huecos de la columna A de PromosDone.
+
+    Una lectura de A:A y una sola escritura por lotes, con un rango por cada
+    bloque de filas seguidas. Devuelve el número de bloques.
+    """
+    valores_columna_a = hoja.get("A:A")
+    libres = [
+        idx for idx, row in enumerate(valores_columna_a, start=1)
+        if not (row and row[0] and row[0].strip())
+    ]
+    siguiente = len(valores_columna_a) + 1
+    libres += range(siguiente, siguiente + max(0, len(filas) - len(libres)))
+    destinos = libres[:len(filas)]
+
+    rangos = []
+    posicion = 0
+    for inicio, fin in bloques_contiguos(destinos):
+        bloque = filas[posicion:posicion + fin - inicio + 1]
+        posicion += len(bloque)
+        # Importante: nunca tocar la columna R (índice 17), ya que se gestiona fuera del bot.
+        rangos.append({"range": f"A{inicio}:Q{fin}", "values": [fila[:17] for fila in bloque]})
+        rangos.append({"range": f"S{inicio}:S{fin}", "values": [[fila[18]] for fila in bloque]})
+
+    if rangos:
+        hoja.batch_update(rangos, value_input_option="USER_ENTERED")
+    return len(rangos) // 2
+
+
 def guardar_registro_trabajo(data):
     persona = data["trabajo_persona"]
     hoja = trabajo_promos_sheets[persona]
@@ -672,39 +2597,418 @@ def guardar_registro_trabajo(data):
     promotores = data.get("trabajo_promotores") or [data.get("trabajo_promotor", "")]
     promotores = [p for p in promotores if p]
 
-    for promotor in promotores:
-        fila = [""] * 19
-        fila[0] = promotor
-        fila[1] = formatear_fecha_para_sheet(data.get("trabajo_fecha", ""))
-        fila[2] = data.get("trabajo_casa", "")
-        fila[3] = data.get("trabajo_tipo_bono", "")
-        fila[4] = data.get("trabajo_tipo_promo", "")
-        fila[5] = data.get("trabajo_observaciones", "")
-        fila[6] = data.get("trabajo_partido", "")
-        fila[15] = data.get("trabajo_perdida", 0)
-        fila[16] = data.get("trabajo_beneficio", 0)
-        fila[18] = data.get("trabajo_observaciones_finales", "")
-
-        valores_columna_a = hoja.get("A:A")
-        fila_destino = len(valores_columna_a) + 1
-
-        for idx, row in enumerate(valores_columna_a, start=1):
-            celda = row[0].strip() if row and row[0] else ""
-            if not celda:
-                fila_destino = idx
-                break
+    escribir_filas_promos(hoja, [fila_promos(data, promotor) for promotor in promotores])
+
+
+def guardar_trabajo(user_id):
+    """Escribe en PromosDone el registro de trabajo del flujo. False si ya lo había guardado."""
+    with escritura_unica(user_id, "PromosDone") as nueva:
+        if nueva:
+            guardar_registro_trabajo(user_states[user_id])
+    return nueva
+
+
+def guardar_movimiento(user_id, data, importe):
+    """Añade el movimiento a REGISTRO (y al espejo). False si el flujo ya lo había guardado."""
+    fila = [
+        formatear_fecha_para_sheet(data.get("fecha", "")),
+        data.get("persona", ""),
+        data.get("pagador", ""),
+        data.get("tipo", ""),
+        data.get("categoria", ""),
+        data.get("sub1", "—"),
+        data.get("sub2", "—"),
+        data.get("sub3", "—"),
+        data.get("observacion", ""),
+        importe
+    ]
+    with escritura_unica(user_id, "REGISTRO") as nueva:
+        if nueva:
+            respuesta = sheet.append_row(fila, value_input_option="USER_ENTERED")
+            registrar_en_espejo(respuesta, fila)
+    return nueva
+
+
+def texto_movimiento_guardado(data, importe):
+    return (
+        "✅ Movimiento guardado correctamente en Excel.\n\n"
+        f"Fecha: {data.get('fecha', '')}\n"
+        f"Persona: {data.get('persona', '')}\n"
+        f"Pagador: {data.get('pagador', '')}\n"
+        f"Tipo: {data.get('tipo', '')}\n"
+        f"Categoría: {data.get('categoria', '')}\n"
+        f"Sub1: {data.get('sub1', '—')}\n"
+        f"Sub2: {data.get('sub2', '—')}\n"
+        f"Sub3: {data.get('sub3', '—')}\n"
+        f"Observación: {data.get('observacion', '') or '—'}\n"
+        f"Importe: {importe}"
+    )
 
-        # Importante: nunca tocar la columna R (índice 17), ya que se gestiona fuera del bot.
-        hoja.update(
-            f"A{fila_destino}:Q{fila_destino}",
-            [fila[:17]],
-            value_input_option="USER_ENTERED",
+# =========================
+# ESPEJO REGISTRO (SQLite)
+# =========================
+
+# Copia local de REGISTRO para consultas que no deben descargar la hoja.
+# Se sincroniza por incrementos desde la última fila copiada, recibe
+# directamente las filas que escribe el bot y cada REGISTRO_VERIFICACION_SECONDS
+# se compara entera con la hoja para recoger ediciones y borrados manuales.
+REGISTRO_DB_PATH = os.path.join(LOCAL_CACHE_DIR, "registro.sqlite3")
+REGISTRO_SYNC_SECONDS = 30
+REGISTRO_VERIFICACION_SECONDS = 3600
+REGISTRO_SYNC_CHUNK = 2000
+
+COLUMNAS_REGISTRO = [
+    "fecha", "persona", "pagador", "tipo", "categoria",
+    "sub1", "sub2", "sub3", "observacion", "importe",
+]
+# Columnas propias del espejo, derivadas de las de la hoja: las claves
+# normalizadas que filtra /buscar (indexadas) y el texto de su búsqueda libre.
+COLUMNAS_NORMALIZADAS = ["persona", "pagador", "tipo", "categoria", "sub1", "sub2", "sub3"]
+COLUMNAS_ESPEJO = COLUMNAS_REGISTRO + [f"{c}_norm" for c in COLUMNAS_NORMALIZADAS] + ["texto_norm"]
+
+# Al cambiar el esquema se reconstruye el espejo desde la hoja.
+REGISTRO_ESQUEMA_VERSION = 3
+
+_registro_db = None
+_registro_lock = threading.RLock()
+# Solo una sincronización a la vez lee de Sheets; no bloquea el espejo.
+_registro_sync_lock = threading.Lock()
+_registro_estado = {
+    "ultima_sync": 0.0,
+    "ultima_verificacion": 0.0,
+    "filas_bot": 0,
+    "filas_sync": 0,
+    "correcciones": 0,
+    "fts": False,
+}
+
+_tarea_verificacion = None
+
+_RE_FILA_RANGO = re.compile(r"![A-Z]+(\d+)")
+
+
+def get_registro_db():
+    global _registro_db
+
+    if _registro_db is None:
+        os.makedirs(os.path.dirname(REGISTRO_DB_PATH), exist_ok=True)
+        conexion = sqlite3.connect(REGISTRO_DB_PATH, check_same_thread=False)
+        conexion.execute("CREATE TABLE IF NOT EXISTS sync (clave TEXT PRIMARY KEY, valor TEXT)")
+        if _valor_sync(conexion, "esquema") != str(REGISTRO_ESQUEMA_VERSION):
+            conexion.execute("DROP TABLE IF EXISTS registro")
+            conexion.execute("DROP TABLE IF EXISTS registro_fts")
+            conexion.execute("DELETE FROM sync")
+            _guardar_sync(conexion, "esquema", REGISTRO_ESQUEMA_VERSION)
+            conexion.commit()
+        conexion.executescript("""
+            CREATE TABLE IF NOT EXISTS registro (
+                fila INTEGER PRIMARY KEY,
+                fecha TEXT,
+                persona TEXT,
+                pagador TEXT,
+                tipo TEXT,
+                categoria TEXT,
+                sub1 TEXT,
+                sub2 TEXT,
+                sub3 TEXT,
+                observacion TEXT,
+                importe REAL,
+                persona_norm TEXT,
+                pagador_norm TEXT,
+                tipo_norm TEXT,
+                categoria_norm TEXT,
+                sub1_norm TEXT,
+                sub2_norm TEXT,
+                sub3_norm TEXT,
+                texto_norm TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_registro_fecha ON registro (fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_persona ON registro (persona_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_pagador ON registro (pagador_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_tipo ON registro (tipo_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_categoria ON registro (categoria_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_sub1 ON registro (sub1_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_sub2 ON registro (sub2_norm, fecha);
+            CREATE INDEX IF NOT EXISTS idx_registro_sub3 ON registro (sub3_norm, fecha);
+        """)
+        _registro_estado["fts"] = _crear_fts_registro(conexion)
+        _registro_db = conexion
+
+    return _registro_db
+
+
+def _crear_fts_registro(conexion):
+    """Índice FTS5 de trigramas sobre texto_norm (rowid = fila).
+
+    Los trigramas permiten buscar subcadenas (como un LIKE '%x%') por índice.
+    Se mantiene a mano junto con ``registro``: por triggers, FTS5 escribe fila
+    a fila y la primera copia de la hoja tarda varias veces más.
+    Devuelve False si este SQLite no trae FTS5 con trigramas.
+    """
+    try:
+        conexion.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS registro_fts USING fts5(texto_norm, tokenize = 'trigram')"
+        )
+    except sqlite3.OperationalError as e:
+        logger.warning("SQLite sin FTS5 de trigramas (%s): /buscar filtrará el texto sin índice", e)
+        return False
+    return True
+
+
+def _valor_sync(conexion, clave, defecto=None):
+    fila = conexion.execute("SELECT valor FROM sync WHERE clave = ?", (clave,)).fetchone()
+    return fila[0] if fila else defecto
+
+
+def _guardar_sync(conexion, clave, valor):
+    conexion.execute(
+        "INSERT INTO sync (clave, valor) VALUES (?, ?) "
+        "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor",
+        (clave, str(valor)),
+    )
+
+
+def _fecha_iso(valor):
+    """Fecha de la hoja (texto en varios formatos o número de serie) → YYYY-MM-DD."""
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return (datetime(1899, 12, 30) + timedelta(days=int(valor))).strftime("%Y-%m-%d")
+
+    texto = str(valor).strip()
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(texto, formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return texto
+
+
+# Personas, categorías y subcategorías se repiten en casi todas las filas.
+@functools.lru_cache(maxsize=4096)
+def _clave_espejo(valor):
+    return normalizar_texto(valor) if valor != "—" else ""
+
+
+def _fila_espejo(numero, valores):
+    valores = list(valores) + [""] * (len(COLUMNAS_REGISTRO) - len(valores))
+    textos = [str(v).strip() for v in valores[1:9]]
+    claves = [_clave_espejo(t) for t in textos[:7]]
+    # Categoría, subcategorías y observación normalizadas, para el texto libre de /buscar.
+    texto_norm = " ".join(t for t in claves[3:] + [normalizar_texto(textos[7])] if t)
+    return (
+        numero,
+        _fecha_iso(valores[0]),
+        *textos,
+        parse_importe(valores[9]),
+        *claves,
+        texto_norm,
+    )
+
+
+def _insertar_filas_espejo(conexion, filas):
+    conexion.executemany(
+        f"INSERT OR REPLACE INTO registro (fila, {', '.join(COLUMNAS_ESPEJO)}) "
+        f"VALUES ({', '.join('?' * (len(COLUMNAS_ESPEJO) + 1))})",
+        filas,
+    )
+    if _registro_estado["fts"]:
+        conexion.executemany("DELETE FROM registro_fts WHERE rowid = ?", [(fila[0],) for fila in filas])
+        conexion.executemany(
+            "INSERT INTO registro_fts (rowid, texto_norm) VALUES (?, ?)",
+            [(fila[0], fila[-1]) for fila in filas],
         )
-        hoja.update(
-            f"S{fila_destino}",
-            [[fila[18]]],
-            value_input_option="USER_ENTERED",
+
+
+def _borrar_filas_espejo(conexion, numeros=None):
+    """Borra del espejo las filas ``numeros`` (todas si es None)."""
+    tablas = ["registro"] + (["registro_fts"] if _registro_estado["fts"] else [])
+    for tabla, columna in zip(tablas, ("fila", "rowid")):
+        if numeros is None:
+            conexion.execute(f"DELETE FROM {tabla}")
+        else:
+            conexion.executemany(f"DELETE FROM {tabla} WHERE {columna} = ?", [(n,) for n in numeros])
+
+
+def _leer_filas_registro(inicio, fin=None):
+    rango = f"A{inicio}:J{fin}" if fin else f"A{inicio}:J"
+    valores = sheet.get(
+        rango,
+        value_render_option="UNFORMATTED_VALUE",
+        date_time_render_option="FORMATTED_STRING",
+    )
+    # gspread devuelve [[]] para un rango sin datos: no es una fila.
+    return [] if valores == [[]] else valores
+
+
+def _origen_registro():
+    return f"{spreadsheet.id}:{sheet.id}"
+
+
+def sincronizar_registro(forzar=False, verificar=False):
+    """Trae a SQLite las filas nuevas de REGISTRO. Devuelve cuántas se copiaron.
+
+    Con ``verificar`` compara además la hoja entera con el espejo; eso solo lo
+    hace la tarea de fondo ``mantener_registro_verificado``, nunca una consulta.
+
+    Las lecturas de Sheets van fuera de ``_registro_lock``: mientras duran, el
+    espejo sigue atendiendo consultas y filas del bot. Si ya hay otra
+    sincronización en marcha (y no se fuerza), se usa el espejo tal cual,
+    salvo que este proceso aún no haya terminado ninguna: tras un arranque en
+    frío el espejo está vacío y contestar con él daría resultados falsos, así
+    que se espera a que acabe la carga.
+    """
+    ensure_google_sheets_ready()
+
+    esperar = forzar or not _registro_estado["ultima_sync"]
+    if not _registro_sync_lock.acquire(blocking=esperar):
+        return 0
+    try:
+        with _registro_lock:
+            conexion = get_registro_db()
+            if _valor_sync(conexion, "origen") != _origen_registro():
+                _borrar_filas_espejo(conexion)
+                _guardar_sync(conexion, "origen", _origen_registro())
+                _guardar_sync(conexion, "ultima_fila", 1)
+                conexion.commit()
+                forzar = True
+            ultima_fila = int(_valor_sync(conexion, "ultima_fila", 1))
+        now = time.monotonic()
+
+        if verificar:
+            return verificar_registro()
+
+        if not forzar and now - _registro_estado["ultima_sync"] < REGISTRO_SYNC_SECONDS:
+            return 0
+
+        desde_cero = ultima_fila <= 1
+        copiadas = 0
+        while True:
+            inicio = ultima_fila + 1
+            valores = _leer_filas_registro(inicio, inicio + REGISTRO_SYNC_CHUNK - 1)
+            if valores:
+                filas = [_fila_espejo(inicio + i, fila) for i, fila in enumerate(valores)]
+                with _registro_lock:
+                    _insertar_filas_espejo(conexion, filas)
+                    # Mientras se leía, el bot puede haber copiado filas suyas más abajo.
+                    ultima_fila = max(inicio + len(valores) - 1, int(_valor_sync(conexion, "ultima_fila", 1)))
+                    _guardar_sync(conexion, "ultima_fila", ultima_fila)
+                    conexion.commit()
+                copiadas += len(valores)
+            if len(valores) < REGISTRO_SYNC_CHUNK:
+                break
+
+        _registro_estado["ultima_sync"] = now
+        # Una carga desde la primera fila ya ha leído la hoja entera.
+        if desde_cero:
+            _registro_estado["ultima_verificacion"] = now
+        _registro_estado["filas_sync"] += copiadas
+        if copiadas:
+            logger.info("Espejo REGISTRO: %d filas nuevas (hasta la fila %d)", copiadas, ultima_fila)
+        return copiadas
+    finally:
+        _registro_sync_lock.release()
+
+
+def verificar_registro():
+    """Compara la hoja entera con el espejo y corrige filas cambiadas, nuevas o borradas.
+
+    Se llama con ``_registro_sync_lock`` tomado. La hoja se lee sin bloquear el
+    espejo; las filas que el bot copie mientras tanto no se tocan.
+    """
+    with _registro_lock:
+        conexion = get_registro_db()
+        limite = int(_valor_sync(conexion, "ultima_fila", 1))
+    now = time.monotonic()
+
+    remotas = {
+        2 + i: _fila_espejo(2 + i, fila)
+        for i, fila in enumerate(_leer_filas_registro(2))
+    }
+
+    with _registro_lock:
+        locales = {
+            fila[0]: fila
+            for fila in conexion.execute(
+                f"SELECT fila, {', '.join(COLUMNAS_ESPEJO)} FROM registro"
+            )
+        }
+        posteriores = [numero for numero in locales if numero > limite and numero not in remotas]
+
+        distintas = [fila for numero, fila in remotas.items() if locales.get(numero) != fila]
+        sobrantes = [numero for numero in locales.keys() - remotas.keys() if numero <= limite]
+
+        _insertar_filas_espejo(conexion, distintas)
+        _borrar_filas_espejo(conexion, sobrantes)
+        _guardar_sync(conexion, "ultima_fila", max([*remotas, *posteriores], default=1))
+        conexion.commit()
+
+    corregidas = len(distintas) + len(sobrantes)
+    nuevas = len(remotas.keys() - locales.keys())
+    _registro_estado["ultima_sync"] = now
+    _registro_estado["ultima_verificacion"] = now
+    _registro_estado["correcciones"] += corregidas - nuevas
+    if corregidas - nuevas:
+        logger.warning(
+            "Espejo REGISTRO: verificación corrigió %d filas y eliminó %d",
+            len(distintas) - nuevas, len(sobrantes),
         )
+    return nuevas
+
+
+async def mantener_registro_verificado():
+    """Compara el espejo con la hoja entera cada REGISTRO_VERIFICACION_SECONDS.
+
+    La primera vez, nada más arrancar, recoge lo que se editara a mano
+    mientras el bot estaba parado.
+    """
+    while True:
+        verificado = _registro_estado["ultima_verificacion"]
+        if verificado:
+            await asyncio.sleep(max(verificado + REGISTRO_VERIFICACION_SECONDS - time.monotonic(), 0))
+        try:
+            await en_hilo(sincronizar_registro, True, True)
+        except Exception as e:
+            logger.warning("No se pudo verificar el espejo de REGISTRO: %s", e)
+            await asyncio.sleep(REGISTRO_SYNC_SECONDS)
+
+
+def registrar_en_espejo(respuesta_append, valores):
+    registrar_filas_en_espejo(respuesta_append, [valores])
+
+
+def registrar_filas_en_espejo(respuesta_append, filas):
+    """Copia al espejo filas recién escritas por el bot sin volver a leer la hoja.
+
+    Si no van justo detrás de la última copiada (alguien escribió en medio),
+    se dejan para la próxima sincronización.
+    """
+    rango = (respuesta_append or {}).get("updates", {}).get("updatedRange", "")
+    match = _RE_FILA_RANGO.search(rango)
+    if not match:
+        return
+
+    numero = int(match.group(1))
+    try:
+        with _registro_lock:
+            conexion = get_registro_db()
+            if _valor_sync(conexion, "origen") != _origen_registro():
+                return
+            if numero != int(_valor_sync(conexion, "ultima_fila", 1)) + 1:
+                return
+            _insertar_filas_espejo(conexion, [_fila_espejo(numero + i, valores) for i, valores in enumerate(filas)])
+            _guardar_sync(conexion, "ultima_fila", numero + len(filas) - 1)
+            conexion.commit()
+            _registro_estado["filas_bot"] += len(filas)
+    except sqlite3.Error as e:
+        logger.warning("No se pudo copiar la fila %d al espejo de REGISTRO: %s", numero, e)
+
+
+def consultar_registro(sql, parametros=()):
+    """Consulta de solo lectura sobre el espejo, sincronizado antes si toca."""
+    sincronizar_registro()
+    with _registro_lock:
+        return get_registro_db().execute(sql, parametros).fetchall()
+
+
 
 # =========================
 # MENU
@@ -738,6 +3042,7 @@ async def mostrar_selector_meses(query):
         keyboard.append([InlineKeyboardButton(f"{mes} {año_actual}", callback_data=callback)])
 
     keyboard.append([InlineKeyboardButton(f"📊 Todo {año_actual}", callback_data=f"resumen_año|{año_actual}")])
+    keyboard.append([InlineKeyboardButton(f"📈 Comparar {año_actual} vs {año_actual - 1}", callback_data=f"comparar|{año_actual}")])
     keyboard.append([InlineKeyboardButton("⬅ Volver", callback_data="menu|volver")])
 
     await query.edit_message_text(
@@ -769,155 +3074,1817 @@ async def start(update, context):
     logger.info(
         "Comando /start atendido | user_id=%s | lag_telegram=%.2fs | uptime=%.2fs | handler_ms=%.1f",
         user_id,
-        received_lag_seconds if received_lag_seconds is not None else -1,
-        uptime_seconds,
-        handler_elapsed_ms,
+        received_lag_seconds if received_lag_seconds is not None else -1,
+        uptime_seconds,
+        handler_elapsed_ms,
+    )
+
+# =========================
+# ESTADÍSTICAS
+# =========================
+
+STATS_MAX_RUTAS = 20
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[k]
+
+
+def formatear_duracion(segundos):
+    segundos = int(segundos)
+    dias, segundos = divmod(segundos, 86400)
+    horas, segundos = divmod(segundos, 3600)
+    minutos, segundos = divmod(segundos, 60)
+    if dias:
+        return f"{dias}d {horas}h {minutos}m"
+    if horas:
+        return f"{horas}h {minutos}m"
+    return f"{minutos}m {segundos}s"
+
+
+def _lineas_cache(nombre, datos, loaded_at, now):
+    metricas = _metricas_cache[nombre]
+    accesos = metricas["hits"] + metricas["misses"]
+    ratio = f"{metricas['hits'] / accesos:.0%}" if accesos else "-"
+    tamaño = len(datos) if datos is not None else 0
+    edad = f"{now - loaded_at:.0f}s" if datos is not None else "-"
+    return f"{nombre[:16]:16} | {tamaño:5} | {edad:>6} | {ratio:>4} ({metricas['hits']}/{accesos})"
+
+
+def contar_filas_espejo():
+    if _registro_db is None:
+        return None
+    with _registro_lock:
+        return _registro_db.execute("SELECT COUNT(*) FROM registro").fetchone()[0]
+
+
+def contar_almacen():
+    """(sesiones, cachés) guardadas en el almacén, o None si no se puede consultar."""
+    almacen = get_almacen()
+    try:
+        return almacen.contar("sesion"), almacen.contar("cache")
+    except sqlite3.Error as e:
+        logger.warning("No se pudo contar el contenido del almacén: %s", e)
+        return None
+
+
+def generar_estadisticas(filas_espejo=None, cola_updates=None, cuentas_almacen=None):
+    now = time.monotonic()
+    uptime = time.time() - PROCESS_STARTED_AT
+    minutos_activo = max(uptime / 60, 1 / 60)
+
+    lineas = [
+        f"Uptime: {formatear_duracion(uptime)}",
+        f"Sesiones activas: {len(user_states)}",
+        f"Almacén: {ALMACEN_BACKEND} | "
+        + (f"{cuentas_almacen[0]} sesiones | {cuentas_almacen[1]} cachés" if cuentas_almacen else "sin datos"),
+        "",
+        "Cachés (tamaño | edad | hit ratio)",
+        _lineas_cache("LISTAS", _listas_cache["data"], _listas_cache["loaded_at"], now),
+    ]
+    for persona in TRABAJO_SPREADSHEETS:
+        cache = _trabajo_casas_cache.get(persona, {})
+        lineas.append(_lineas_cache(
+            f"Casas {persona}",
+            cache.get("data"),
+            cache.get("loaded_at", 0.0),
+            now,
+        ))
+
+    if filas_espejo is not None:
+        lineas += [
+            "",
+            f"Espejo REGISTRO: {filas_espejo} filas | sync hace "
+            f"{formatear_duracion(now - _registro_estado['ultima_sync'])}",
+            f"Filas del bot: {_registro_estado['filas_bot']} | por sync: {_registro_estado['filas_sync']} | "
+            f"correcciones: {_registro_estado['correcciones']}",
+        ]
+
+    media_telegram_ms = _metricas_telegram["ms_total"] / max(_metricas_telegram["llamadas"], 1)
+    lineas += [
+        "",
+        f"Telegram: {_metricas_telegram['llamadas']} llamadas | {_metricas_telegram['errores']} errores | "
+        f"{media_telegram_ms:.0f} ms de media",
+        f"Interfaz: {_metricas_ui['ediciones']} ediciones | {_metricas_ui['reenvios']} reenvíos",
+        f"Ahorro: {_metricas_ui['llamadas_ahorradas']} llamadas | {_metricas_ui['esperas_ahorradas']} esperas "
+        f"(~{_metricas_ui['esperas_ahorradas'] * media_telegram_ms / 1000:.1f} s)",
+        f"Duplicados suprimidos: {_metricas_duplicados['updates']} updates | "
+        f"{_metricas_duplicados['escrituras']} escrituras | "
+        f"{_metricas_duplicados['sin_comprobar']} sin comprobar",
+        f"RetryAfter: {_metricas_cola_telegram['retry_after']} "
+        f"({_metricas_cola_telegram['segundos_retry_after']:.0f} s en pausa)",
+    ]
+    esperas_usuario = _metricas_updates["espera_usuario_ms"]
+    esperas_cola = _metricas_updates["espera_cola_ms"]
+    en_cola = cola_updates.qsize() if cola_updates is not None else 0
+    lineas += [
+        f"Updates: {_metricas_updates['en_curso']} en curso (máx {_metricas_updates['max_en_curso']}) | "
+        f"espera por usuario p95 {percentil(esperas_usuario, 95):.0f} ms | {_metricas_updates['fallos']} fallos",
+        f"Cola updates: {en_cola} en cola (máx {_metricas_updates['max_en_cola']}/{COLA_UPDATES_MAX}) | "
+        f"espera p95 {percentil(esperas_cola, 95):.0f} ms | {_metricas_updates['esperas_cola_llena']} veces llena",
+    ]
+    for prioridad, nombre in NOMBRES_PRIORIDAD.items():
+        esperas = _metricas_cola_telegram["espera_ms"][prioridad]
+        lineas.append(
+            f"Cola {nombre:11} | {len(esperas):4} | p50 {percentil(esperas, 50):5.0f} ms | "
+            f"p95 {percentil(esperas, 95):5.0f} ms"
+        )
+
+    if _credentials is not None:
+        lineas.append(
+            f"Token OAuth: {_metricas_token['refrescos']} refrescos ({_metricas_token['en_handler']} en handler) | "
+            f"{_metricas_token['errores']} errores | p95 {percentil(_metricas_token['ms'], 95):.0f} ms | "
+            f"caduca en {formatear_duracion(max(segundos_para_caducar(_credentials), 0))}"
+        )
+
+    recientes = [error for ts, error in _metricas_sheets["recientes"] if now - ts <= 60]
+    lineas += [
+        "",
+        "Sheets",
+        f"Último minuto: {len(recientes)} llamadas | {sum(recientes)} errores",
+        f"Media: {_metricas_sheets['llamadas'] / minutos_activo:.1f} llamadas/min | "
+        f"{_metricas_sheets['errores'] / minutos_activo:.2f} errores/min",
+        f"Total: {_metricas_sheets['llamadas']} llamadas | {_metricas_sheets['errores']} errores",
+    ]
+
+    if _latencias_ruta:
+        lineas += ["", f"{'Ruta (ms)':24} | {'n':4} | {'p50':6} | {'p95':6} | {'p99':6}"]
+        rutas = sorted(_latencias_ruta.items(), key=lambda kv: -percentil(kv[1], 95))
+        for ruta, valores in rutas[:STATS_MAX_RUTAS]:
+            nombre = ruta.replace("esperando_", "")
+            lineas.append(
+                f"{nombre[:24]:24} | {len(valores):4} | {percentil(valores, 50):6.0f} | "
+                f"{percentil(valores, 95):6.0f} | {percentil(valores, 99):6.0f}"
+            )
+
+    return "📊 Estadísticas del bot\n\n```\n" + "\n".join(lineas) + "\n```"
+
+
+async def stats(update, context):
+    if not await verificar_autorizacion(update, context):
+        return
+
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⛔ Solo el administrador puede ver las estadísticas.")
+        return
+
+    filas_espejo = await en_hilo(contar_filas_espejo)
+    cuentas_almacen = await en_hilo(contar_almacen)
+    await update.message.reply_text(
+        generar_estadisticas(filas_espejo, context.application.update_queue, cuentas_almacen),
+        parse_mode="Markdown",
+    )
+
+# =========================
+# RESUMEN
+# =========================
+
+# Prefijo de las hojas "… : gráficos y datos" de cada cuenta.
+CUENTAS_RESUMEN = {
+    "Ramon": "Cuenta Ramon",
+    "Claudia": "Cuenta Claudia",
+    "Común": "Cuenta común",
+}
+
+# Opción del selector que junta las tres cuentas en un solo mensaje.
+RESUMEN_TODOS = "Todos"
+
+# Con RESUMEN_COMPARAR_LECTURA=1 cada resumen descarga además las hojas
+# completas y registra la diferencia de payload y latencia frente a la
+# lectura por rangos.
+RESUMEN_COMPARAR_LECTURA = env_bool("RESUMEN_COMPARAR_LECTURA")
+
+
+def _letra_columna(indice):
+    """Índice 0-based → letra A1 (0 → A, 13 → N)."""
+    letras = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+
+def _rango_hoja(titulo, a1):
+    return "'" + titulo.replace("'", "''") + "'!" + a1
+
+
+def hojas_resumen(persona, año):
+    prefijo = CUENTAS_RESUMEN[persona]
+    return f"{prefijo}: gráficos y datos {año}", f"{prefijo}: gráficos y datos del mes actual"
+
+
+def rangos_resumen(persona, año, mes):
+    """Rangos mínimos del resumen: categorías + columna del mes (o N) y, por mes, objetivos A y C."""
+    hoja_datos, hoja_objetivos = hojas_resumen(persona, año)
+
+    columna = _letra_columna(13 if mes is None else mes)  # Enero=1 → B, total → N
+    rangos = [
+        _rango_hoja(hoja_datos, "A2:A"),
+        _rango_hoja(hoja_datos, f"{columna}2:{columna}"),
+    ]
+    if mes is not None:
+        rangos += [
+            _rango_hoja(hoja_objetivos, "A2:A"),
+            _rango_hoja(hoja_objetivos, "C2:C"),
+        ]
+    return rangos
+
+
+def leer_columnas_resumen(personas, año, mes):
+    """Lee en un único batch_get los rangos del resumen de cada persona.
+
+    Devuelve {persona: [columna, ...]} en el orden de ``rangos_resumen``.
+    """
+    ensure_google_sheets_ready()
+
+    rangos_por_persona = {persona: rangos_resumen(persona, año, mes) for persona in personas}
+    rangos = [r for rangos_persona in rangos_por_persona.values() for r in rangos_persona]
+
+    with medir_sheets() as medicion:
+        respuesta = spreadsheet.values_batch_get(
+            rangos,
+            params={"valueRenderOption": "UNFORMATTED_VALUE", "majorDimension": "COLUMNS"},
+        )
+
+    columnas = [
+        (value_range.get("values") or [[]])[0]
+        for value_range in respuesta.get("valueRanges", [])
+    ]
+
+    logger.info(
+        "Resumen %s %s/%s | lectura por rangos: %d rangos | %dB | %.1f ms",
+        ",".join(personas), mes or "total", año, len(rangos),
+        medicion["bytes_recibidos"], medicion["ms"],
+    )
+    if RESUMEN_COMPARAR_LECTURA:
+        comparar_lectura_resumen(personas, año, medicion)
+
+    resultado = {}
+    i = 0
+    for persona, rangos_persona in rangos_por_persona.items():
+        resultado[persona] = columnas[i:i + len(rangos_persona)]
+        i += len(rangos_persona)
+    return resultado
+
+
+def comparar_lectura_resumen(personas, año, medicion_rangos):
+    """Descarga las hojas completas (como antes) solo para registrar la diferencia."""
+    with medir_sheets() as medicion:
+        for persona in personas:
+            for titulo in hojas_resumen(persona, año):
+                spreadsheet.worksheet(titulo).get_all_values(value_render_option="UNFORMATTED_VALUE")
+
+    logger.info(
+        "Resumen %s %s | hojas completas: %dB en %.1f ms | rangos: %dB en %.1f ms | ahorro %.0f%% payload",
+        ",".join(personas), año,
+        medicion["bytes_recibidos"], medicion["ms"],
+        medicion_rangos["bytes_recibidos"], medicion_rangos["ms"],
+        100 * (1 - medicion_rangos["bytes_recibidos"] / medicion["bytes_recibidos"]) if medicion["bytes_recibidos"] else 0,
+    )
+
+
+def calcular_tabla_resumen(columnas, mes):
+    """Filas (categoría, objetivo, real) con algún importe distinto de cero."""
+    categorias, valores = columnas[0], columnas[1]
+    reales = parse_columna_importes(valores)
+
+    objetivos_por_categoria = {}
+    if mes is not None:
+        categorias_obj, valores_obj = columnas[2], columnas[3]
+        importes_objetivo = parse_columna_importes(valores_obj)
+        for categoria_obj, objetivo in zip(categorias_obj, importes_objetivo):
+            objetivos_por_categoria.setdefault(str(categoria_obj).strip().lower(), objetivo)
+
+    tabla = []
+
+    for categoria, real in itertools.zip_longest(categorias, reales, fillvalue=""):
+
+        categoria = str(categoria).strip()
+        real = real or 0.0
+        objetivo = objetivos_por_categoria.get(categoria.lower(), 0)
+
+        if real == 0 and objetivo == 0:
+            continue
+
+        tabla.append((categoria, objetivo, real))
+
+    return tabla
+
+
+def formatear_resumen(persona, año, mes, tabla):
+    """Líneas del resumen de una cuenta, listas para ``enviar_paginado``."""
+    titulo = f"📊 {persona} - {año}"
+    if mes:
+        titulo += f" - Mes {mes}"
+    else:
+        titulo += " - TOTAL"
+    lineas = [titulo, ""]
+
+    if not tabla:
+        return lineas + ["No hay datos para este periodo."]
+
+    lineas.append("```")
+
+    if mes is not None:
+        lineas.append(f"{'Categoría':20} | {'Objetivo':10} | {'Real':10} | {'Uso':15}")
+        lineas.append("-"*65)
+    else:
+        lineas.append(f"{'Categoría':20} | {'Real':10}")
+        lineas.append("-"*40)
+
+    for categoria, objetivo, real in tabla:
+
+        categoria_txt = categoria[:20]
+
+        if mes is not None:
+
+            if objetivo > 0:
+                uso_txt = generar_barra(real, objetivo)
+            else:
+                uso_txt = "-"
+
+            lineas.append(f"{categoria_txt:20} | {round(objetivo,2):10} | {round(real,2):10} | {uso_txt:15}")
+
+        else:
+            lineas.append(f"{categoria_txt:20} | {round(real,2):10}")
+
+    lineas.append("```")
+    return lineas
+
+
+async def generar_resumen(query, año, mes, persona):
+    logger.info("Resumen | persona=%s | año=%s | mes=%s", persona, año, mes)
+
+    if persona == RESUMEN_TODOS:
+        personas = list(CUENTAS_RESUMEN)
+    elif persona in CUENTAS_RESUMEN:
+        personas = [persona]
+    else:
+        await query.edit_message_text("Persona no válida.")
+        return
+
+    # Una sola lectura para todas las cuentas; las tablas se calculan en paralelo.
+    columnas = await en_hilo(leer_columnas_resumen, personas, año, mes)
+    tablas = await asyncio.gather(*(
+        en_hilo(calcular_tabla_resumen, columnas[p], mes)
+        for p in personas
+    ))
+
+    if not any(tablas):
+        await query.edit_message_text("No hay datos para este periodo.")
+        return
+
+    # ================= CREAR TABLA =================
+
+    lineas = []
+    for p, tabla in zip(personas, tablas):
+        if lineas:
+            lineas.append("")
+        lineas += formatear_resumen(p, año, mes, tabla)
+
+    await enviar_paginado(
+        query.edit_message_text,
+        lineas,
+        filas_extra=[[InlineKeyboardButton("⬅ Volver", callback_data="menu|volver")]],
+        parse_mode="Markdown",
+    )
+    logger.debug("Resumen enviado | persona=%s | %d líneas", persona, len(lineas))
+
+
+def get_objetivos_mes_actual():
+    ensure_google_sheets_ready()
+
+    hoja_obj = spreadsheet.worksheet("Cuenta común: gráficos y datos del mes actual")
+    filas = hoja_obj.get_all_values(value_render_option="UNFORMATTED_VALUE")
+
+    objetivos = {}
+
+    for row in filas[1:]:
+        try:
+            categoria = str(row[0]).strip()
+            objetivo = row[2]   # Columna C
+            real = row[3]       # Columna D
+
+            if not categoria:
+                continue
+
+            objetivo = parse_importe(objetivo, estricto=True) if objetivo != "" else 0
+            real = parse_importe(real, estricto=True) if real != "" else 0
+
+            objetivos[categoria] = {
+                "objetivo": objetivo,
+                "real": real
+            }
+
+        except (IndexError, ValueError, AttributeError) as e:
+            logger.warning("Fila de objetivos inválida y omitida: %s", e)
+            continue
+
+    return objetivos
+
+
+
+# =========================
+# COMPARATIVA ANUAL
+# =========================
+
+# Copia local por columnas de las hojas "Cuenta …: gráficos y datos {año}".
+# Los años cerrados ya no cambian: se leen una vez y se guardan en disco; el
+# año en curso solo vive en memoria y se refresca cada ANUAL_CACHE_SECONDS.
+ANUAL_CACHE_DIR = os.path.join(LOCAL_CACHE_DIR, "anual")
+ANUAL_CACHE_SECONDS = 300
+_anual_cache = {}
+
+TITULOS_CACHE_SECONDS = 3600
+_titulos_cache = {
+    "data": None,
+    "expires_at": 0.0,
+    "loaded_at": 0.0,
+}
+
+MESES_CORTOS = ["Ene", "Feb", "Mar", "Abr", "May", "Jun", "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"]
+
+
+def get_titulos_hojas():
+    ensure_google_sheets_ready()
+
+    now = time.monotonic()
+    if _titulos_cache["data"] is not None and now < _titulos_cache["expires_at"]:
+        return _titulos_cache["data"]
+
+    data = {hoja.title for hoja in spreadsheet.worksheets()}
+    _titulos_cache["data"] = data
+    _titulos_cache["expires_at"] = now + TITULOS_CACHE_SECONDS
+    _titulos_cache["loaded_at"] = now
+    return data
+
+
+def _ruta_cache_anual(persona, año):
+    return os.path.join(ANUAL_CACHE_DIR, f"{normalizar_texto(CUENTAS_RESUMEN[persona])}_{año}.json")
+
+
+def _columnas_anuales(columnas):
+    """Columnas crudas A..N → {"categorias": [...], "importes": [[B], ..., [N]]}."""
+    categorias = [str(c).strip() for c in (columnas[0] if columnas else [])]
+    importes = []
+    for i in range(1, 14):
+        valores = parse_columna_importes(columnas[i] if i < len(columnas) else [])
+        valores += [0.0] * (len(categorias) - len(valores))
+        importes.append(valores[:len(categorias)])
+    return {"categorias": categorias, "importes": importes}
+
+
+def get_datos_anuales(persona, años):
+    """Datos por columnas de cada año pedido ({año: datos}, o None si no hay hoja).
+
+    Lo que falta en memoria y en disco se pide en un único batch_get.
+    """
+    ensure_google_sheets_ready()
+
+    now = time.monotonic()
+    año_actual = datetime.now().year
+    metricas = _metricas_cache["Anual"]
+    resultado = {}
+    pendientes = []
+
+    for año in años:
+        entrada = _anual_cache.get((persona, año))
+        if entrada is not None and now < entrada["expires_at"]:
+            metricas["hits"] += 1
+            resultado[año] = entrada["data"]
+            continue
+
+        if año < año_actual:
+            datos = leer_json_local(_ruta_cache_anual(persona, año))
+            if datos is not None:
+                metricas["hits"] += 1
+                _anual_cache[(persona, año)] = {"data": datos, "expires_at": float("inf"), "loaded_at": now}
+                resultado[año] = datos
+                continue
+
+        metricas["misses"] += 1
+        pendientes.append(año)
+
+    titulos = get_titulos_hojas() if pendientes else set()
+    a_descargar = []
+    for año in pendientes:
+        hoja_datos, _ = hojas_resumen(persona, año)
+        if hoja_datos in titulos:
+            a_descargar.append(año)
+        else:
+            resultado[año] = None
+
+    if a_descargar:
+        rangos = [_rango_hoja(hojas_resumen(persona, año)[0], "A2:N") for año in a_descargar]
+        respuesta = spreadsheet.values_batch_get(
+            rangos,
+            params={"valueRenderOption": "UNFORMATTED_VALUE", "majorDimension": "COLUMNS"},
+        )
+
+        for año, value_range in zip(a_descargar, respuesta.get("valueRanges", [])):
+            datos = _columnas_anuales(value_range.get("values", []))
+            cerrado = año < año_actual
+            _anual_cache[(persona, año)] = {
+                "data": datos,
+                "expires_at": float("inf") if cerrado else now + ANUAL_CACHE_SECONDS,
+                "loaded_at": now,
+            }
+            if cerrado:
+                guardar_json_local(_ruta_cache_anual(persona, año), datos)
+            resultado[año] = datos
+
+    return resultado
+
+
+def serie_categoria(datos, categoria):
+    """Importes de Enero..Diciembre + total de una categoría (ceros si no existe ese año)."""
+    if datos is None:
+        return None
+    clave = categoria.strip().lower()
+    for i, nombre in enumerate(datos["categorias"]):
+        if nombre.lower() == clave:
+            return [columna[i] for columna in datos["importes"]]
+    return [0.0] * 13
+
+
+def categorias_comparables(persona, año):
+    datos = get_datos_anuales(persona, [año, año - 1])
+    nombres = []
+    vistos = set()
+    for datos_año in (datos[año], datos[año - 1]):
+        if datos_año is None:
+            continue
+        for i, nombre in enumerate(datos_año["categorias"]):
+            if nombre and nombre.lower() not in vistos and datos_año["importes"][12][i] != 0:
+                vistos.add(nombre.lower())
+                nombres.append(nombre)
+    return nombres
+
+
+def formatear_comparativa(persona, categoria, año, actual, anterior):
+    lineas = [
+        f"📈 {persona} - {categoria}: {año} vs {año - 1}",
+        "",
+        "```",
+        f"{'Mes':5} | {año:>10} | {año - 1:>10} | {'Δ':>10}",
+        "-" * 44,
+    ]
+
+    for i, nombre_mes in enumerate(MESES_CORTOS + ["Total"]):
+        if i == 12:
+            lineas.append("-" * 44)
+        diferencia = actual[i] - anterior[i]
+        lineas.append(f"{nombre_mes:5} | {round(actual[i], 2):10} | {round(anterior[i], 2):10} | {round(diferencia, 2):+10}")
+
+    lineas.append("```")
+    return "\n".join(lineas)
+
+
+async def mostrar_comparativa_personas(query, año):
+    keyboard = [
+        [InlineKeyboardButton(persona, callback_data=f"comparar_persona|{año}|{persona}")]
+        for persona in CUENTAS_RESUMEN
+    ]
+    keyboard.append([InlineKeyboardButton("⬅ Volver", callback_data="menu|resumen")])
+
+    await query.edit_message_text(
+        f"📈 Comparar {año} con {año - 1}\n\n👤 ¿Qué cuenta?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def mostrar_comparativa_categorias(query, año, persona):
+    categorias = await en_hilo(categorias_comparables, persona, año)
+
+    if not categorias:
+        await query.edit_message_text(
+            "No hay datos para comparar.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅ Volver", callback_data=f"comparar|{año}")]])
+        )
+        return
+
+    # Los botones llevan el índice (el nombre puede no caber en callback_data):
+    # se guarda con la cuenta y el año a los que corresponde la lista.
+    user_states.setdefault(query.from_user.id, {})["comparar_categorias"] = (año, persona, categorias)
+
+    botones = [
+        InlineKeyboardButton(nombre[:30], callback_data=f"comparar_cat|{año}|{persona}|{i}")
+        for i, nombre in enumerate(categorias)
+    ]
+    keyboard = [botones[i:i + 2] for i in range(0, len(botones), 2)]
+    keyboard.append([InlineKeyboardButton("⬅ Volver", callback_data=f"comparar|{año}")])
+
+    await query.edit_message_text(
+        f"📈 {persona}: {año} vs {año - 1}\n\n📂 Elige categoría:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+
+async def generar_comparativa(query, año, persona, indice):
+    guardadas = user_states.get(query.from_user.id, {}).get("comparar_categorias")
+    if guardadas and guardadas[:2] == (año, persona):
+        categorias = guardadas[2]
+    else:
+        categorias = await en_hilo(categorias_comparables, persona, año)
+    if indice >= len(categorias):
+        await query.edit_message_text("Categoría no válida.")
+        return
+
+    categoria = categorias[indice]
+    datos = await en_hilo(get_datos_anuales, persona, [año, año - 1])
+    actual = serie_categoria(datos[año], categoria)
+    anterior = serie_categoria(datos[año - 1], categoria)
+
+    if actual is None or anterior is None:
+        await query.edit_message_text(f"No existe la hoja de {año if actual is None else año - 1}.")
+        return
+
+    keyboard = [[
+        InlineKeyboardButton("⬅ Categorías", callback_data=f"comparar_persona|{año}|{persona}"),
+        InlineKeyboardButton("🏠 Menú", callback_data="menu|volver"),
+    ]]
+
+    await query.edit_message_text(
+        formatear_comparativa(persona, categoria, año, actual, anterior),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+
+
+
+# =========================
+# BUSCAR
+# =========================
+
+BUSCAR_POR_PAGINA = 10
+
+AYUDA_BUSCAR = (
+    "🔎 Uso: /buscar [texto] [filtros]\n\n"
+    "Filtros:\n"
+    "• desde:01/03/2026  hasta:31/03/2026\n"
+    "• mes:marzo  mes:3/2025\n"
+    "• persona:Común  pagador:Ramon  tipo:Gasto\n"
+    "• cat:Salud  sub:Farmacia\n"
+    "• min:10  max:50,5 (importe)\n\n"
+    "El texto libre busca en categoría, subcategorías y observación "
+    "(sin tildes ni mayúsculas). Usa comillas para valores con espacios: "
+    "cat:\"Cuidado personal\".\n\n"
+    "Ejemplo: /buscar farmacia mes:marzo persona:Común"
+)
+
+_ALIAS_FILTROS_BUSCAR = {
+    "desde": "desde",
+    "hasta": "hasta",
+    "mes": "mes",
+    "persona": "persona",
+    "pagador": "pagador",
+    "tipo": "tipo",
+    "cat": "categoria",
+    "categoria": "categoria",
+    "sub": "sub",
+    "min": "importe_min",
+    "minimo": "importe_min",
+    "max": "importe_max",
+    "maximo": "importe_max",
+}
+
+
+def _fecha_busqueda(valor):
+    fecha = _fecha_iso(valor)
+    try:
+        datetime.strptime(fecha, "%Y-%m-%d")
+    except ValueError as e:
+        raise ValueError(f"Fecha no válida: {valor}") from e
+    return fecha
+
+
+def _mes_busqueda(valor):
+    """"marzo", "mar", "3", "3/2025" o "marzo/2025" → (primer día, último día) ISO."""
+    nombre, _, año = valor.partition("/")
+    año = int(año) if año.strip() else datetime.now().year
+
+    if nombre.strip().isdigit():
+        mes = int(nombre)
+    else:
+        prefijo = normalizar_texto(nombre)[:3]
+        cortos = [normalizar_texto(m) for m in MESES_CORTOS]
+        mes = cortos.index(prefijo) + 1 if prefijo in cortos else 0
+
+    if not 1 <= mes <= 12:
+        raise ValueError(f"Mes no válido: {valor}")
+
+    inicio = datetime(año, mes, 1)
+    fin = datetime(año + mes // 12, mes % 12 + 1, 1) - timedelta(days=1)
+    return inicio.strftime("%Y-%m-%d"), fin.strftime("%Y-%m-%d")
+
+
+def parse_busqueda(texto):
+    """Argumentos de /buscar → filtros. Lanza ValueError si alguno no es válido."""
+    try:
+        tokens = shlex.split(texto)
+    except ValueError:
+        tokens = texto.split()
+
+    filtros = {"texto": []}
+    for token in tokens:
+        clave, separador, valor = token.partition(":")
+        campo = _ALIAS_FILTROS_BUSCAR.get(normalizar_texto(clave)) if separador else None
+
+        if campo is None:
+            if normalizar_texto(token):
+                filtros["texto"].append(normalizar_texto(token))
+            continue
+        if not valor.strip():
+            raise ValueError(f"Falta el valor de {clave}:")
+
+        if campo in ("desde", "hasta"):
+            filtros[campo] = _fecha_busqueda(valor)
+        elif campo == "mes":
+            filtros["desde"], filtros["hasta"] = _mes_busqueda(valor)
+        elif campo in ("importe_min", "importe_max"):
+            try:
+                filtros[campo] = parse_importe(valor, estricto=True)
+            except ValueError as e:
+                raise ValueError(f"Importe no válido: {valor}") from e
+        else:
+            filtros[campo] = normalizar_texto(valor)
+
+    return filtros
+
+
+def _condiciones_busqueda(filtros):
+    condiciones = []
+    parametros = []
+
+    if filtros.get("desde"):
+        condiciones.append("fecha >= ?")
+        parametros.append(filtros["desde"])
+    if filtros.get("hasta"):
+        condiciones.append("fecha <= ?")
+        parametros.append(filtros["hasta"])
+    if filtros.get("importe_min") is not None:
+        condiciones.append("importe >= ?")
+        parametros.append(filtros["importe_min"])
+    if filtros.get("importe_max") is not None:
+        condiciones.append("importe <= ?")
+        parametros.append(filtros["importe_max"])
+
+    for campo in ("persona", "pagador", "tipo", "categoria"):
+        if filtros.get(campo):
+            condiciones.append(f"{campo}_norm = ?")
+            parametros.append(filtros[campo])
+
+    if filtros.get("sub"):
+        condiciones.append("(sub1_norm = ? OR sub2_norm = ? OR sub3_norm = ?)")
+        parametros += [filtros["sub"]] * 3
+
+    # El índice de trigramas necesita al menos tres letras por término; los
+    # más cortos (y todos, sin FTS5) se filtran con LIKE sobre lo que quede.
+    get_registro_db()
+    terminos = filtros.get("texto", [])
+    indexados = [t for t in terminos if len(t) >= 3] if _registro_estado["fts"] else []
+    if indexados:
+        condiciones.append("fila IN (SELECT rowid FROM registro_fts WHERE registro_fts MATCH ?)")
+        parametros.append(" AND ".join(f'"{t}"' for t in indexados))
+    for termino in terminos:
+        if termino not in indexados:
+            condiciones.append("texto_norm LIKE ?")
+            parametros.append(f"%{termino}%")
+
+    return " AND ".join(condiciones) or "1", parametros
+
+
+def buscar_registro(filtros, pagina=0):
+    """(total, suma, filas de la página) de los movimientos del espejo que cumplen los filtros."""
+    where, parametros = _condiciones_busqueda(filtros)
+
+    total, suma = consultar_registro(
+        f"SELECT COUNT(*), COALESCE(SUM(importe), 0) FROM registro WHERE {where}",
+        parametros,
+    )[0]
+    filas = consultar_registro(
+        f"SELECT fecha, persona, pagador, tipo, categoria, sub1, sub2, sub3, observacion, importe "
+        f"FROM registro WHERE {where} ORDER BY fecha DESC, fila DESC LIMIT ? OFFSET ?",
+        parametros + [BUSCAR_POR_PAGINA, pagina * BUSCAR_POR_PAGINA],
+    )
+    return total, suma, filas
+
+
+def formatear_busqueda(total, suma, filas, pagina, ms):
+    if not total:
+        return "🔎 Sin resultados."
+
+    paginas = (total + BUSCAR_POR_PAGINA - 1) // BUSCAR_POR_PAGINA
+    lineas = [
+        f"🔎 {total} movimientos | Total: {formatear_importe(suma)}",
+        f"Página {pagina + 1}/{paginas} · {ms:.0f} ms",
+        "",
+    ]
+    # Las páginas van por filas (la navegación es por OFFSET), así que cada
+    # movimiento tiene su parte del límite de Telegram: lo que no cabe (una
+    # observación larga, sobre todo) se recorta.
+    por_fila = (PAGINA_MAX_CHARS - len("\n".join(lineas))) // BUSCAR_POR_PAGINA
+
+    for fecha, persona, pagador, tipo, categoria, sub1, sub2, sub3, observacion, importe in filas:
+        try:
+            fecha_txt = datetime.strptime(fecha, "%Y-%m-%d").strftime("%d/%m/%Y")
+        except ValueError:
+            fecha_txt = fecha
+        ruta = " › ".join(c for c in (categoria, sub1, sub2, sub3) if c and c != "—")
+        bloque = [
+            f"📅 {fecha_txt} · {persona}/{pagador} · {tipo}",
+            f"   {ruta} · {formatear_importe(importe)}",
+        ]
+        if observacion and observacion != "—":
+            bloque.append(f"   📝 {observacion}")
+        texto = "\n".join(bloque)
+        if len(texto) >= por_fila:
+            texto = texto[:por_fila - 2] + "…"
+        lineas.append(texto)
+
+    return "\n".join(lineas)
+
+
+async def enviar_pagina_busqueda(user_id, pagina, responder):
+    filtros = user_states.get(user_id, {}).get("busqueda")
+    if filtros is None:
+        await responder("🔎 La búsqueda ha caducado. Lánzala de nuevo con /buscar.")
+        return
+
+    t0 = time.perf_counter()
+    total, suma, filas = await en_hilo(buscar_registro, filtros, pagina)
+    ms = (time.perf_counter() - t0) * 1000
+    logger.info("Búsqueda | user_id=%s | %d resultados | página %d | %.1f ms", user_id, total, pagina, ms)
+
+    paginas = (total + BUSCAR_POR_PAGINA - 1) // BUSCAR_POR_PAGINA
+    navegacion = []
+    if pagina > 0:
+        navegacion.append(InlineKeyboardButton("⬅ Anterior", callback_data=f"buscar_pag|{pagina - 1}"))
+    if pagina + 1 < paginas:
+        navegacion.append(InlineKeyboardButton("Siguiente ➡", callback_data=f"buscar_pag|{pagina + 1}"))
+    keyboard = [navegacion] if navegacion else []
+
+    await responder(
+        formatear_busqueda(total, suma, filas, pagina, ms),
+        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None,
+    )
+
+
+async def buscar(update, context):
+    if not await verificar_autorizacion(update, context):
+        return
+
+    user_id = update.effective_user.id
+    texto = " ".join(context.args or [])
+    if not texto.strip():
+        await update.message.reply_text(AYUDA_BUSCAR)
+        return
+
+    try:
+        filtros = parse_busqueda(texto)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_BUSCAR}")
+        return
+
+    user_states.setdefault(user_id, {})["busqueda"] = filtros
+    await enviar_pagina_busqueda(user_id, 0, update.message.reply_text)
+
+
+# =========================
+# ALTA RÁPIDA (/g)
+# =========================
+
+# Un movimiento en una línea, resuelto contra el índice de LISTAS y guardado
+# con un solo toque de confirmación.
+AYUDA_ALTA_RAPIDA = (
+    "⚡ Uso: /g [fecha] persona [pagador] categoría… importe [observación]\n\n"
+    "• fecha: hoy (por defecto), ayer, anteayer, 15/03 o 15/03/2026\n"
+    "• categoría: una o varias palabras de la categoría y subcategorías, "
+    "aunque sea abreviadas o con erratas\n"
+    "• todo lo que va después del importe es la observación\n\n"
+    "Ejemplo: /g ayer Ramon Común Comida Supermercado 23,40 cena"
+)
+
+# Parecido mínimo de cada palabra con alguna parte de la categoría.
+ALTA_RAPIDA_UMBRAL = 0.6
+ALTA_RAPIDA_MAX_OPCIONES = 6
+
+
+def _fecha_alta_rapida(token):
+    """Fecha DD/MM/YYYY del token, o None si no es una fecha."""
+    hoy = datetime.now()
+    relativas = {"hoy": 0, "ayer": 1, "anteayer": 2}
+    if normalizar_texto(token) in relativas:
+        return (hoy - timedelta(days=relativas[normalizar_texto(token)])).strftime("%d/%m/%Y")
+
+    partes = token.split("/")
+    if not 2 <= len(partes) <= 3 or not all(p.isdigit() for p in partes):
+        return None
+    if len(partes) == 2:
+        partes.append(str(hoy.year))
+    elif len(partes[2]) == 2:
+        partes[2] = "20" + partes[2]
+    try:
+        return datetime(int(partes[2]), int(partes[1]), int(partes[0])).strftime("%d/%m/%Y")
+    except ValueError as e:
+        raise ValueError(f"Fecha no válida: {token}") from e
+
+
+def nombre_por_prefijo(token, nombres):
+    """Nombre de ``nombres`` al que se refiere ``token`` (completo o su inicio)."""
+    en = normalizar_texto(token)
+    if not en:
+        return None
+    for nombre in nombres:
+        if normalizar_texto(nombre) == en:
+            return nombre
+    if len(en) >= 3:
+        coincidencias = [n for n in nombres if normalizar_texto(n).startswith(en)]
+        if len(coincidencias) == 1:
+            return coincidencias[0]
+    return None
+
+
+def rutas_parecidas(terminos, indice):
+    """Rutas de LISTAS que mejor encajan con ``terminos``, empatadas en cabeza.
+
+    Cada término se compara una vez con cada texto distinto del índice. Una
+    ruta vale la media del mejor parecido de cada término con alguna de sus
+    partes; a igual valor gana la que deja menos partes sin nombrar.
+    """
+    parecidos = []
+    for termino in terminos:
+        en = normalizar_texto(termino)
+        # Entre dos textos que contienen el término gana el que empieza por él:
+        # "merca" es Mercadona antes que Supermercado.
+        parecidos.append({
+            valor: score_normalizado(en, ca, ac) + (0.01 if ca != en and ca.startswith(en) else 0)
+            for valor, (ca, ac) in indice["claves"].items()
+        })
+
+    ranking = []
+    for ruta in indice["rutas"]:
+        partes = [p for p in ruta if p != "—"]
+        elegidas = [max(partes, key=parecido.__getitem__) for parecido in parecidos]
+        mejores = [parecido[p] for parecido, p in zip(parecidos, elegidas)]
+        if min(mejores) < ALTA_RAPIDA_UMBRAL:
+            continue
+        ranking.append((round(sum(mejores) / len(mejores), 2), len(set(elegidas)) - len(partes), ruta))
+
+    if not ranking:
+        return []
+    ranking.sort(key=lambda x: (-x[0], -x[1], x[2]))
+    cabeza = ranking[0][:2]
+    return [ruta for *orden, ruta in ranking if tuple(orden) == cabeza][:ALTA_RAPIDA_MAX_OPCIONES]
+
+
+def parse_alta_rapida(texto, indice):
+    """Argumentos de /g → (movimiento, rutas candidatas). ValueError si falta algo."""
+    try:
+        tokens = shlex.split(texto)
+    except ValueError:
+        tokens = texto.split()
+
+    movimiento = {"fecha": datetime.now().strftime("%d/%m/%Y"), "observacion": ""}
+    nombres = []
+    terminos = []
+    for posicion, token in enumerate(tokens):
+        fecha = _fecha_alta_rapida(token)
+        if fecha is not None:
+            movimiento["fecha"] = fecha
+            continue
+        try:
+            importe = parse_importe(token, estricto=True)
+        except ValueError:
+            importe = None
+        if importe is not None:
+            if importe <= 0:
+                raise ValueError("Importe no válido.")
+            movimiento["importe"] = importe
+            resto = tokens[posicion + 1:]
+            if resto and resto[0] == "€":
+                resto = resto[1:]
+            movimiento["observacion"] = " ".join(resto)
+            break
+        nombre = None
+        if len(nombres) < 2:
+            nombre = nombre_por_prefijo(token, list(dict.fromkeys(indice["personas"] + indice["pagadores"])))
+        if nombre is not None:
+            nombres.append(nombre)
+        else:
+            terminos.append(token)
+
+    if "importe" not in movimiento:
+        raise ValueError("Falta el importe.")
+    if not nombres:
+        raise ValueError("Falta de quién es el gasto.")
+
+    # Persona y pagador en el orden escrito; si no encajan, al revés.
+    persona, pagador = (nombres + nombres)[:2] if len(nombres) == 1 else nombres
+    if persona not in indice["personas"] or pagador not in indice["pagadores"]:
+        persona, pagador = pagador, persona
+    if persona not in indice["personas"]:
+        raise ValueError(f"{persona} no es una persona de LISTAS.")
+    if pagador not in indice["pagadores"]:
+        raise ValueError("Falta quién paga." if len(nombres) == 1 else f"{pagador} no es un pagador de LISTAS.")
+    movimiento["persona"] = persona
+    movimiento["pagador"] = pagador
+
+    if not terminos:
+        raise ValueError("Falta la categoría.")
+    rutas = rutas_parecidas(terminos, indice)
+    if not rutas:
+        raise ValueError(f"No encuentro ninguna categoría parecida a «{' '.join(terminos)}».")
+    return movimiento, rutas
+
+
+def movimiento_con_ruta(movimiento, ruta):
+    tipo, categoria, sub1, sub2, sub3 = ruta
+    return dict(movimiento, tipo=tipo, categoria=categoria, sub1=sub1, sub2=sub2, sub3=sub3)
+
+
+def texto_ruta(ruta):
+    return " › ".join(p for p in ruta[1:] if p != "—")
+
+
+def texto_alta_rapida(movimiento, rutas):
+    mensaje = (
+        "⚡ Alta rápida\n\n"
+        f"Fecha: {movimiento['fecha']}\n"
+        f"Persona: {movimiento['persona']}\n"
+        f"Pagador: {movimiento['pagador']}\n"
+    )
+    if len(rutas) == 1:
+        mensaje += f"Tipo: {rutas[0][0]}\nCategoría: {texto_ruta(rutas[0])}\n"
+    mensaje += (
+        f"Observación: {movimiento['observacion'] or '—'}\n"
+        f"Importe: {formatear_importe(movimiento['importe'])}"
+    )
+    if len(rutas) > 1:
+        mensaje += "\n\nElige la categoría para guardarlo:"
+    return mensaje
+
+
+def teclado_alta_rapida(rutas):
+    if len(rutas) == 1:
+        keyboard = [[InlineKeyboardButton("✅ Guardar", callback_data="rapido|0")]]
+    else:
+        keyboard = [
+            [InlineKeyboardButton(f"{texto_ruta(ruta)} ({ruta[0]})", callback_data=f"rapido|{idx}")]
+            for idx, ruta in enumerate(rutas)
+        ]
+    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def alta_rapida(update, context):
+    if not await verificar_autorizacion(update, context):
+        return
+
+    user_id = update.effective_user.id
+    texto = " ".join(context.args or [])
+    if not texto.strip():
+        await update.message.reply_text(AYUDA_ALTA_RAPIDA)
+        return
+
+    t0 = time.perf_counter()
+    indice = await en_hilo(get_indice_taxonomia)
+    try:
+        movimiento, rutas = parse_alta_rapida(texto, indice)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_ALTA_RAPIDA}")
+        return
+    logger.info(
+        "Alta rápida | user_id=%s | %d opciones | %.1f ms",
+        user_id, len(rutas), (time.perf_counter() - t0) * 1000,
+    )
+
+    reiniciar_estado(user_id)
+    user_states[user_id].update({
+        "history": [],
+        "flujo_id": nuevo_id_flujo(),
+        "rapido": movimiento,
+        "rapido_rutas": rutas,
+    })
+    await actualizar_mensaje_flujo(
+        update,
+        context,
+        user_id,
+        texto_alta_rapida(movimiento, rutas),
+        reply_markup=teclado_alta_rapida(rutas),
+    )
+
+
+async def confirmar_alta_rapida(query, context, user_id, opcion):
+    estado = user_states.get(user_id, {})
+    rutas = estado.get("rapido_rutas")
+    if not rutas or not 0 <= opcion < len(rutas):
+        await query.edit_message_text("⚡ Este alta rápida ha caducado. Lánzala de nuevo con /g.")
+        return
+
+    data = movimiento_con_ruta(estado["rapido"], rutas[opcion])
+    importe = data["importe"]
+    if not await en_hilo(guardar_movimiento, user_id, data, importe):
+        await query.edit_message_text("ℹ️ Este movimiento ya estaba guardado; no se ha repetido.")
+        return
+
+    reiniciar_estado(user_id)
+    await context.bot.send_message(chat_id=query.message.chat_id, text=texto_movimiento_guardado(data, importe))
+    await desplazar_menu_al_final(
+        context,
+        user_id,
+        "💰 Gestión de dinero",
+        teclado_menu_gestion(),
     )
 
+
 # =========================
-# RESUMEN
+# IMPORTAR CSV
 # =========================
 
-async def generar_resumen(query, año, mes, persona):
-    ensure_google_sheets_ready()
+# Un CSV enviado como documento se lee fila a fila dos veces: una para
+# validarlo y enseñar el resumen, y otra, tras confirmar, para escribirlo en
+# REGISTRO por lotes de IMPORTAR_CSV_LOTE filas (una llamada a Sheets cada uno).
+IMPORTAR_CSV_DIR = os.path.join(LOCAL_CACHE_DIR, "importaciones")
+IMPORTAR_CSV_LOTE = int(os.environ.get("IMPORTAR_CSV_LOTE", 2000))
+IMPORTAR_CSV_MAX_ERRORES = 10
+# Límite de descarga de la Bot API.
+IMPORTAR_CSV_MAX_BYTES = 20 * 1024 * 1024
+# Un CSV pendiente de confirmar que nadie confirma ni cancela (el usuario se
+# fue por otro menú o el proceso se reinició) se borra pasado este tiempo.
+IMPORTAR_CSV_CADUCIDAD_SECONDS = int(os.environ.get("IMPORTAR_CSV_CADUCIDAD_SECONDS", 24 * 3600))
+
+AYUDA_IMPORTAR_CSV = (
+    "📥 Envía un .csv con cabecera y estas columnas (en cualquier orden):\n"
+    "Fecha, Persona, Pagador, Tipo, Categoría, Importe y, opcionales, "
+    "Sub1, Sub2, Sub3 y Observación.\n\n"
+    "Fechas DD/MM/YYYY o YYYY-MM-DD; importes como 1.234,56 o 1234.56. "
+    "Separador coma, punto y coma o tabulador."
+)
+
+_COLUMNAS_CSV = {
+    "fecha": "fecha",
+    "persona": "persona",
+    "pagador": "pagador",
+    "tipo": "tipo",
+    "categoria": "categoria",
+    "sub1": "sub1",
+    "sub2": "sub2",
+    "sub3": "sub3",
+    "observacion": "observacion",
+    "obs": "observacion",
+    "importe": "importe",
+}
+_COLUMNAS_CSV_OBLIGATORIAS = ("fecha", "persona", "pagador", "tipo", "categoria", "importe")
+_FORMATOS_FECHA_CSV = ("%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y")
 
-    print("=== RESUMEN NUEVO ===")
-    print("Persona:", persona, "Año:", año, "Mes:", mes)
 
-    # ================= SELECCIÓN DE HOJAS =================
+def _codificacion_csv(ruta):
+    """utf-8 si todo el fichero lo es; si no, latin-1 (exportaciones de bancos)."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(ruta, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                decoder.decode(bloque)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return "latin-1"
+    return "utf-8-sig"
+
+
+# Separadores aceptados, en orden de preferencia, y líneas que se miran para elegirlo.
+CSV_SEPARADORES = ";\t|,"
+CSV_MUESTRA_LINEAS = 20
+
+
+def filas_csv(f, columnas, obligatorias, orden=None):
+    """Genera (número de línea, {campo: valor}) de ``f``, un fichero de texto abierto.
+
+    La cabecera elige las columnas por nombre (claves de ``columnas``). Con
+    ``orden``, si la primera línea no parece una cabecera, es ya un dato y
+    las columnas van en ese orden. Lanza ValueError si falta alguna obligatoria.
+    """
+    # El separador lo deduce csv.Sniffer de las primeras líneas, así no lo
+    # engañan una cabecera sin separadores ni un primer campo entre comillas
+    # con ; o , dentro. A igualdad, el punto y coma, porque la coma también es
+    # el separador decimal. Si no lo deduce, el que aparece en más líneas de
+    # la muestra.
+    muestra = "".join(itertools.islice(f, CSV_MUESTRA_LINEAS))
+    f.seek(0)
+    sniffer = csv.Sniffer()
+    sniffer.preferred = list(CSV_SEPARADORES)
+    try:
+        separador = sniffer.sniff(muestra, delimiters=CSV_SEPARADORES).delimiter
+    except csv.Error:
+        lineas = muestra.splitlines()
+        separador = max(
+            CSV_SEPARADORES,
+            key=lambda c: (sum(c in linea for linea in lineas), muestra.count(c), -CSV_SEPARADORES.index(c)),
+        )
+    lector = csv.reader(f, delimiter=separador)
+
+    primera = next(lector, [])
+    campos = [columnas.get(normalizar_texto(c)) for c in primera]
+    sin_cabecera = orden is not None and sum(c is not None for c in campos) < 2
+    if sin_cabecera:
+        campos = list(orden)
+    faltan = [c for c in obligatorias if c not in campos]
+    if faltan:
+        raise ValueError(f"Faltan columnas en la cabecera: {', '.join(faltan)}")
+
+    lineas = itertools.chain(
+        [(lector.line_num, primera)] if sin_cabecera else [],
+        ((lector.line_num, valores) for valores in lector),
+    )
+    for numero, valores in lineas:
+        if not any(v.strip() for v in valores):
+            continue
+        yield numero, {
+            campo: valor.strip()
+            for campo, valor in zip(campos, valores)
+            if campo is not None
+        }
 
-    if persona == "Común":
-        hoja_datos = spreadsheet.worksheet(f"Cuenta común: gráficos y datos {año}")
-        hoja_objetivos = spreadsheet.worksheet("Cuenta común: gráficos y datos del mes actual")
 
-    elif persona == "Claudia":
-        hoja_datos = spreadsheet.worksheet(f"Cuenta Claudia: gráficos y datos {año}")
-        hoja_objetivos = spreadsheet.worksheet("Cuenta Claudia: gráficos y datos del mes actual")
+def leer_csv(ruta):
+    """Líneas del CSV de movimientos, sin cargar el fichero entero."""
+    with open(ruta, newline="", encoding=_codificacion_csv(ruta)) as f:
+        yield from filas_csv(f, _COLUMNAS_CSV, _COLUMNAS_CSV_OBLIGATORIAS)
 
-    elif persona == "Ramon":
-        hoja_datos = spreadsheet.worksheet(f"Cuenta Ramon: gráficos y datos {año}")
-        hoja_objetivos = spreadsheet.worksheet("Cuenta Ramon: gráficos y datos del mes actual")
 
-    else:
-        await query.edit_message_text("Persona no válida.")
-        return
+# Los valores de un extracto se repiten mucho (fechas, personas, categorías):
+# normalizarlos una vez por valor y no una vez por fila.
+@functools.lru_cache(maxsize=4096)
+def _clave_csv(valor):
+    return normalizar_texto(valor)
 
-    datos = hoja_datos.get_all_values()[1:]
-    objetivos = hoja_objetivos.get_all_values()[1:]
 
-    if mes is None:
-        col_index = 13  # Columna N (total)
-    else:
-        col_index = mes  # Enero=1 → Columna B
+@functools.lru_cache(maxsize=4096)
+def _fecha_csv(valor):
+    for formato in _FORMATOS_FECHA_CSV:
+        try:
+            return datetime.strptime(valor, formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise ValueError(f"fecha no válida «{valor}»")
 
-    tabla = []
 
-    for row in datos:
+def fila_csv_a_registro(campos, indice):
+    """Fila de REGISTRO para ``campos`` de una línea del CSV. ValueError si no es válida."""
+    fecha = _fecha_csv(campos.get("fecha", ""))
+    try:
+        importe = parse_importe(campos.get("importe", ""), estricto=True)
+    except ValueError as e:
+        raise ValueError(f"importe no válido «{campos.get('importe', '')}»") from e
+    if importe <= 0:
+        raise ValueError("el importe debe ser positivo (el signo lo da el tipo)")
+
+    nombres = {}
+    for campo, validos in (("persona", indice["personas_por_clave"]), ("pagador", indice["pagadores_por_clave"])):
+        valor = campos.get(campo, "")
+        nombres[campo] = validos.get(_clave_csv(valor))
+        if nombres[campo] is None:
+            raise ValueError(f"{campo} «{valor}» no está en LISTAS")
+
+    clave = tuple(
+        _clave_csv(campos.get(campo, ""))
+        for campo in ("tipo", "categoria", "sub1", "sub2", "sub3")
+    )
+    ruta = indice["por_ruta"].get(clave)
+    if ruta is None:
+        texto = " › ".join(campos.get(c, "") for c in ("tipo", "categoria", "sub1", "sub2", "sub3") if campos.get(c))
+        raise ValueError(f"categoría que no está en LISTAS «{texto}»")
+
+    return [fecha, nombres["persona"], nombres["pagador"], *ruta, campos.get("observacion", ""), importe]
 
-        if len(row) <= col_index:
+
+def analizar_csv(ruta):
+    """Valida el CSV entero en una pasada y devuelve el resumen para confirmar."""
+    indice = get_indice_taxonomia()
+    resumen = {"filas": 0, "validas": 0, "total": 0.0, "desde": None, "hasta": None, "errores": []}
+    num_errores = 0
+    for linea, campos in leer_csv(ruta):
+        resumen["filas"] += 1
+        try:
+            fila = fila_csv_a_registro(campos, indice)
+        except ValueError as e:
+            num_errores += 1
+            if len(resumen["errores"]) < IMPORTAR_CSV_MAX_ERRORES:
+                resumen["errores"].append(f"línea {linea}: {e}")
+            continue
+        resumen["validas"] += 1
+        resumen["total"] += fila[9]
+        resumen["desde"] = min(resumen["desde"] or fila[0], fila[0])
+        resumen["hasta"] = max(resumen["hasta"] or fila[0], fila[0])
+    resumen["num_errores"] = num_errores
+    return resumen
+
+
+def importar_csv(user_id, ruta):
+    """Escribe las filas válidas en REGISTRO por lotes. Devuelve (filas, lotes escritos).
+
+    Cada lote tiene su clave de idempotencia: si la importación se corta y se
+    repite, los lotes ya escritos no se duplican.
+    """
+    indice = get_indice_taxonomia()
+    escritas = 0
+    lotes = 0
+
+    def escribir(numero, lote):
+        with escritura_unica(user_id, f"REGISTRO-csv{numero}") as nueva:
+            if nueva:
+                respuesta = sheet.append_rows(lote, value_input_option="USER_ENTERED")
+                registrar_filas_en_espejo(respuesta, lote)
+        return nueva
+
+    lote = []
+    numero = 0
+    for _, campos in leer_csv(ruta):
+        try:
+            lote.append(fila_csv_a_registro(campos, indice))
+        except ValueError:
             continue
+        if len(lote) >= IMPORTAR_CSV_LOTE:
+            if escribir(numero, lote):
+                escritas += len(lote)
+                lotes += 1
+            numero += 1
+            lote = []
+    if lote and escribir(numero, lote):
+        escritas += len(lote)
+        lotes += 1
+    return escritas, lotes
+
+
+def texto_resumen_csv(nombre, resumen):
+    mensaje = f"📥 {nombre}\n\n{resumen['filas']} filas | ✅ {resumen['validas']} válidas"
+    if resumen["num_errores"]:
+        mensaje += f" | ❌ {resumen['num_errores']} con errores (no se importarán)"
+    if resumen["validas"]:
+        desde = datetime.strptime(resumen["desde"], "%Y-%m-%d").strftime("%d/%m/%Y")
+        hasta = datetime.strptime(resumen["hasta"], "%Y-%m-%d").strftime("%d/%m/%Y")
+        mensaje += f"\nDel {desde} al {hasta} | Total: {formatear_importe(resumen['total'])}"
+    if resumen["errores"]:
+        mensaje += "\n\nErrores:\n" + "\n".join(f"• {e}" for e in resumen["errores"])
+        if resumen["num_errores"] > len(resumen["errores"]):
+            mensaje += f"\n… y {resumen['num_errores'] - len(resumen['errores'])} más"
+    return mensaje
 
-        categoria = row[0].strip()
-        real = limpiar_importe(row[col_index])
 
-        objetivo = 0
+def borrar_importacion(user_id):
+    ruta = user_states.get(user_id, {}).pop("importar_csv", None)
+    if ruta:
+        with contextlib.suppress(OSError):
+            os.remove(ruta)
 
-        if mes is not None:
-            for obj_row in objetivos:
-                if obj_row[0].strip().lower() == categoria.lower():
-                    objetivo = limpiar_importe(obj_row[2])
-                    break
 
-        if real == 0 and objetivo == 0:
+def limpiar_ficheros_csv(user_id=None, conservar=None):
+    """Borra los CSV de importación y exportación caducados.
+
+    Con ``user_id`` borra además todas las importaciones pendientes de ese
+    usuario salvo ``conservar``: solo puede tener una a la vez, y la anterior
+    puede haberse quedado sin referencia si salió del flujo por otro menú.
+    """
+    limite = time.time() - IMPORTAR_CSV_CADUCIDAD_SECONDS
+    prefijo = f"{user_id}-" if user_id is not None else None
+    borrados = 0
+    for directorio in (IMPORTAR_CSV_DIR, EXPORTAR_DIR):
+        try:
+            nombres = os.listdir(directorio)
+        except FileNotFoundError:
             continue
+        for nombre in nombres:
+            ruta = os.path.join(directorio, nombre)
+            if ruta == conservar:
+                continue
+            with contextlib.suppress(OSError):
+                propio = prefijo is not None and directorio == IMPORTAR_CSV_DIR and nombre.startswith(prefijo)
+                if propio or os.path.getmtime(ruta) < limite:
+                    os.remove(ruta)
+                    borrados += 1
+    return borrados
 
-        tabla.append((categoria, objetivo, real))
 
-    if not tabla:
-        await query.edit_message_text("No hay datos para este periodo.")
+async def recibir_csv(update, context):
+    if not await verificar_autorizacion(update, context):
         return
 
-    # ================= CREAR TABLA =================
+    user_id = update.effective_user.id
+    documento = update.message.document
+    if documento.file_size and documento.file_size > IMPORTAR_CSV_MAX_BYTES:
+        await update.message.reply_text("❌ El fichero supera los 20 MB que deja descargar Telegram.")
+        return
 
-    mensaje = f"📊 {persona} - {año}"
-    if mes:
-        mensaje += f" - Mes {mes}"
-    else:
-        mensaje += " - TOTAL"
-    mensaje += "\n\n"
+    os.makedirs(IMPORTAR_CSV_DIR, exist_ok=True)
+    ruta = os.path.join(IMPORTAR_CSV_DIR, f"{user_id}-{uuid.uuid4().hex}.csv")
+    # El fichero solo se queda en disco si la importación queda pendiente de
+    # confirmar; cualquier otro final (incluido un error inesperado al
+    # analizarlo) lo borra.
+    pendiente = False
+    try:
+        fichero = await context.bot.get_file(documento.file_id)
+        await fichero.download_to_drive(ruta)
+
+        persona_promos = user_states.get(user_id, {}).get("trabajo_importar_persona")
+        if persona_promos:
+            try:
+                analisis = await en_hilo(analizar_promos_fichero, ruta, persona_promos)
+            except (ValueError, csv.Error) as e:
+                await update.message.reply_text(f"❌ {e}\n\n{AYUDA_IMPORTAR_PROMOS}")
+                return
+            await mostrar_resumen_promos(update, context, user_id, persona_promos, analisis)
+            return
 
-    mensaje += "```\n"
-    
-    if mes is not None:
-        mensaje += f"{'Categoría':20} | {'Objetivo':10} | {'Real':10} | {'Uso':15}\n"
-        mensaje += "-"*65 + "\n"
-    else:
-        mensaje += f"{'Categoría':20} | {'Real':10}\n"
-        mensaje += "-"*40 + "\n"
+        t0 = time.perf_counter()
+        try:
+            resumen = await en_hilo(analizar_csv, ruta)
+        except (ValueError, csv.Error) as e:
+            await update.message.reply_text(f"❌ {e}\n\n{AYUDA_IMPORTAR_CSV}")
+            return
+        logger.info(
+            "CSV analizado | user_id=%s | %d filas | %d válidas | %.1f ms",
+            user_id, resumen["filas"], resumen["validas"], (time.perf_counter() - t0) * 1000,
+        )
 
-    for categoria, objetivo, real in tabla:
+        borrar_importacion(user_id)
+        reiniciar_estado(user_id)
+        keyboard = []
+        if resumen["validas"]:
+            user_states[user_id].update({
+                "history": [],
+                "flujo_id": nuevo_id_flujo(),
+                "importar_csv": ruta,
+            })
+            pendiente = True
+            keyboard.append([
+                InlineKeyboardButton(f"✅ Importar {resumen['validas']} filas", callback_data="importar_csv|si")
+            ])
+        keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="importar_csv|no")])
+    finally:
+        if not pendiente:
+            with contextlib.suppress(OSError):
+                os.remove(ruta)
+
+    # Importaciones anteriores de este usuario que ya no se pueden confirmar
+    # y las caducadas de cualquiera.
+    await en_hilo(limpiar_ficheros_csv, user_id, ruta)
+
+    await actualizar_mensaje_flujo(
+        update,
+        context,
+        user_id,
+        texto_resumen_csv(documento.file_name or "CSV", resumen),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+    )
 
-        categoria_txt = categoria[:20]
-    
-        if mes is not None:
-    
-            if objetivo > 0:
-                uso_txt = generar_barra(real, objetivo)
-            else:
-                uso_txt = "-"
-    
-            mensaje += f"{categoria_txt:20} | {round(objetivo,2):10} | {round(real,2):10} | {uso_txt:15}\n"
-    
-        else:
-            mensaje += f"{categoria_txt:20} | {round(real,2):10}\n"
-    
-    mensaje += "```"
-    
-    keyboard = [[InlineKeyboardButton("⬅ Volver", callback_data="menu|volver")]]
-    
+
+async def confirmar_importar_csv(query, context, user_id, opcion):
+    ruta = user_states.get(user_id, {}).get("importar_csv")
+    if opcion != "si":
+        borrar_importacion(user_id)
+        reiniciar_estado(user_id)
+        await mostrar_menu(query)
+        return
+    if not ruta or not os.path.exists(ruta):
+        await query.edit_message_text("📥 Esta importación ha caducado. Vuelve a enviar el CSV.")
+        return
+
+    await query.edit_message_text("⏳ Importando…")
+    t0 = time.perf_counter()
+    escritas, lotes = await en_hilo(importar_csv, user_id, ruta)
+    logger.info(
+        "CSV importado | user_id=%s | %d filas | %d lotes | %.1f ms",
+        user_id, escritas, lotes, (time.perf_counter() - t0) * 1000,
+    )
+    borrar_importacion(user_id)
+    reiniciar_estado(user_id)
+
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=(
+            f"✅ {escritas} movimientos importados en REGISTRO."
+            if escritas else "ℹ️ Esta importación ya estaba hecha; no se ha repetido."
+        ),
+    )
+    await desplazar_menu_al_final(
+        context,
+        user_id,
+        "💰 Gestión de dinero",
+        teclado_menu_gestion(),
+    )
+
+
+# =========================
+# IMPORTAR PROMOS
+# =========================
+
+# Varias filas de PromosDone de golpe, pegadas como texto o en un CSV, en
+# vez de pasar cada una por el flujo de trabajo.
+PROMOS_CASA_UMBRAL = 0.8
+
+AYUDA_IMPORTAR_PROMOS = (
+    "📥 Pega las promos, una por línea, o envía un .csv. Columnas (separadas "
+    "por ; , tabulador o |):\n\n"
+    "promotor; fecha; casa; tipo bono; tipo promo; partido; pérdida; beneficio; "
+    "observaciones; observaciones finales\n\n"
+    "Las cinco primeras son obligatorias. Con una línea de cabecera con esos "
+    "nombres, las columnas pueden ir en cualquier orden.\n\n"
+    "Ejemplo: RCM; 15/03/2026; RETA; Recurrente; Freebet; Betis - Sevilla; -10; 25,5"
+)
+
+_COLUMNAS_PROMOS = {
+    "promotor": "promotor",
+    "fecha": "fecha",
+    "casa": "casa",
+    "tipobono": "tipo_bono",
+    "bono": "tipo_bono",
+    "tipopromo": "tipo_promo",
+    "promo": "tipo_promo",
+    "partido": "partido",
+    "perdida": "perdida",
+    "beneficio": "beneficio",
+    "observaciones": "observaciones",
+    "obs": "observaciones",
+    "observacionesfinales": "observaciones_finales",
+    "obsfinales": "observaciones_finales",
+}
+_ORDEN_PROMOS = (
+    "promotor", "fecha", "casa", "tipo_bono", "tipo_promo",
+    "partido", "perdida", "beneficio", "observaciones", "observaciones_finales",
+)
+_COLUMNAS_PROMOS_OBLIGATORIAS = _ORDEN_PROMOS[:5]
+
+
+def _importe_promo(campos, campo, nombre):
+    valor = campos.get(campo, "")
+    if not valor:
+        return ""
+    try:
+        return parse_importe(valor, estricto=True)
+    except ValueError as e:
+        raise ValueError(f"valor de {nombre} no válido «{valor}»") from e
+
+
+def fila_promo_importada(campos, persona, casas):
+    """Fila de PromosDone para ``campos`` de una línea. ValueError si no es válida."""
+    promotor = nombre_por_prefijo(campos.get("promotor", ""), TRABAJO_PROMOTORES[persona])
+    if promotor is None:
+        raise ValueError(f"promotor «{campos.get('promotor', '')}» no es de {persona}")
+
+    entrada_casa = campos.get("casa", "")
+    ranking = sorted(((score_casa(entrada_casa, casa), casa) for casa in casas), reverse=True)
+    if not ranking or ranking[0][0] < PROMOS_CASA_UMBRAL:
+        sugerencia = f" (¿{ranking[0][1]}?)" if ranking and ranking[0][0] >= 0.55 else ""
+        raise ValueError(f"casa «{entrada_casa}» no reconocida{sugerencia}")
+
+    tipos = {}
+    for campo, validos, nombre in (
+        ("tipo_bono", TRABAJO_TIPOS_BONO, "tipo de bono"),
+        ("tipo_promo", TRABAJO_TIPOS_PROMO, "tipo de promo"),
+    ):
+        tipos[campo] = nombre_por_prefijo(campos.get(campo, ""), validos)
+        if tipos[campo] is None:
+            raise ValueError(f"{nombre} «{campos.get(campo, '')}» no válido")
+
+    data = {
+        "trabajo_fecha": _fecha_csv(campos.get("fecha", "")),
+        "trabajo_casa": ranking[0][1],
+        "trabajo_tipo_bono": tipos["tipo_bono"],
+        "trabajo_tipo_promo": tipos["tipo_promo"],
+        "trabajo_observaciones": campos.get("observaciones", ""),
+        "trabajo_partido": campos.get("partido", ""),
+        "trabajo_perdida": _importe_promo(campos, "perdida", "pérdida"),
+        "trabajo_beneficio": _importe_promo(campos, "beneficio", "beneficio"),
+        "trabajo_observaciones_finales": campos.get("observaciones_finales", ""),
+    }
+    return fila_promos(data, promotor)
+
+
+def analizar_promos(f, persona):
+    """(filas válidas, número de líneas, errores) de las promos de ``f``."""
+    casas = obtener_casas_trabajo(persona)
+    filas = []
+    lineas = 0
+    errores = []
+    for numero, campos in filas_csv(f, _COLUMNAS_PROMOS, _COLUMNAS_PROMOS_OBLIGATORIAS, _ORDEN_PROMOS):
+        lineas += 1
+        try:
+            filas.append(fila_promo_importada(campos, persona, casas))
+        except ValueError as e:
+            errores.append(f"línea {numero}: {e}")
+    return filas, lineas, errores
+
+
+def analizar_promos_fichero(ruta, persona):
+    with open(ruta, newline="", encoding=_codificacion_csv(ruta)) as f:
+        return analizar_promos(f, persona)
+
+
+def texto_resumen_promos(persona, filas, lineas, errores):
+    mensaje = f"📥 Promos de {persona}\n\n{lineas} líneas | ✅ {len(filas)} válidas"
+    if errores:
+        mensaje += f" | ❌ {len(errores)} con errores (no se importarán)"
+    for fila in filas[:IMPORTAR_CSV_MAX_ERRORES]:
+        fecha = datetime.strptime(fila[1], "%Y-%m-%d").strftime("%d/%m/%Y")
+        mensaje += f"\n• {fila[0]} · {fecha} · {fila[2]} · {fila[4]}"
+    if len(filas) > IMPORTAR_CSV_MAX_ERRORES:
+        mensaje += f"\n… y {len(filas) - IMPORTAR_CSV_MAX_ERRORES} más"
+    if errores:
+        mensaje += "\n\nErrores:\n" + "\n".join(f"• {e}" for e in errores[:IMPORTAR_CSV_MAX_ERRORES])
+        if len(errores) > IMPORTAR_CSV_MAX_ERRORES:
+            mensaje += f"\n… y {len(errores) - IMPORTAR_CSV_MAX_ERRORES} más"
+    return mensaje
+
+
+async def pedir_importar_promos(query, user_id, persona):
+    reiniciar_estado(user_id)
+    user_states[user_id].update({
+        "history": [],
+        "flujo_id": nuevo_id_flujo(),
+        "trabajo_importar_persona": persona,
+    })
     await query.edit_message_text(
-        mensaje,
+        AYUDA_IMPORTAR_PROMOS,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")]]),
+    )
+
+
+async def mostrar_resumen_promos(update, context, user_id, persona, analisis):
+    filas, lineas, errores = analisis
+    keyboard = []
+    if filas:
+        user_states[user_id]["trabajo_importar_filas"] = filas
+        keyboard.append([
+            InlineKeyboardButton(f"✅ Importar {len(filas)} promos", callback_data="trabajo_importar_ok|si")
+        ])
+    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="cancelar")])
+    await actualizar_mensaje_flujo(
+        update,
+        context,
+        user_id,
+        texto_resumen_promos(persona, filas, lineas, errores),
         reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
     )
 
-    print("=== FIN RESUMEN ===")
 
+def guardar_promos_importadas(user_id, persona, filas):
+    """Escribe las promos importadas. Devuelve los bloques escritos o None si ya se habían guardado."""
+    with escritura_unica(user_id, "PromosDone") as nueva:
+        if nueva:
+            return escribir_filas_promos(trabajo_promos_sheets[persona], filas)
+    return None
 
 
-def get_objetivos_mes_actual():
-    ensure_google_sheets_ready()
+async def confirmar_importar_promos(query, context, user_id):
+    estado = user_states.get(user_id, {})
+    persona = estado.get("trabajo_importar_persona")
+    filas = estado.get("trabajo_importar_filas")
+    if not persona or not filas:
+        await query.edit_message_text("📥 Esta importación ha caducado. Vuelve a pegar las promos.")
+        return
 
-    hoja_obj = spreadsheet.worksheet("Cuenta común: gráficos y datos del mes actual")
-    filas = hoja_obj.get_all_values()
+    t0 = time.perf_counter()
+    bloques = await en_hilo(guardar_promos_importadas, user_id, persona, filas)
+    if bloques is None:
+        await query.edit_message_text("ℹ️ Estas promos ya estaban guardadas; no se han repetido.")
+        return
+    logger.info(
+        "Promos importadas | user_id=%s | %s | %d filas | %d bloques | %.1f ms",
+        user_id, persona, len(filas), bloques, (time.perf_counter() - t0) * 1000,
+    )
+    reiniciar_estado(user_id)
 
-    objetivos = {}
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=f"✅ {len(filas)} promos de {persona} guardadas en PromosDone.",
+    )
+    await desplazar_menu_al_final(
+        context,
+        user_id,
+        "💼 Trabajo",
+        teclado_menu_trabajo(),
+    )
 
-    for row in filas[1:]:
-        try:
-            categoria = row[0].strip()
-            objetivo = row[2].strip()   # Columna C
-            real = row[3].strip()       # Columna D
 
-            if not categoria:
-                continue
+# =========================
+# EXPORTAR CSV
+# =========================
 
-            objetivo = objetivo.replace("€","").replace(".","").replace(",",".")
-            real = real.replace("€","").replace(".","").replace(",",".")
-            
-            objetivo = float(objetivo) if objetivo else 0
-            real = float(real) if real else 0
+# /export lee el espejo de REGISTRO por páginas (en orden de fecha, desde la
+# última fila de la página anterior) y va escribiendo el CSV en disco: la
+# memoria no crece con el tamaño de la hoja.
+EXPORTAR_DIR = os.path.join(LOCAL_CACHE_DIR, "exportaciones")
+EXPORTAR_POR_LECTURA = 2000
+
+AYUDA_EXPORTAR = (
+    "📤 Uso: /export [filtros]\n\n"
+    "Envía un CSV con los movimientos de REGISTRO que cumplen los filtros "
+    "(los mismos que /buscar; sin filtros, todo el historial):\n"
+    "• desde:01/03/2026  hasta:31/03/2026\n"
+    "• mes:marzo  mes:3/2025\n"
+    "• persona:Común  pagador:Ramon  tipo:Gasto\n"
+    "• cat:Salud  sub:Farmacia\n"
+    "• min:10  max:50,5 (importe)\n\n"
+    "Ejemplo: /export mes:marzo persona:Común\n\n"
+    "El CSV tiene el mismo formato que acepta la importación."
+)
 
-            objetivos[categoria] = {
-                "objetivo": objetivo,
-                "real": real
-            }
+_RE_FECHA_ISO = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
-        except (IndexError, ValueError, AttributeError) as e:
-            logger.warning("Fila de objetivos inválida y omitida: %s", e)
-            continue
+_CABECERA_EXPORTAR = [
+    "Fecha", "Persona", "Pagador", "Tipo", "Categoría",
+    "Sub1", "Sub2", "Sub3", "Observación", "Importe",
+]
 
-    return objetivos
+
+def filas_exportacion(filtros):
+    """Genera las filas del espejo que cumplen ``filtros``, en orden de fecha."""
+    where, parametros = _condiciones_busqueda(filtros)
+    sincronizar_registro()
+
+    ultima_fecha, ultima_fila = "", 0
+    while True:
+        with _registro_lock:
+            pagina = get_registro_db().execute(
+                f"SELECT fecha, persona, pagador, tipo, categoria, sub1, sub2, sub3, observacion, importe, fila "
+                f"FROM registro WHERE ({where}) AND (fecha, fila) > (?, ?) "
+                f"ORDER BY fecha, fila LIMIT ?",
+                parametros + [ultima_fecha, ultima_fila, EXPORTAR_POR_LECTURA],
+            ).fetchall()
+        if not pagina:
+            return
+        for fila in pagina:
+            yield fila[:10]
+        ultima_fecha, ultima_fila = pagina[-1][0], pagina[-1][10]
+
+
+def exportar_registro(filtros, ruta):
+    """Escribe en ``ruta`` el CSV de los movimientos que cumplen ``filtros``. Devuelve (filas, total)."""
+    filas = 0
+    total = 0.0
+    with open(ruta, "w", newline="", encoding="utf-8-sig") as f:
+        escritor = csv.writer(f, delimiter=";")
+        escritor.writerow(_CABECERA_EXPORTAR)
+        for fecha, *textos, importe in filas_exportacion(filtros):
+            # El espejo guarda YYYY-MM-DD: se reordena sin pasar por strptime.
+            if _RE_FECHA_ISO.match(fecha or ""):
+                fecha = f"{fecha[8:10]}/{fecha[5:7]}/{fecha[:4]}"
+            escritor.writerow([fecha, *textos, f"{importe:.2f}".replace(".", ",")])
+            filas += 1
+            total += importe
+    return filas, total
+
+
+def nombre_exportacion(filtros):
+    partes = ["registro"]
+    if filtros.get("desde"):
+        partes.append(filtros["desde"])
+    if filtros.get("hasta"):
+        partes.append(filtros["hasta"])
+    for campo in ("persona", "pagador", "tipo", "categoria", "sub"):
+        if filtros.get(campo):
+            partes.append(filtros[campo])
+    return "_".join(partes) + ".csv"
+
+
+async def exportar(update, context):
+    if not await verificar_autorizacion(update, context):
+        return
+
+    user_id = update.effective_user.id
+    texto = " ".join(context.args or [])
+    try:
+        filtros = parse_busqueda(texto)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{AYUDA_EXPORTAR}")
+        return
+
+    os.makedirs(EXPORTAR_DIR, exist_ok=True)
+    ruta = os.path.join(EXPORTAR_DIR, f"{user_id}-{uuid.uuid4().hex}.csv")
+    try:
+        t0 = time.perf_counter()
+        filas, total = await en_hilo(exportar_registro, filtros, ruta)
+        logger.info(
+            "Exportación | user_id=%s | %d filas | %.1f ms",
+            user_id, filas, (time.perf_counter() - t0) * 1000,
+        )
+        if not filas:
+            await update.message.reply_text("📤 No hay movimientos con esos filtros.")
+            return
+        with open(ruta, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=nombre_exportacion(filtros),
+                caption=f"📤 {filas} movimientos | Total: {formatear_importe(total)}",
+            )
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(ruta)
 
 
 
@@ -943,6 +4910,7 @@ async def recibir_texto(update, context):
     if update.message:
         try:
             await update.message.delete()
+            retirar_posicion_chat(update.effective_chat.id, update.message.message_id)
         except BadRequest:
             pass
     
@@ -953,6 +4921,16 @@ async def recibir_texto(update, context):
     
     # ================= TRABAJO =================
 
+    persona_promos = user_states[user_id].get("trabajo_importar_persona")
+    if persona_promos:
+        try:
+            analisis = await en_hilo(analizar_promos, io.StringIO(texto), persona_promos)
+        except (ValueError, csv.Error) as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        await mostrar_resumen_promos(update, context, user_id, persona_promos, analisis)
+        return
+
     if user_states[user_id].get("trabajo_esperando_fecha_manual"):
         try:
             fecha = datetime.strptime(texto, "%d/%m/%Y")
@@ -974,7 +4952,9 @@ async def recibir_texto(update, context):
 
     if user_states[user_id].get("trabajo_esperando_casa_input"):
         persona = user_states[user_id]["trabajo_persona"]
-        sugerencias = buscar_casas_parecidas(persona, texto)
+        sugerencias = await desde_cache(
+            _trabajo_casas_cache.get(persona), buscar_casas_parecidas, persona, texto
+        )
         user_states[user_id]["trabajo_casa_sugerencias"] = sugerencias
 
         keyboard = [[InlineKeyboardButton(casa, callback_data=f"trabajo_casa_idx|{idx}")]
@@ -1030,7 +5010,7 @@ async def recibir_texto(update, context):
 
     if user_states[user_id].get("trabajo_esperando_perdida"):
         try:
-            valor = parse_numero_con_signo(texto)
+            valor = parse_importe(texto, estricto=True)
         except ValueError:
             await update.message.reply_text("❌ Valor de pérdida no válido.")
             return
@@ -1054,7 +5034,7 @@ async def recibir_texto(update, context):
 
     if user_states[user_id].get("trabajo_esperando_beneficio"):
         try:
-            valor = parse_numero_con_signo(texto)
+            valor = parse_importe(texto, estricto=True)
         except ValueError:
             await update.message.reply_text("❌ Valor de beneficio no válido.")
             return
@@ -1076,7 +5056,9 @@ async def recibir_texto(update, context):
         user_states[user_id]["trabajo_observaciones_finales"] = texto
         user_states[user_id]["trabajo_esperando_observaciones_finales"] = False
 
-        guardar_registro_trabajo(user_states[user_id])
+        if not await en_hilo(guardar_trabajo, user_id):
+            await update.message.reply_text("ℹ️ Este registro de trabajo ya estaba guardado; no se ha repetido.")
+            return
 
         resumen_guardado = (
             "✅ Registro de trabajo guardado en PromosDone.\n\n"
@@ -1140,7 +5122,7 @@ async def recibir_texto(update, context):
             await update.message.reply_text("❌ Fecha inválida. Usa DD/MM/YYYY")
             return
 
-        personas = get_personas_gasto()
+        personas = await desde_cache(_listas_cache, get_personas_gasto)
         keyboard = [[InlineKeyboardButton(p, callback_data=f"persona|{p}")]
                     for p in personas]
         keyboard.append(botones_navegacion())
@@ -1170,7 +5152,7 @@ async def recibir_texto(update, context):
     # IMPORTE
     if user_states[user_id].get("esperando_importe"):
         try:
-            importe = float(texto.replace(",", "."))
+            importe = parse_importe(texto, estricto=True)
             if importe <= 0:
                 raise ValueError
         except ValueError:
@@ -1179,32 +5161,10 @@ async def recibir_texto(update, context):
 
         data = user_states[user_id]
 
-        sheet.append_row([
-            formatear_fecha_para_sheet(data.get("fecha", "")),
-            data.get("persona", ""),
-            data.get("pagador", ""),
-            data.get("tipo", ""),
-            data.get("categoria", ""),
-            data.get("sub1", "—"),
-            data.get("sub2", "—"),
-            data.get("sub3", "—"),
-            data.get("observacion", ""),
-            importe
-        ], value_input_option="USER_ENTERED")
-        resumen_guardado = (
-            "✅ Movimiento guardado correctamente en Excel.\n\n"
-            f"Fecha: {data.get('fecha', '')}\n"
-            f"Persona: {data.get('persona', '')}\n"
-            f"Pagador: {data.get('pagador', '')}\n"
-            f"Tipo: {data.get('tipo', '')}\n"
-            f"Categoría: {data.get('categoria', '')}\n"
-            f"Sub1: {data.get('sub1', '—')}\n"
-            f"Sub2: {data.get('sub2', '—')}\n"
-            f"Sub3: {data.get('sub3', '—')}\n"
-            f"Observación: {data.get('observacion', '') or '—'}\n"
-            f"Importe: {importe}"
-        )
-        await update.message.reply_text(resumen_guardado)
+        if not await en_hilo(guardar_movimiento, user_id, data, importe):
+            await update.message.reply_text("ℹ️ Este movimiento ya estaba guardado; no se ha repetido.")
+            return
+        await update.message.reply_text(texto_movimiento_guardado(data, importe))
 
         await desplazar_menu_al_final(
             context,
@@ -1268,6 +5228,7 @@ async def button_handler(update, context):
         user_states[user_id] = {
             "history": [],
             "flujo": "trabajo",
+            "flujo_id": nuevo_id_flujo(),
             "trabajo_persona": persona,
             "ui_chat_id": query.message.chat_id,
             "ui_message_id": query.message.message_id,
@@ -1456,6 +5417,7 @@ async def button_handler(update, context):
         # 🔴 RESETEAR ESTADO COMPLETAMENTE
         user_states[user_id] = {
             "history": [],
+            "flujo_id": nuevo_id_flujo(),
             "ui_chat_id": query.message.chat_id,
             "ui_message_id": query.message.message_id,
         }
@@ -1484,6 +5446,7 @@ async def button_handler(update, context):
             [InlineKeyboardButton("Ramon", callback_data=f"resumen_final|{año}|{mes}|Ramon")],
             [InlineKeyboardButton("Claudia", callback_data=f"resumen_final|{año}|{mes}|Claudia")],
             [InlineKeyboardButton("Común", callback_data=f"resumen_final|{año}|{mes}|Común")],
+            [InlineKeyboardButton("👨‍👩‍👧 Todos", callback_data=f"resumen_final|{año}|{mes}|{RESUMEN_TODOS}")],
             [InlineKeyboardButton("⬅ Volver", callback_data="menu|resumen")]
         ]
     
@@ -1501,6 +5464,7 @@ async def button_handler(update, context):
             [InlineKeyboardButton("Ramon", callback_data=f"resumen_final|{año}|0|Ramon")],
             [InlineKeyboardButton("Claudia", callback_data=f"resumen_final|{año}|0|Claudia")],
             [InlineKeyboardButton("Común", callback_data=f"resumen_final|{año}|0|Común")],
+            [InlineKeyboardButton("👨‍👩‍👧 Todos", callback_data=f"resumen_final|{año}|0|{RESUMEN_TODOS}")],
             [InlineKeyboardButton("⬅ Volver", callback_data="menu|resumen")]
         ]
     
@@ -1511,6 +5475,57 @@ async def button_handler(update, context):
         return
 
 
+    # ================= PÁGINAS =================
+
+    if data.startswith("pag|"):
+        _, snapshot_id, pagina = data.split("|")
+        await mostrar_pagina(query, int(snapshot_id), int(pagina))
+        return
+
+    # ================= BUSCAR =================
+
+    if data.startswith("buscar_pag|"):
+        pagina = int(data.split("|")[1])
+        await enviar_pagina_busqueda(user_id, pagina, query.edit_message_text)
+        return
+
+    # ================= ALTA RÁPIDA =================
+
+    if data.startswith("rapido|"):
+        await confirmar_alta_rapida(query, context, user_id, int(data.split("|")[1]))
+        return
+
+    # ================= IMPORTAR CSV =================
+
+    if data.startswith("importar_csv|"):
+        await confirmar_importar_csv(query, context, user_id, data.split("|")[1])
+        return
+
+    if data.startswith("trabajo_importar|"):
+        await pedir_importar_promos(query, user_id, data.split("|")[1])
+        return
+
+    if data.startswith("trabajo_importar_ok|"):
+        await confirmar_importar_promos(query, context, user_id)
+        return
+
+    # ================= COMPARATIVA ANUAL =================
+
+    if data.startswith("comparar|"):
+        _, año = data.split("|")
+        await mostrar_comparativa_personas(query, int(año))
+        return
+
+    if data.startswith("comparar_persona|"):
+        _, año, persona = data.split("|")
+        await mostrar_comparativa_categorias(query, int(año), persona)
+        return
+
+    if data.startswith("comparar_cat|"):
+        _, año, persona, indice = data.split("|")
+        await generar_comparativa(query, int(año), persona, int(indice))
+        return
+
     # ================= RESUMEN FINAL =================
 
     if data.startswith("resumen_final|"):
@@ -1541,7 +5556,7 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["fecha"]=fecha
         
-        personas=get_personas_gasto()
+        personas = await desde_cache(_listas_cache, get_personas_gasto)
 
         keyboard=[[InlineKeyboardButton(p,callback_data=f"persona|{p}")]
                   for p in personas]
@@ -1560,7 +5575,7 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["persona"] = persona
 
-        pagadores = get_quien_paga()
+        pagadores = await desde_cache(_listas_cache, get_quien_paga)
 
         keyboard = [[InlineKeyboardButton(p, callback_data=f"pagador|{p}")]
                     for p in pagadores]
@@ -1584,7 +5599,7 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["pagador"] = pagador
 
-        tipos = get_tipos()
+        tipos = await desde_cache(_listas_cache, get_tipos)
 
         keyboard = [[InlineKeyboardButton(t, callback_data=f"tipo|{t}")]
                     for t in tipos]
@@ -1608,7 +5623,7 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["tipo"] = tipo
 
-        categorias = get_categorias(tipo)
+        categorias = await desde_cache(_listas_cache, get_categorias, tipo)
 
         keyboard = [[InlineKeyboardButton(c, callback_data=f"categoria|{c}")]
                     for c in categorias]
@@ -1632,7 +5647,7 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["categoria"] = categoria
 
-        sub1_list = get_sub1(user_states[user_id]["tipo"], categoria)
+        sub1_list = await desde_cache(_listas_cache, get_sub1, user_states[user_id]["tipo"], categoria)
 
         keyboard = [[InlineKeyboardButton(s, callback_data=f"sub1|{s}")]
                     for s in sub1_list]
@@ -1656,7 +5671,9 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["sub1"] = sub1
 
-        sub2_list = get_sub2(
+        sub2_list = await desde_cache(
+            _listas_cache,
+            get_sub2,
             user_states[user_id]["tipo"],
             user_states[user_id]["categoria"],
             sub1
@@ -1705,7 +5722,9 @@ async def button_handler(update, context):
         user_states[user_id]["history"].append(user_states[user_id].copy())
         user_states[user_id]["sub2"] = sub2
 
-        sub3_list = get_sub3(
+        sub3_list = await desde_cache(
+            _listas_cache,
+            get_sub3,
             user_states[user_id]["tipo"],
             user_states[user_id]["categoria"],
             user_states[user_id]["sub1"],
@@ -1858,90 +5877,98 @@ async def button_handler(update, context):
                 return
     
         if "sub3" in data_state:
+            sub3_list = await desde_cache(
+                _listas_cache,
+                get_sub3,
+                data_state["tipo"],
+                data_state["categoria"],
+                data_state["sub1"],
+                data_state["sub2"]
+            )
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\nSelecciona SUB3:",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(s, callback_data=f"sub3|{s}")]
-                     for s in get_sub3(
-                        data_state["tipo"],
-                        data_state["categoria"],
-                        data_state["sub1"],
-                        data_state["sub2"]
-                     )] + [botones_navegacion()]
+                     for s in sub3_list] + [botones_navegacion()]
                 )
             )
             return
     
         if "sub2" in data_state:
+            sub2_list = await desde_cache(
+                _listas_cache,
+                get_sub2,
+                data_state["tipo"],
+                data_state["categoria"],
+                data_state["sub1"]
+            )
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\nSelecciona SUB2:",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(s, callback_data=f"sub2|{s}")]
-                     for s in get_sub2(
-                        data_state["tipo"],
-                        data_state["categoria"],
-                        data_state["sub1"]
-                     )] + [botones_navegacion()]
+                     for s in sub2_list] + [botones_navegacion()]
                 )
             )
             return
     
         if "sub1" in data_state:
+            sub1_list = await desde_cache(_listas_cache, get_sub1, data_state["tipo"], data_state["categoria"])
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\nSelecciona SUB1:",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(s, callback_data=f"sub1|{s}")]
-                     for s in get_sub1(
-                        data_state["tipo"],
-                        data_state["categoria"]
-                     )] + [botones_navegacion()]
+                     for s in sub1_list] + [botones_navegacion()]
                 )
             )
             return
     
         if "categoria" in data_state:
+            categorias = await desde_cache(_listas_cache, get_categorias, data_state["tipo"])
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\nSelecciona CATEGORÍA:",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(c, callback_data=f"categoria|{c}")]
-                     for c in get_categorias(data_state["tipo"])] + [botones_navegacion()]
+                     for c in categorias] + [botones_navegacion()]
                 )
             )
             return
     
         if "tipo" in data_state:
+            tipos = await desde_cache(_listas_cache, get_tipos)
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\nSelecciona TIPO:",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(t, callback_data=f"tipo|{t}")]
-                     for t in get_tipos()] + [botones_navegacion()]
+                     for t in tipos] + [botones_navegacion()]
                 )
             )
             return
     
         if "pagador" in data_state:
+            pagadores = await desde_cache(_listas_cache, get_quien_paga)
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\n¿Quién paga?",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(p, callback_data=f"pagador|{p}")]
-                     for p in get_quien_paga()] + [botones_navegacion()]
+                     for p in pagadores] + [botones_navegacion()]
                 )
             )
             return
     
         if "persona" in data_state:
+            personas = await desde_cache(_listas_cache, get_personas_gasto)
             await query.edit_message_text(
                 resumen_parcial(data_state) +
                 "\n¿De quién es el gasto?",
                 reply_markup=InlineKeyboardMarkup(
                     [[InlineKeyboardButton(p, callback_data=f"persona|{p}")]
-                     for p in get_personas_gasto()] + [botones_navegacion()]
+                     for p in personas] + [botones_navegacion()]
                 )
             )
             return
@@ -2002,33 +6029,11 @@ async def button_handler(update, context):
         return
 
     if data == "lista|ver":
-    
-        mensaje = "🛒 LISTA DE LA COMPRA\n\n"
-    
-        for nombre, hoja in [
-            ("Carrefour", sheet_carrefour),
-            ("Mercadona", sheet_mercadona),
-            ("Sirena", sheet_sirena),
-            ("Otros", sheet_otros)
-        ]:
-    
-            productos = hoja.col_values(1)[1:]
-    
-            mensaje += f"📍 {nombre}\n"
-    
-            if productos:
-                for p in productos:
-                    mensaje += f"  • {p}\n"
-            else:
-                mensaje += "  (Vacío)\n"
-    
-            mensaje += "\n"
-    
-        keyboard = [[InlineKeyboardButton("⬅ Volver", callback_data="menu|lista")]]
-    
-        await query.edit_message_text(
-            mensaje,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+
+        await enviar_paginado(
+            query.edit_message_text,
+            lineas_lista_compra("🛒 LISTA DE LA COMPRA"),
+            filas_extra=[[InlineKeyboardButton("⬅ Volver", callback_data="menu|lista")]],
         )
         return
 
@@ -2185,7 +6190,7 @@ async def button_handler(update, context):
         for fila in sorted(estado["seleccionados"], reverse=True):
             hoja.delete_rows(fila)
     
-        user_states.pop(user_id)
+        reiniciar_estado(user_id)
     
         await query.answer("Productos eliminados ✅")
         await notificar_lista_actualizada(context, mover_menu=True)
@@ -2204,41 +6209,133 @@ async def button_handler(update, context):
 # REGISTRO DE HANDLERS
 # =========================
 
-application = ApplicationBuilder().token(TOKEN).build()
+def construir_application(request=None, procesador=None):
+    builder = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .rate_limiter(LimitadorTelegram())
+        .concurrent_updates(procesador or ProcesadorUpdates())
+        .update_queue(ColaUpdates())
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", trazar_update(start)))
+    app.add_handler(CommandHandler("stats", trazar_update(stats)))
+    app.add_handler(CommandHandler("buscar", trazar_update(buscar)))
+    app.add_handler(CommandHandler("g", trazar_update(alta_rapida)))
+    app.add_handler(CommandHandler("export", trazar_update(exportar)))
+    app.add_handler(CallbackQueryHandler(trazar_update(button_handler)))
+    app.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, trazar_update(recibir_texto))
+    )
+    app.add_handler(
+        MessageHandler(
+            filters.Document.FileExtension("csv") | filters.Document.MimeType("text/csv"),
+            trazar_update(recibir_csv),
+        )
+    )
+    return app
 
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CallbackQueryHandler(button_handler))
-application.add_handler(
-    MessageHandler(filters.TEXT & ~filters.COMMAND, recibir_texto)
-)
+
+_application = None
+
+
+def get_application():
+    global _application
+
+    if _application is None:
+        _application = construir_application()
+        marcar_fase_arranque("application")
+    return _application
+
+
+async def esperar_puerto_abierto(port, timeout=60):
+    fin = time.monotonic() + timeout
+    while time.monotonic() < fin:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.02)
+            continue
+        writer.close()
+        return True
+    return False
 
 
 async def warmup_caches(application):
+    marcar_fase_arranque("initialize (getMe)")
+
     async def _warmup_background():
-        loop = asyncio.get_running_loop()
+        global _tarea_token, _tarea_verificacion
+
+        # En modo webhook se espera a que el puerto esté escuchando para que la
+        # carga de gspread y las credenciales no compita con el arranque.
+        if BOT_RUN_MODE != "polling":
+            if await esperar_puerto_abierto(PORT):
+                marcar_fase_arranque("puerto abierto")
+                informe_arranque("puerto abierto")
+
         try:
-            await loop.run_in_executor(None, get_listas_data)
+            await en_hilo(get_listas_data)
             logger.info("Caché LISTAS precalentada")
         except Exception as e:
             logger.warning("No se pudo precalentar caché LISTAS: %s", e)
 
+        try:
+            await en_hilo(sincronizar_registro)
+        except Exception as e:
+            logger.warning("No se pudo sincronizar el espejo de REGISTRO: %s", e)
+
+        informe_arranque("cachés y espejo precalentados")
+
+        try:
+            borrados = await en_hilo(limpiar_ficheros_csv)
+            if borrados:
+                logger.info("CSV temporales caducados borrados: %d", borrados)
+        except Exception as e:
+            logger.warning("No se pudieron limpiar los CSV temporales: %s", e)
+
+        if _tarea_verificacion is None:
+            _tarea_verificacion = asyncio.create_task(mantener_registro_verificado())
+
+        # Solo con el cliente real: el backend en memoria no usa credenciales.
+        if _credentials is not None and _tarea_token is None:
+            _tarea_token = asyncio.create_task(mantener_token_fresco())
+
     asyncio.create_task(_warmup_background())
 
+
+async def informe_parada(application):
+    # Application.stop() deja de recibir y espera a que la cola se vacíe
+    # antes de llegar aquí: lo que Telegram ya tenía confirmado se ha atendido.
+    logger.info(
+        "Parada: cola de updates drenada (%d atendidos, %d pendientes, máx. en cola %d)",
+        _metricas_updates["atendidos"],
+        application.update_queue.qsize(),
+        _metricas_updates["max_en_cola"],
+    )
+
 # =========================
 # START APP
 # =========================
 
 if __name__ == "__main__":
+    application = get_application()
     if BOT_RUN_MODE == "polling":
         application.post_init = warmup_caches
+        application.post_stop = informe_parada
         logger.info("Iniciando bot en modo polling")
         application.run_polling(drop_pending_updates=True)
     else:
         application.post_init = warmup_caches
+        application.post_stop = informe_parada
         logger.info("Iniciando bot en modo webhook")
         application.run_webhook(
             listen="0.0.0.0",
             port=PORT,
             webhook_url=f"{WEBHOOK_BASE_URL}/{TOKEN}",
             url_path=TOKEN,
+            max_connections=WEBHOOK_MAX_CONEXIONES,
         )
@@ -0,0 +1,284 @@
+"""Prueba de estrés del procesado concurrente de updates.
+
+Encola de golpe, en la ``update_queue`` real de la Application, los toques de
+varios usuarios: uno pide resúmenes (lentos) y el resto mete gastos, cada
+gasto con una observación e importe únicos por usuario y ronda. Al terminar
+comprueba que el estado de sesión no se ha mezclado:
+
+- cada usuario tiene exactamente sus gastos, con su persona, su pagador y
+  su importe, en el espejo de REGISTRO;
+- la sesión final de cada usuario en ``user_states`` es la de su último gasto;
+- no ha habido errores en los handlers.
+
+Con ``--tasa-fallo-almacen`` una fracción de las llamadas del procesador al
+almacén (dedupe de updates y de escrituras, cerrojo y copia de la sesión)
+falla como un SQLite bloqueado; los updates se deben atender y los gastos
+guardar igualmente. Con
+``ALMACEN_BACKEND=sqlite`` se prueban también las de la sesión. Con
+``--tasa-fallo-procesador`` el procesador lanza una excepción después de
+atender una fracción de los updates: la cola tiene que vaciarse igualmente y
+devolver todos sus huecos en vuelo.
+
+También mide la latencia de cada update desde que entra en la cola.
+
+Modos (``--modo``):
+    usuario      ProcesadorUpdates: paralelo entre usuarios, en orden por usuario.
+    secuencial   un update detrás de otro (lo que hacía el bot antes).
+    sin-orden    paralelo sin cerrojo por usuario (debe detectar corrupción).
+
+Uso:
+    python stress_estado.py [--usuarios 6] [--rondas 5] [--modo usuario]
+                            [--latencia-sheets-ms 80] [--latencia-telegram-ms 40]
+                            [--variacion-telegram-ms 40] [--tasa-fallo-almacen 0]
+                            [--tasa-fallo-procesador 0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from datetime import date
+
+import benchmark
+
+PERSONAS = ["Común", "Ramon", "Claudia"]
+PAGADORES = ["Ramon", "Claudia"]
+
+
+def pasos_gasto(user_id, ronda, indice):
+    persona = PERSONAS[indice % len(PERSONAS)]
+    pagador = PAGADORES[indice % len(PAGADORES)]
+    importe = f"{indice + 1},{ronda:02d}"
+    esperado = (persona, pagador, f"stress {user_id} {ronda}", float(importe.replace(",", ".")))
+    pasos = [
+        ("txt", "/start"),
+        ("cb", "menu|gestion"),
+        ("cb", "menu|add"),
+        ("cb", "fecha|hoy"),
+        ("cb", f"persona|{persona}"),
+        ("cb", f"pagador|{pagador}"),
+        ("cb", "tipo|Gasto"),
+        ("cb", "categoria|Comida"),
+        ("cb", "sub1|Supermercado"),
+        ("cb", "sub2|Mercadona"),
+        ("cb", "obs|si"),
+        ("txt", esperado[2]),
+        ("txt", importe),
+    ]
+    return pasos, esperado
+
+
+def pasos_resumen():
+    hoy = date.today()
+    return [
+        ("txt", "/start"),
+        ("cb", "menu|gestion"),
+        ("cb", "menu|resumen"),
+        ("cb", f"resumen_mes|{hoy.year}|{hoy.month}"),
+        ("cb", f"resumen_final|{hoy.year}|{hoy.month}|Todos"),
+    ]
+
+
+def procesador_modo(main, modo):
+    from telegram.ext import SimpleUpdateProcessor
+
+    if modo == "usuario":
+        return main.ProcesadorUpdates()
+    if modo == "secuencial":
+        return SimpleUpdateProcessor(1)
+    return SimpleUpdateProcessor(main.UPDATES_EN_VUELO)
+
+
+def fallar_almacen(almacen, tasa, semilla=7):
+    """Hace fallar con probabilidad ``tasa`` las llamadas al almacén que hace el procesador."""
+    rnd = random.Random(semilla)
+    fallos = Counter()
+
+    def envolver(nombre, aplica):
+        original = getattr(almacen, nombre)
+
+        def llamada(*args):
+            if aplica(*args) and rnd.random() < tasa:
+                fallos[nombre] += 1
+                raise sqlite3.OperationalError("database is locked")
+            return original(*args)
+
+        setattr(almacen, nombre, llamada)
+
+    envolver("reservar", lambda espacio, *_: espacio in ("update", "escritura"))
+    for nombre in ("leer", "escribir", "borrar"):
+        envolver(nombre, lambda espacio, *_: espacio == "sesion")
+    for nombre in ("adquirir", "liberar"):
+        envolver(nombre, lambda *_: True)
+    return fallos
+
+
+def fallar_procesador(procesador, tasa, semilla=13):
+    """Hace que ``procesador`` lance una excepción tras atender una fracción de los updates."""
+    rnd = random.Random(semilla)
+    fallos = Counter()
+    if not tasa:
+        return fallos
+    original = procesador.do_process_update
+
+    async def do_process_update(update, coroutine):
+        await original(update, coroutine)
+        if rnd.random() < tasa:
+            fallos["procesador"] += 1
+            raise RuntimeError("fallo inyectado en el procesador")
+
+    procesador.do_process_update = do_process_update
+    return fallos
+
+
+async def prueba_estres(usuarios, rondas, modo, tasa_fallo_almacen=0.0, tasa_fallo_procesador=0.0, **opciones):
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    os.environ["AUTHORIZED_USERS"] = ",".join(str(3000 + i) for i in range(usuarios))
+    os.environ.setdefault("ADMIN_ID", "3000")
+
+    benchmark._configurar_entorno()
+    import main
+
+    procesador = procesador_modo(main, modo)
+    fallos_procesador = fallar_procesador(procesador, tasa_fallo_procesador)
+    entorno = await benchmark.preparar_bot(procesador=procesador, **opciones)
+    app = entorno["app"]
+    generador = entorno["generador"]
+    main.ensure_google_sheets_ready()
+    main.sincronizar_registro(forzar=True)
+    fallos_almacen = fallar_almacen(main.get_almacen(), tasa_fallo_almacen)
+
+    encolado = {}
+    latencias = defaultdict(list)
+    tipo_usuario = {}
+
+    async def marcar_fin(update, context):
+        inicio = encolado.pop(update.update_id, None)
+        if inicio is not None:
+            latencias[tipo_usuario[update.effective_user.id]].append((time.perf_counter() - inicio) * 1000)
+
+    app.add_handler(TypeHandler(Update, marcar_fin), group=1)
+
+    user_ids = sorted(main.AUTHORIZED_USERS)
+    guiones = {}
+    esperados = defaultdict(list)
+    for indice, user_id in enumerate(user_ids):
+        if indice == 0:
+            tipo_usuario[user_id] = "resumen"
+            guiones[user_id] = pasos_resumen() * rondas
+            continue
+        tipo_usuario[user_id] = "gasto"
+        guiones[user_id] = []
+        for ronda in range(rondas):
+            pasos, esperado = pasos_gasto(user_id, ronda, indice)
+            guiones[user_id] += pasos
+            esperados[user_id].append(esperado)
+
+    await app.start()
+    inicio = time.perf_counter()
+    # Los toques de todos los usuarios, intercalados y de golpe.
+    for posicion in range(max(len(g) for g in guiones.values())):
+        for user_id, guion in guiones.items():
+            if posicion < len(guion):
+                update = generador.paso(user_id, guion[posicion])
+                encolado[update.update_id] = time.perf_counter()
+                await app.update_queue.put(update)
+    try:
+        await asyncio.wait_for(app.update_queue.join(), timeout=120)
+    except asyncio.TimeoutError:
+        print(f"❌ La cola no se ha vaciado: {app.update_queue.en_vuelo} updates en vuelo sin terminar")
+        return False
+    transcurrido = time.perf_counter() - inicio
+    await app.stop()
+    huecos_perdidos = app.update_queue.en_vuelo
+
+    filas = main.consultar_registro(
+        "SELECT observacion, persona, pagador, importe FROM registro WHERE observacion LIKE 'stress %'"
+    )
+    obtenidos = defaultdict(list)
+    for observacion, persona, pagador, importe in filas:
+        obtenidos[int(observacion.split()[1])].append((persona, pagador, observacion, importe))
+
+    fallos = []
+    for user_id, lista in esperados.items():
+        if sorted(obtenidos.get(user_id, [])) != sorted(lista):
+            fallos.append(
+                f"usuario {user_id}: esperaba {len(lista)} gastos, hay {len(obtenidos.get(user_id, []))}"
+                + ("" if len(obtenidos.get(user_id, [])) != len(lista) else " con datos mezclados")
+            )
+        persona, pagador, observacion, _ = lista[-1]
+        estado = main.user_states.get(user_id, {})
+        final = (estado.get("persona"), estado.get("pagador"), estado.get("observacion"))
+        if final != (persona, pagador, observacion):
+            fallos.append(f"usuario {user_id}: sesión final {final} en vez de {(persona, pagador, observacion)}")
+
+    await app.shutdown()
+
+    p = benchmark.percentil
+    total = sum(len(v) for v in latencias.values())
+    print(
+        f"Modo {modo} | {usuarios} usuarios x {rondas} rondas | {total} updates en {transcurrido:.1f}s | "
+        f"errores: {len(entorno['errores'])} | máx. en curso: {main._metricas_updates['max_en_curso']}"
+    )
+    print(f"{'Usuarios':10} | {'n':5} | {'p50 ms':8} | {'p95 ms':8} | {'max ms':8}")
+    for tipo, valores in sorted(latencias.items()):
+        print(f"{tipo:10} | {len(valores):5} | {p(valores, 50):8.1f} | {p(valores, 95):8.1f} | {max(valores):8.1f}")
+    if tasa_fallo_almacen:
+        print("Fallos de almacén inyectados: " + (", ".join(f"{k}={v}" for k, v in sorted(fallos_almacen.items())) or "0"))
+    if tasa_fallo_procesador:
+        print(f"Fallos de procesador inyectados: {fallos_procesador['procesador']}")
+    if huecos_perdidos:
+        fallos.append(f"{huecos_perdidos} huecos en vuelo sin devolver tras vaciar la cola")
+
+    if fallos or entorno["errores"]:
+        print("\n❌ Estado corrupto:")
+        for fallo in fallos:
+            print(f"  - {fallo}")
+        for error in entorno["errores"][:5]:
+            print(f"  - error en handler: {error!r}")
+        return False
+    print("\n✅ Estado de sesión consistente")
+    return True
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, default=6)
+    parser.add_argument("--rondas", type=int, default=5)
+    parser.add_argument("--modo", choices=["usuario", "secuencial", "sin-orden"], default="usuario")
+    parser.add_argument("--latencia-sheets-ms", type=float, default=80)
+    parser.add_argument("--latencia-telegram-ms", type=float, default=40)
+    parser.add_argument("--variacion-telegram-ms", type=float, default=40,
+                        help="extra aleatorio por llamada: las respuestas llegan desordenadas")
+    parser.add_argument("--tasa-fallo-almacen", type=float, default=0.0,
+                        help="fracción de llamadas del procesador al almacén que fallan")
+    parser.add_argument("--tasa-fallo-procesador", type=float, default=0.0,
+                        help="fracción de updates tras los que el procesador lanza una excepción (modo usuario)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    nivel_log = logging.INFO if args.verbose else logging.CRITICAL
+    logging.basicConfig(level=nivel_log)
+    logging.getLogger().setLevel(nivel_log)
+
+    correcto = asyncio.run(prueba_estres(
+        max(args.usuarios, 2),
+        args.rondas,
+        args.modo,
+        latencia_sheets_ms=args.latencia_sheets_ms,
+        latencia_telegram_ms=args.latencia_telegram_ms,
+        variacion_telegram_ms=args.variacion_telegram_ms,
+        tasa_fallo_almacen=args.tasa_fallo_almacen,
+        tasa_fallo_procesador=args.tasa_fallo_procesador,
+    ))
+    raise SystemExit(0 if correcto else 1)
+
+
+if __name__ == "__main__":
+    main_cli()